@@ -1,4 +1,18 @@
 from .pySmartDL import SmartDL, HashFailedException, CanceledException
+from .remote import RemoteFile
 from . import utils
+from . import transport
+from . import writer
+from . import extract
+from . import progress
+from . import telemetry
+from . import tls
+from . import singleflight
+from . import sync
+from . import tracing
+from . import governor
+from . import hashsums
+from . import supervisor
+from . import multirange
 
 __version__ = pySmartDL.__version__
\ No newline at end of file
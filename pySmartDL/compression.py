@@ -0,0 +1,121 @@
+'''
+Helpers for transparent `Content-Encoding` support. gzip and deflate are always
+available; br and zstd are offered if the `brotli` and `zstandard` packages are installed.
+'''
+
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+def accept_encoding():
+    '''
+    Returns the value of the `Accept-Encoding` header, listing every encoding we can decode.
+
+    :rtype: string
+    '''
+    encodings = []
+    if zstandard:
+        encodings.append('zstd')
+    if brotli:
+        encodings.append('br')
+    encodings.extend(['gzip', 'deflate'])
+    return ', '.join(encodings)
+
+def get_content_encoding(headers):
+    '''
+    Returns the content-encoding of a response, or None if it is not encoded. Stacked
+    encodings are returned as they are listed, like `gzip, br`.
+
+    :param headers: Response headers.
+    :rtype: string
+    '''
+    encodings = _split(headers.get('Content-Encoding') or '')
+    if not encodings:
+        return None
+    return ', '.join(encodings)
+
+def _split(encoding):
+    return [e for e in [e.strip().lower() for e in encoding.split(',')] if e and e != 'identity']
+
+def is_supported(encoding):
+    '''
+    Returns True if `get_decoder()` can decode the content-encoding.
+
+    :param encoding: Content encoding, such as `gzip` or `gzip, br`.
+    :type encoding: string
+    :rtype: bool
+    '''
+    try:
+        get_decoder(encoding)
+    except ValueError:
+        return False
+    return True
+
+class _BrotliDecoder(object):
+    def __init__(self):
+        self._obj = brotli.Decompressor()
+    def decompress(self, data):
+        return self._obj.process(bytes(data))
+    def flush(self):
+        return b''
+
+class _DeflateDecoder(object):
+    "Some servers send raw deflate data instead of zlib-wrapped data. Handle both."
+    def __init__(self):
+        self._obj = None
+    def decompress(self, data):
+        if self._obj is None:
+            try:
+                self._obj = zlib.decompressobj()
+                return self._obj.decompress(data)
+            except zlib.error:
+                self._obj = zlib.decompressobj(-zlib.MAX_WBITS)
+        return self._obj.decompress(data)
+    def flush(self):
+        return self._obj.flush() if self._obj else b''
+
+class _ChainDecoder(object):
+    "Decodes stacked encodings. They are listed in the order they were applied, so they are decoded in reverse."
+    def __init__(self, decoders):
+        self._decoders = decoders
+    def decompress(self, data):
+        for decoder in self._decoders:
+            data = decoder.decompress(data)
+        return data
+    def flush(self):
+        data = b''
+        for decoder in self._decoders:
+            data = decoder.decompress(data) + decoder.flush() if data else decoder.flush()
+        return data
+
+def get_decoder(encoding):
+    '''
+    Returns a streaming decoder for a content-encoding. The decoder has `decompress(data)`
+    and `flush()` methods. Raises `ValueError` if the encoding is not supported.
+
+    :param encoding: Content encoding, such as `gzip`, or stacked encodings, such as `gzip, br`.
+    :type encoding: string
+    '''
+    encodings = _split(encoding)
+    if len(encodings) > 1:
+        return _ChainDecoder([_get_decoder(e) for e in reversed(encodings)])
+    return _get_decoder(encodings[0] if encodings else encoding)
+
+def _get_decoder(encoding):
+    if encoding in ('gzip', 'x-gzip'):
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if encoding == 'deflate':
+        return _DeflateDecoder()
+    if encoding == 'br' and brotli:
+        return _BrotliDecoder()
+    if encoding == 'zstd' and zstandard:
+        return zstandard.ZstdDecompressor().decompressobj()
+    raise ValueError("Unsupported content-encoding: {}".format(encoding))
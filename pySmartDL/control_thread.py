@@ -1,68 +1,82 @@
-import threading
 import time
 
-from . import utils
+from . import tracing
+from .telemetry import Telemetry
+from .supervisor import supervisor
 
-class ControlThread(threading.Thread):
-    "A class that shows information about a running SmartDL object."
-    def __init__(self, obj):
-        threading.Thread.__init__(self)
+class ControlThread(object):
+    '''
+    A class that shows information about a running SmartDL object. It's not a thread
+    anymore: `pySmartDL.supervisor` calls `tick()` periodically, and runs the actions
+    after the download in the shared pool.
+
+    :param post_actions: A function that runs once the pool is done.
+    '''
+    def __init__(self, obj, post_actions=None):
         self.obj = obj
-        self.progress_bar = obj.progress_bar
         self.logger = obj.logger
         self.shared_var = obj.shared_var
         
+        self.telemetry = Telemetry(self.shared_var.array)
         self.dl_speed = 0
         self.eta = 0
-        self.lastBytesSamples = []  # list with last 50 Bytes Samples.
-        self.last_calculated_totalBytes = 0
-        self.calcETA_queue = []
-        self.calcETA_i = 0
-        self.calcETA_val = 0
+        self.min_eta_time = 2  # seconds of samples before an ETA is given
         self.dl_time = -1.0
-        
-        self.daemon = True
-        self.start()
-        
-    def run(self):
-        t1 = time.time()
-        self.logger.info("Control thread has been started.")
-        
-        while not self.obj.pool.done():
-            self.dl_speed = self.calcDownloadSpeed(self.shared_var.value)
-            if self.dl_speed > 0:
-                self.eta = self.calcETA((self.obj.filesize-self.shared_var.value)/self.dl_speed)
+        self.t1 = time.time()
+        self.post_actions = post_actions
+        self.post_future = None
+
+    def tick(self):
+        "Samples the progress. Once the pool is done, submits the post actions. Returns True when there's nothing left to watch."
+        obj = self.obj
+        if not obj.pool.done():
+            self.dl_speed = self.telemetry.sample()
+            if obj._watchdog and not obj._killed:
+                obj._watchdog.check(paused=obj.status == 'paused')
+            if obj.filesize and self.telemetry.total.elapsed() >= self.min_eta_time:
+                self.eta = self.telemetry.total.eta(obj.filesize-self.shared_var.value)
                 
-            if self.progress_bar:
-                if self.obj.filesize:
-                    status = r"[*] %s / %s @ %s/s %s [%3.1f%%, %s left]   " % (utils.sizeof_human(self.shared_var.value), utils.sizeof_human(self.obj.filesize), utils.sizeof_human(self.dl_speed), utils.progress_bar(1.0*self.shared_var.value/self.obj.filesize), self.shared_var.value * 100.0 / self.obj.filesize, utils.time_human(self.eta, fmt_short=True))
-                else:
-                    status = r"[*] %s / ??? MB @ %s/s   " % (utils.sizeof_human(self.shared_var.value), utils.sizeof_human(self.dl_speed))
-                status = status + chr(8)*(len(status)+1)
-                print(status, end=' ', flush=True)
-            time.sleep(0.1)
+            if obj.engine == 'process':
+                # the workers run in other processes, and can't call the callbacks themselves.
+                obj._notify_progress()
+            return False
             
-        if self.obj._killed:
+        if obj._killed:
             self.logger.info("File download process has been stopped.")
-            return
-            
-        if self.progress_bar:
-            if self.obj.filesize:
-                print(r"[*] %s / %s @ %s/s %s [100%%, 0s left]    " % (utils.sizeof_human(self.obj.filesize), utils.sizeof_human(self.obj.filesize), utils.sizeof_human(self.dl_speed), utils.progress_bar(1.0)))
-            else:
-                print(r"[*] %s / %s @ %s/s    " % (utils.sizeof_human(self.shared_var.value), utils.sizeof_human(self.shared_var.value), utils.sizeof_human(self.dl_speed)))
-                
-        t2 = time.time()
-        self.dl_time = float(t2-t1)
-        
-        while self.obj.post_threadpool_thread.is_alive():
-            time.sleep(0.1)
+            obj._extract_stop.set()
+            obj._done.set()
+            return True
             
+        self.telemetry.sample()  # a fast transfer may be done before the first sample
+        obj._notify_progress(force=True)
+        self.dl_time = float(time.time()-self.t1)
+
+        self.post_future = supervisor.submit(tracing.wrap(obj.tracer, self.post_actions))
+        self.post_future.add_done_callback(self._post_done)
+        return True
+
+    def _post_done(self, future):
+        if future.exception():
+            self.logger.exception(future.exception())
+        if self.obj.control_thread is not self:
+            return  # the download was retried, and a new run took over.
         self.obj.pool.shutdown()
         self.obj.status = "finished"
         if not self.obj.errors:
             self.logger.info("File downloaded within %.2f seconds." % self.dl_time)
+
+    def abort(self, e):
+        "Called by the supervisor if `tick()` raised an exception."
+        self.logger.exception(e)
+        self.obj.errors.append(e)
+        self.obj._failed = True
+        self.obj.status = "finished"
             
+    def finish(self, dl_time):
+        "Sets the final stats of a download that didn't need the thread."
+        self.dl_time = dl_time
+        self.dl_speed = self.shared_var.value / dl_time if dl_time > 0 else 0
+
     def get_eta(self):
         if self.eta <= 0 or self.obj.status == 'paused':
             return 0
@@ -72,7 +86,7 @@ class ControlThread(threading.Thread):
             return 0
         return self.dl_speed
     def get_dl_size(self):
-        if self.shared_var.value > self.obj.filesize:
+        if self.obj.filesize and self.shared_var.value > self.obj.filesize:
             return self.obj.filesize
         return self.shared_var.value
     def get_final_filesize(self):
@@ -83,37 +97,3 @@ class ControlThread(threading.Thread):
         return 1.0*self.shared_var.value/self.obj.filesize
     def get_dl_time(self):
         return self.dl_time
-        
-    def calcDownloadSpeed(self, totalBytes, sampleCount=30, sampleDuration=0.1):
-        '''
-        Function calculates the download rate.
-        @param totalBytes: The total amount of bytes.
-        @param sampleCount: How much samples should the function take into consideration.
-        @param sampleDuration: Duration of a sample in seconds.
-        '''
-        l = self.lastBytesSamples
-        newBytes = totalBytes - self.last_calculated_totalBytes
-        self.last_calculated_totalBytes = totalBytes
-        if newBytes >= 0: # newBytes may be negetive, will happen
-                          # if a thread has crushed and the totalBytes counter got decreased.
-            if len(l) == sampleCount: # calc download for last 3 seconds (30 * 100ms per signal emit)
-                l.pop(0)
-                
-            l.append(newBytes)
-            
-        dlRate = sum(l)/len(l)/sampleDuration
-        return dlRate
-        
-    def calcETA(self, eta):
-        self.calcETA_i += 1
-        l = self.calcETA_queue
-        l.append(eta)
-        
-        if self.calcETA_i % 10 == 0:
-            self.calcETA_val = sum(l)/len(l)
-        if len(l) == 30:
-            l.pop(0)
-
-        if self.calcETA_i < 50:
-            return 0
-        return self.calcETA_val
@@ -2,57 +2,175 @@ import os
 import urllib.request, urllib.error, urllib.parse
 import time
 from . import utils
+from . import compression
+from . import tracing
+from . import governor
+from .transport import get_default_transport
+from .metrics import bind as bind_metrics
 
-def download(url, dest, requestArgs=None, context=None, startByte=0, endByte=None, timeout=4, shared_var=None, thread_shared_cmds=None, logger=None, retries=3):
-    "The basic download function that runs at each thread."
+def download(url, dest, requestArgs=None, context=None, startByte=0, endByte=None, timeout=4, shared_var=None, thread_shared_cmds=None, logger=None, retries=3, transport=None, decompress=False, decoded_var=None, offset=None, metrics=None, writer=None, progress=None, urlObj=None, attempt=None, resumable=False, fallback_url=None):
+    '''
+    The basic download function that runs at each thread. If `urlObj` is given, the already opened response is read instead of opening a new one. If `attempt` (a `pySmartDL.hedging.Attempt`) is canceled, the download stops early.
+
+    If `fallback_url` is given, `url` is the target of its redirects. `fallback_url` is requested instead if `url` is a
+    signed url that expired, or if it's refused with a HTTP 403 or 410.
+
+    A pause closes the connection, and the rest of the range is requested on resume, if the server supports ranges: if
+    the response is partial (`206`), or if `resumable` is true. Else, the connection is kept open during the pause.
+    '''
     logger = logger or utils.DummyLogger()
-    req = urllib.request.Request(url, **requestArgs)
-    if endByte:
-        req.add_header('Range', 'bytes={:.0f}-{:.0f}'.format(startByte, endByte))
+    transport = transport or get_default_transport()
     logger.info("Downloading '{}' to '{}'...".format(url, dest))
+
+    done = 0  # bytes written before the pauses
+    while True:
+        if fallback_url and urlObj is None and utils.is_url_expired(url):
+            logger.info("'{}' expired. Using '{}'.".format(url, fallback_url))
+            url, fallback_url = fallback_url, None
+        try:
+            paused_at = _download(url, dest, requestArgs, context, startByte+done, endByte, timeout, shared_var, thread_shared_cmds, logger, retries,
+                                  transport, decompress, decoded_var, (offset or 0)+done if done else offset, metrics, writer, progress, urlObj, attempt, resumable, bool(done), fallback_url)
+        except utils.CanceledException:
+            raise
+        except Exception:
+            if shared_var and done:
+                shared_var.value -= done
+            raise
+        if paused_at is None:
+            return
+        done += paused_at
+        urlObj = None
+        logger.info('Paused after {}. The connection is closed until the download is resumed.'.format(utils.sizeof_human(done)))
+        while 'pause' in thread_shared_cmds:
+            if 'stop' in thread_shared_cmds:
+                logger.info('stop command received. Stopping.')
+                raise utils.CanceledException()
+            if attempt is not None and attempt.canceled:
+                return
+            time.sleep(0.2)
+
+def _download(url, dest, requestArgs, context, startByte, endByte, timeout, shared_var, thread_shared_cmds, logger, retries, transport, decompress, decoded_var, offset, metrics, writer, progress, urlObj, attempt, resumable, resumed, fallback_url=None):
+    "Opens the request and reads it. Returns the number of bytes read if the download was paused and the connection closed, else None."
+    # every request holds a slot of its host, so the hosts that refuse connections get fewer of them.
+    host = None
+    if urlObj is None and governor.ENABLED:
+        host = governor.governor.get(url)
+        while not host.acquire(timeout=0.5):
+            if thread_shared_cmds and 'stop' in thread_shared_cmds:
+                logger.info('stop command received. Stopping.')
+                raise utils.CanceledException()
     try:
         # Context is used to skip ssl validation if verify is False.
-        urlObj = urllib.request.urlopen(req, timeout=timeout, context=context)
+        if urlObj is None:
+            with bind_metrics(metrics), tracing.span('request', start=startByte, end=endByte):
+                urlObj = transport.open(url, requestArgs, context=context, timeout=timeout, startByte=startByte, endByte=endByte)
+            if resumed or startByte:
+                # the data is written at the position of startByte, so anything but that range would corrupt the file.
+                content_range = utils.parse_content_range(urlObj.headers.get('Content-Range'))
+                if urlObj.status != 206 or (content_range and content_range[0] != startByte):
+                    urlObj.close()
+                    raise urllib.error.URLError('The server ignored the range request from byte {} (HTTP {}, Content-Range: {}).'.format(startByte, urlObj.status, urlObj.headers.get('Content-Range')))
     except urllib.error.HTTPError as e:
-        if e.code == 416:
+        retry_after = utils.parse_retry_after(e.headers.get('Retry-After')) if e.headers else None
+        if host:
+            if e.code in governor.OVERLOAD_CODES or retry_after is not None:
+                with bind_metrics(metrics):
+                    host.on_overload(retry_after and min(retry_after, governor.MAX_RETRY_AFTER))
+            host.release()
+        if fallback_url and e.code in utils.EXPIRED_URL_CODES:
+            # the redirect target was signed, and isn't valid anymore. the original url redirects to a fresh one.
+            logger.info("'{}' was refused (HTTP {}). Using '{}'.".format(url, e.code, fallback_url))
+            return _download(fallback_url, dest, requestArgs, context, startByte, endByte, timeout, shared_var, thread_shared_cmds, logger, retries, transport, decompress, decoded_var, offset, metrics, writer, progress, None, attempt, resumable, resumed)
+        if e.code in governor.OVERLOAD_CODES:
             '''
             HTTP 416 Error: Requested Range Not Satisfiable. Happens when we ask
             for a range that is not available on the server. It will happen when
             the server will try to send us a .html page that means something like
-            "you opened too many connections to our server". If this happens, we
-            will wait for the other threads to finish their connections and try again.
+            "you opened too many connections to our server". 429 (Too Many Requests)
+            and 503 (Service Unavailable) mean the same. If this happens, we will wait
+            for the other threads to finish their connections and try again.
             '''
             
             if retries > 0:
-                logger.warning("Thread didn't got the file it was expecting. Retrying ({} times left)...".format(retries-1))
-                time.sleep(5)
-                return download(url, dest, requestArgs, startByte, endByte, timeout, shared_var, thread_shared_cmds, logger, retries-1)
+                delay = governor.RETRY_DELAY if retry_after is None else min(retry_after, governor.MAX_RETRY_AFTER)
+                logger.warning("Thread didn't got the file it was expecting (HTTP {}). Retrying in {:.0f}s ({} times left)...".format(e.code, delay, retries-1))
+                with tracing.span('retry', code=e.code, retries_left=retries-1):
+                    time.sleep(delay)
+                return _download(url, dest, requestArgs, context, startByte, endByte, timeout, shared_var, thread_shared_cmds, logger, retries-1, transport, decompress, decoded_var, offset, metrics, writer, progress, None, attempt, resumable, resumed, fallback_url)
             else:
                 raise
         else:
             raise
-    
-    with open(dest, 'wb') as f:
-        if endByte:
-            filesize = endByte-startByte
-        else:
-            try:
-                meta = urlObj.info()
-                filesize = int(urlObj.headers["Content-Length"])
+    except BaseException:
+        if host:
+            host.release()
+        raise
+
+    if host:
+        host.on_success()
+    try:
+        return _read(urlObj, dest, startByte, endByte, shared_var, thread_shared_cmds, logger, decompress, decoded_var, offset, writer, progress, attempt, resumable)
+    finally:
+        if host:
+            host.release()
+
+def _read(urlObj, dest, startByte, endByte, shared_var, thread_shared_cmds, logger, decompress, decoded_var, offset, writer, progress, attempt, resumable):
+    "Reads the response into `dest`. Returns the number of bytes read if the download was paused and the response closed, else None."
+    if attempt is not None:
+        attempt.response = urlObj
+    encoding = compression.get_content_encoding(urlObj.headers) if decompress else None
+    decoder = compression.get_decoder(encoding) if encoding else None
+    if decoder:
+        logger.info("Content is {}-encoded. Decoding it on the fly.".format(encoding))
+    # the state of a decoder can't be resumed from the middle of the stream.
+    resumable = not decoder and (resumable or urlObj.status == 206)
+    paused = False
+
+    if attempt is not None and attempt.canceled:
+        # another request finished the range before this one was answered. the file isn't even opened.
+        urlObj.close()
+        return None
+
+    # if offset is given, dest already exists (it's preallocated, or shared with other requests).
+    if writer:
+        f = writer.open(dest, offset)
+    else:
+        f = open(dest, 'r+b' if offset is not None else 'wb')
+        if offset is not None:
+            f.seek(offset)
+    tracer = tracing.current()
+    if tracer:
+        f = tracing.TimedFile(f)
+        read_start = tracer.now()
+    with f:
+        try:
+            meta = urlObj.info()
+            filesize = int(urlObj.headers["Content-Length"])
+            if not endByte:
                 logger.info("Content-Length is {}.".format(filesize))
-            except (IndexError, KeyError, TypeError):
+        except (IndexError, KeyError, TypeError):
+            filesize = endByte-startByte+1 if endByte else None
+            if not endByte:
                 logger.warning("Server did not send Content-Length. Filesize is unknown.")
         
         filesize_dl = 0  # total downloaded size
         limitspeed_timestamp = time.time()
         limitspeed_filesize = 0
         block_sz = 8192
+        buff = bytearray(block_sz)
+        view = memoryview(buff)
         while True:
+            if attempt is not None and attempt.canceled:
+                logger.info('Another request finished the range. Stopping.')
+                break
             if thread_shared_cmds:
                 if 'stop' in thread_shared_cmds:
                     logger.info('stop command received. Stopping.')
-                    raise CanceledException()
+                    raise utils.CanceledException()
                 if 'pause' in thread_shared_cmds:
+                    if resumable and (filesize is None or filesize_dl < filesize):
+                        paused = True
+                        break
                     time.sleep(0.2)
                     continue
                 if 'limit' in thread_shared_cmds:
@@ -70,19 +188,40 @@ def download(url, dest, requestArgs=None, context=None, startByte=0, endByte=Non
                             limitspeed_filesize = filesize_dl
                 
             try:
-                buff = urlObj.read(block_sz)
+                n = urlObj.readinto(buff)
             except Exception as e:
+                if attempt is not None and attempt.canceled:
+                    logger.info('Another request finished the range. Stopping.')
+                    break
                 logger.error(str(e))
                 if shared_var:
                     shared_var.value -= filesize_dl
                 raise
                 
-            if not buff:
+            if not n:
                 break
 
-            filesize_dl += len(buff)
+            filesize_dl += n
             if shared_var:
-                shared_var.value += len(buff)
-            f.write(buff)
+                shared_var.value += n
+            if progress:
+                progress()
+            if decoder:
+                data = decoder.decompress(view[:n])
+                if decoded_var:
+                    decoded_var.value += len(data)
+                f.write(data)
+            else:
+                f.write(view[:n])
+
+        if decoder:
+            data = decoder.flush()
+            if decoded_var:
+                decoded_var.value += len(data)
+            f.write(data)
             
+    if tracer:
+        tracer.add_span('read', read_start, tracer.now(), {'bytes': filesize_dl, 'write_time': f.write_time})
     urlObj.close()
+    if paused:
+        return filesize_dl
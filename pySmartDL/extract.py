@@ -0,0 +1,541 @@
+'''
+Archive extraction while the archive downloads.
+
+* tar archives (`.tar`, `.tar.gz`, `.tgz`, `.tar.bz2`, `.tar.xz`, and `.tar.zst` if `zstandard` is installed)
+  are fed in order into `tarfile`'s stream mode, as the range workers write them.
+* zip archives need their central directory, which is at the end of the file. It is
+  fetched first with a range request, and every member is extracted as soon as the
+  ranges that hold it are downloaded. If the archive doesn't need to be kept, the
+  members are fetched directly with range requests, and nothing but the extracted
+  files is written to disk.
+'''
+
+import io
+import os
+import tarfile
+import zipfile
+import threading
+import urllib.error
+from concurrent import futures
+
+from . import utils
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+TAR_SUFFIXES = ('.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz', '.txz')
+TAR_ZST_SUFFIXES = ('.tar.zst', '.tzst')
+
+def detect_format(filename):
+    '''
+    Detects the archive format of a filename.
+
+    :param filename: Filename or path.
+    :type filename: string
+    :returns: `zip`, `tar`, `tar.zst`, or None if it's not a supported archive.
+    :rtype: string
+    '''
+    name = filename.lower()
+    if name.endswith('.zip'):
+        return 'zip'
+    if name.endswith(TAR_SUFFIXES):
+        return 'tar'
+    if name.endswith(TAR_ZST_SUFFIXES) and zstandard:
+        return 'tar.zst'
+    return None
+
+class ExtractionCanceled(Exception):
+    "Raised inside the extractor when the download is stopped or restarted."
+    pass
+
+class PartsReader(io.RawIOBase):
+    '''
+    Reads the part files of a download, in order, while they are being written.
+
+    :param parts: Part files.
+    :type parts: list of strings
+    :param sizes: Expected size of every part. None if unknown (the part is then complete when `is_finished()` returns true).
+    :type sizes: list of ints
+    :param is_finished: A function that returns true once the download threads are done.
+    :param stop_event: When set, reading raises `ExtractionCanceled`.
+    :type stop_event: `threading.Event` instance
+    '''
+    def __init__(self, parts, sizes, is_finished, stop_event, poll_interval=0.05):
+        self.parts = parts
+        self.sizes = sizes
+        self.is_finished = is_finished
+        self.stop_event = stop_event
+        self.poll_interval = poll_interval
+        self._index = 0
+        self._read = 0
+        self._f = None
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while self._index < len(self.parts):
+            if self.stop_event.is_set():
+                raise ExtractionCanceled()
+            size = self.sizes[self._index]
+            if size is not None and self._read >= size:
+                self._next_part()
+                continue
+            if self._f is None:
+                try:
+                    self._f = open(self.parts[self._index], 'rb')
+                except FileNotFoundError:
+                    self.stop_event.wait(self.poll_interval)
+                    continue
+
+            view = memoryview(b)
+            if size is not None:
+                view = view[:size-self._read]
+            n = self._f.readinto(view)
+            if n:
+                self._read += n
+                return n
+            if size is None and self.is_finished():
+                # one last read, in case the data was written just before the workers finished.
+                n = self._f.readinto(view)
+                if n:
+                    self._read += n
+                    return n
+                self._next_part()
+                continue
+            self.stop_event.wait(self.poll_interval)
+        return 0
+
+    def _next_part(self):
+        if self._f:
+            self._f.close()
+            self._f = None
+        self._index += 1
+        self._read = 0
+
+    def close(self):
+        if self._f:
+            self._f.close()
+            self._f = None
+        super().close()
+
+def _extract_tar(tar, path):
+    if hasattr(tarfile, 'data_filter'):
+        tar.extractall(path, filter='data')
+    else:
+        for member in tar:
+            target = os.path.realpath(os.path.join(path, member.name))
+            if not target.startswith(os.path.realpath(path) + os.sep):
+                raise tarfile.TarError("Refusing to extract {} outside of {}".format(member.name, path))
+            tar.extract(member, path)
+
+def extract_tar_stream(fileobj, path, fmt='tar'):
+    '''
+    Extracts a tar archive from a non-seekable file object.
+
+    :param fileobj: A readable file object.
+    :param path: Destination folder.
+    :type path: string
+    :param fmt: `tar` (optionally gz/bz2/xz compressed) or `tar.zst`.
+    :type fmt: string
+    '''
+    if fmt == 'tar.zst':
+        fileobj = zstandard.ZstdDecompressor().stream_reader(fileobj)
+    with tarfile.open(fileobj=fileobj, mode='r|*') as tar:
+        _extract_tar(tar, path)
+
+def extract_file(filename, path, fmt):
+    '''
+    Extracts a complete archive file.
+
+    :param filename: Archive path.
+    :type filename: string
+    :param path: Destination folder.
+    :type path: string
+    :param fmt: The archive format, as returned by `detect_format()`.
+    :type fmt: string
+    '''
+    if fmt == 'zip':
+        with zipfile.ZipFile(filename) as zf:
+            zf.extractall(path)
+    else:
+        with open(filename, 'rb') as f:
+            extract_tar_stream(f, path, fmt)
+
+class MissingRange(Exception):
+    "Raised by `SparseFile` when data that wasn't fetched yet is read."
+    def __init__(self, start, end):
+        self.start = start
+        self.end = end
+
+class SparseFile(io.RawIOBase):
+    '''
+    A seekable, read-only file of a known size, of which only some segments are available.
+    A segment is either held in memory, or read on demand from a source (see `add_source()`).
+    Reading a missing segment raises `MissingRange`.
+    '''
+    def __init__(self, size):
+        self.size = size
+        self.segments = {}
+        self._pos = 0
+        self._lock = threading.Lock()
+
+    def add(self, start, data):
+        self.add_source(start, len(data), _BytesSource(data))
+
+    def add_source(self, start, size, source):
+        '''
+        Adds a segment that is read on demand. `source.readinto(pos, b)` reads the data of the
+        segment from `pos` (relative to `start`) into `b`, and returns the number of bytes read.
+        `source.close()` is called when the segment is removed.
+        '''
+        with self._lock:
+            self.segments[start] = (size, source)
+
+    def view(self):
+        '''
+        Returns a `SparseFile` over the same segments, with its own position, so another thread can read it.
+        '''
+        view = SparseFile(self.size)
+        view.segments = self.segments
+        view._lock = self._lock
+        return view
+
+    def remove(self, start):
+        with self._lock:
+            segment = self.segments.pop(start, None)
+        if segment:
+            segment[1].close()
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self._pos = offset
+        elif whence == io.SEEK_CUR:
+            self._pos += offset
+        else:
+            self._pos = self.size + offset
+        return self._pos
+
+    def readinto(self, b):
+        n = min(len(b), self.size - self._pos)
+        if n <= 0:
+            return 0
+        with self._lock:
+            for start, (size, source) in self.segments.items():
+                if start <= self._pos < start+size:
+                    break
+            else:
+                raise MissingRange(self._pos, self._pos+n)
+        # a source may read from the network, so it's read outside the lock.
+        n = source.readinto(self._pos-start, memoryview(b)[:min(n, start+size-self._pos)])
+        self._pos += n
+        return n
+
+class _BytesSource(object):
+    def __init__(self, data):
+        self.data = data
+
+    def readinto(self, pos, b):
+        n = len(b)
+        b[:n] = self.data[pos:pos+n]
+        return n
+
+    def close(self):
+        pass
+
+class _StreamSource(object):
+    "Streams a segment with a range request, opened on the first read. A read elsewhere than the position of the stream reopens it there."
+    def __init__(self, fetch, start, end):
+        self.fetch = fetch
+        self.start = start
+        self.end = end
+        self._stream = None
+        self._pos = None
+
+    def readinto(self, pos, b):
+        if self._stream is None or pos != self._pos:
+            self.close()
+            self._stream = self.fetch.open(self.start+pos, self.end)
+            self._pos = pos
+        n = self._stream.readinto(b)
+        self._pos += n
+        return n
+
+    def close(self):
+        if self._stream:
+            self._stream.close()
+            self._stream = None
+
+class _PartsSource(object):
+    "Reads a segment from the part files of a download."
+    def __init__(self, chunks, parts, start):
+        self.chunks = chunks
+        self.parts = parts
+        self.start = start
+        self._f = None
+        self._part = None
+
+    def readinto(self, pos, b):
+        offset = self.start + pos
+        for (chunk_start, chunk_end), part in zip(self.chunks, self.parts):
+            if chunk_start <= offset <= chunk_end:
+                break
+        else:
+            raise MissingRange(offset, offset+len(b))
+        if part != self._part:
+            self.close()
+            self._f = open(part, 'rb')
+            self._part = part
+        self._f.seek(offset-chunk_start)
+        n = self._f.readinto(b[:chunk_end+1-offset])
+        if not n:
+            raise MissingRange(offset, offset+len(b))  # the part is shorter than its range
+        return n
+
+    def close(self):
+        if self._f:
+            self._f.close()
+            self._f = None
+            self._part = None
+
+def open_remote_zip(size, fetch, tail_size=64*1024+22):
+    '''
+    Reads the central directory of a remote zip file, fetching only the data it needs
+    (the tail of the file first).
+
+    :param size: Size of the archive.
+    :type size: int
+    :param fetch: A function `fetch(start, end)` that returns the bytes `[start, end)` of the archive.
+    :returns: `(zf, sparse, ranges)`. `zf` is a `zipfile.ZipFile` over `sparse`, a `SparseFile`. `ranges` is a list of `(info, start, end)` with the byte range of every member's entry.
+    '''
+    sparse = SparseFile(size)
+    start = max(0, size-tail_size)
+    sparse.add(start, fetch(start, size))
+    while True:
+        try:
+            zf = zipfile.ZipFile(sparse)
+            break
+        except MissingRange as e:
+            # a big central directory. fetch the rest of it.
+            sparse.add(e.start, fetch(e.start, min(start, max(e.end, e.start+tail_size))))
+
+    infos = sorted(zf.infolist(), key=lambda info: info.header_offset)
+    cd_start = zf.start_dir
+    ranges = []
+    for i, info in enumerate(infos):
+        end = infos[i+1].header_offset if i+1 < len(infos) else cd_start
+        ranges.append((info, info.header_offset, end))
+    return zf, sparse, ranges
+
+class _ThreadZips(object):
+    "A `zipfile.ZipFile` per thread, over views of one `SparseFile`, so the members are read in parallel instead of under the lock of a shared ZipFile."
+    def __init__(self, sparse):
+        self.sparse = sparse
+        self._local = threading.local()
+        self._zips = []
+        self._lock = threading.Lock()
+
+    def get(self):
+        zf = getattr(self._local, 'zf', None)
+        if zf is None:
+            zf = self._local.zf = zipfile.ZipFile(self.sparse.view())
+            with self._lock:
+                self._zips.append(zf)
+        return zf
+
+    def close(self):
+        with self._lock:
+            zips, self._zips = self._zips, []
+        for zf in zips:
+            zf.close()
+
+def _make_member_dirs(infos, path):
+    # the folders are created before the members are extracted in parallel, so zipfile never races to create one of them.
+    dirs = set([path])
+    for info in infos:
+        arcname = info.filename.replace('/', os.path.sep)
+        if os.path.altsep:
+            arcname = arcname.replace(os.path.altsep, os.path.sep)
+        names = [x for x in os.path.splitdrive(arcname)[1].split(os.path.sep) if x not in ('', os.path.curdir, os.path.pardir)]
+        if not info.filename.endswith('/'):
+            names = names[:-1]
+        dirs.add(os.path.join(path, *names))
+    for d in sorted(dirs):
+        os.makedirs(d, exist_ok=True)
+
+def _extract_member(zips, sparse, info, start, end, source, path):
+    # the member is streamed from its source, so only the blocks that zipfile asks for are in memory.
+    sparse.add_source(start, end-start, source)
+    try:
+        zips.get().extract(info, path)
+    finally:
+        sparse.remove(start)
+
+class _RangeStream(object):
+    def __init__(self, urlObj, size, shared_var):
+        self.urlObj = urlObj
+        self.remaining = size
+        self.shared_var = shared_var
+
+    def readinto(self, b):
+        if not self.remaining:
+            return 0
+        n = self.urlObj.readinto(memoryview(b)[:self.remaining])
+        if not n:
+            raise urllib.error.URLError("The range response ended {} bytes early.".format(self.remaining))
+        self.remaining -= n
+        if self.shared_var:
+            self.shared_var.value += n
+        return n
+
+    def close(self):
+        self.urlObj.close()
+
+class RangeFetcher(object):
+    '''
+    Fetches byte ranges of a url. `fetch(start, end)` returns the bytes `[start, end)`, and
+    `fetch.open(start, end)` returns a stream of them, with `readinto()` and `close()`.
+
+    If `fallback_url` is given, `url` is the target of its redirects, and `fallback_url` is used
+    instead once `url` expires or is refused with a HTTP 403 or 410.
+    '''
+    def __init__(self, url, transport, requestArgs=None, context=None, timeout=None, shared_var=None, fallback_url=None):
+        self.url = url
+        self.transport = transport
+        self.requestArgs = requestArgs
+        self.context = context
+        self.timeout = timeout
+        self.shared_var = shared_var
+        self.fallback_url = fallback_url
+        self._lock = threading.Lock()
+
+    def _use_fallback(self, url):
+        # the members are fetched in parallel, so only the first of them switches to the fallback url.
+        with self._lock:
+            if self.fallback_url and self.url == url:
+                self.url, self.fallback_url = self.fallback_url, None
+            return self.url
+
+    def _open_url(self, start, end):
+        url = self.url
+        if self.fallback_url and utils.is_url_expired(url):
+            url = self._use_fallback(url)
+        try:
+            return self.transport.open(url, self.requestArgs, context=self.context, timeout=self.timeout, startByte=start, endByte=end-1)
+        except urllib.error.HTTPError as e:
+            if e.code not in utils.EXPIRED_URL_CODES or (url == self.url and not self.fallback_url):
+                raise
+            return self.transport.open(self._use_fallback(url), self.requestArgs, context=self.context, timeout=self.timeout, startByte=start, endByte=end-1)
+
+    def open(self, start, end):
+        urlObj = self._open_url(start, end)
+        content_range = utils.parse_content_range(urlObj.headers.get('Content-Range'))
+        # a whole file is only good for a range at its start.
+        if not (urlObj.status == 206 and content_range and content_range[0] == start) and not (urlObj.status == 200 and start == 0):
+            urlObj.close()
+            raise urllib.error.URLError('"{}" does not support range requests.'.format(self.url))
+        return _RangeStream(urlObj, end-start, self.shared_var)
+
+    def __call__(self, start, end):
+        if end <= start:
+            return b''
+        data = bytearray(end-start)
+        view = memoryview(data)
+        stream = self.open(start, end)
+        try:
+            pos = 0
+            while pos < len(data):
+                pos += stream.readinto(view[pos:])
+        finally:
+            stream.close()
+        return bytes(data)
+
+def make_range_fetcher(url, transport, requestArgs=None, context=None, timeout=None, shared_var=None, fallback_url=None):
+    '''
+    Returns a `RangeFetcher` of `url`.
+    '''
+    return RangeFetcher(url, transport, requestArgs, context, timeout, shared_var, fallback_url)
+
+def extract_remote_zip(size, fetch, path, threads=5, stop_event=None):
+    '''
+    Extracts a remote zip archive without downloading the archive itself. Every member is
+    fetched with its own range request, and members are extracted in parallel.
+
+    :param size: Size of the archive.
+    :type size: int
+    :param fetch: A `RangeFetcher`, see `make_range_fetcher()`. The members are streamed with `fetch.open()`.
+    :param path: Destination folder.
+    :type path: string
+    :param threads: Number of members to fetch in parallel.
+    :type threads: int
+    '''
+    zf, sparse, ranges = open_remote_zip(size, fetch)
+    zips = _ThreadZips(sparse)
+
+    def task(info, start, end):
+        if stop_event and stop_event.is_set():
+            raise ExtractionCanceled()
+        _extract_member(zips, sparse, info, start, end, _StreamSource(fetch, start, end), path)
+
+    try:
+        with zf:
+            _make_member_dirs(zf.infolist(), path)
+            with futures.ThreadPoolExecutor(threads) as pool:
+                for future in [pool.submit(task, *r) for r in ranges]:
+                    future.result()
+    finally:
+        zips.close()
+
+def extract_zip_while_downloading(size, fetch, path, chunks, parts, part_futures, stop_event, threads=5, poll_interval=0.1):
+    '''
+    Extracts a zip archive while it downloads. The central directory is fetched with
+    `fetch`, and every member is extracted from the part files once all the ranges that
+    hold it are done.
+
+    :param chunks: The `(startByte, endByte)` range of every part.
+    :type chunks: list of tuples
+    :param parts: Part files.
+    :type parts: list of strings
+    :param part_futures: The future of the worker of every part.
+    :type part_futures: list of `concurrent.futures.Future` instances
+    '''
+    zf, sparse, ranges = open_remote_zip(size, fetch)
+
+    def is_ready(start, end):
+        for (chunk_start, chunk_end), future in zip(chunks, part_futures):
+            if chunk_start < end and start <= chunk_end:
+                if not future.done() or future.exception():
+                    return False
+        return True
+
+    zips = _ThreadZips(sparse)
+    try:
+        with zf:
+            _make_member_dirs(zf.infolist(), path)
+            with futures.ThreadPoolExecutor(threads) as pool:
+                pending = list(ranges)
+                running = []
+                while pending:
+                    if stop_event.is_set():
+                        raise ExtractionCanceled()
+                    for r in [r for r in pending if is_ready(r[1], r[2])]:
+                        pending.remove(r)
+                        info, start, end = r
+                        running.append(pool.submit(_extract_member, zips, sparse, info, start, end, _PartsSource(chunks, parts, start), path))
+                    if pending:
+                        stop_event.wait(poll_interval)
+                for future in running:
+                    future.result()
+    finally:
+        zips.close()
@@ -0,0 +1,145 @@
+'''
+A per-host concurrency governor, shared by all the downloads of the process. Every range
+request holds a slot of its host while it runs.
+
+The number of slots adapts like TCP's congestion window (AIMD): when a server answers
+`416`, `429` or `503`, the host's limit is halved (down to the number of connections that
+were running, at most), and after a run of successful requests as long as the limit, it
+grows by one again. A `Retry-After` header also stops new requests to the host until
+the given time.
+
+.. NOTE::
+    The workers of the `process` engine have their own governor in every process.
+'''
+
+import time
+import threading
+import urllib.parse
+
+from . import metrics
+
+ENABLED = True
+MAX_CONNECTIONS = 32  # per host
+OVERLOAD_CODES = (416, 429, 503)
+DECREASE_INTERVAL = 1  # the limit is halved at most once per interval, in seconds
+RETRY_DELAY = 5  # seconds before a refused request is retried, if there's no Retry-After
+MAX_RETRY_AFTER = 120
+
+def configure(enabled=None, max_connections=None):
+    '''
+    Changes the process-wide governor settings. Arguments left as None are not changed.
+
+    :param enabled: If false, the concurrency isn't limited. Default is True.
+    :type enabled: bool
+    :param max_connections: Maximum number of connections per host. Default is 32.
+    :type max_connections: int
+    '''
+    global ENABLED, MAX_CONNECTIONS
+    if enabled is not None:
+        ENABLED = enabled
+    if max_connections is not None:
+        MAX_CONNECTIONS = max_connections
+        with governor._lock:
+            for host in governor._hosts.values():
+                host.limit = min(host.limit, max_connections)
+
+class HostGovernor(object):
+    '''
+    The slots of a single host.
+    '''
+    def __init__(self, host, limit=None):
+        self.host = host
+        self.limit = limit or MAX_CONNECTIONS
+        self.in_flight = 0
+        self.successes = 0
+        self.blocked_until = 0
+        self._last_decrease = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, block=True, timeout=None):
+        '''
+        Takes a slot, waiting for one if needed. If `block` is false, the slot is taken even if the limit is reached.
+
+        :returns: False if `timeout` passed without a free slot.
+        :rtype: bool
+        '''
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while block:
+                now = time.monotonic()
+                wait = self.blocked_until - now if self.blocked_until > now else None
+                if wait is None and self.in_flight < self.limit:
+                    break
+                if deadline is not None:
+                    if now >= deadline:
+                        return False
+                    wait = min(wait, deadline - now) if wait else deadline - now
+                self._cond.wait(wait)
+            self.in_flight += 1
+            return True
+
+    def release(self):
+        with self._cond:
+            self.in_flight -= 1
+            self._cond.notify()
+
+    def on_success(self):
+        "A request was answered. After a run of successes, the limit grows by one."
+        with self._cond:
+            self.successes += 1
+            if self.successes >= self.limit and self.limit < MAX_CONNECTIONS:
+                self.limit += 1
+                self.successes = 0
+                self._cond.notify()
+
+    def on_overload(self, retry_after=None):
+        '''
+        The server refused a request because it's overloaded. Halves the limit, and stops
+        new requests for `retry_after` seconds, if given.
+        '''
+        now = time.monotonic()
+        with self._cond:
+            self.successes = 0
+            # many requests that were sent together fail together. only halve once for them.
+            if now - self._last_decrease >= DECREASE_INTERVAL:
+                self.limit = max(1, min(self.limit, self.in_flight) // 2)
+                self._last_decrease = now
+                metrics.incr('governor_decreases')
+            if retry_after:
+                self.blocked_until = max(self.blocked_until, now + retry_after)
+
+class Governor(object):
+    '''
+    The `HostGovernor` of every host.
+    '''
+    def __init__(self):
+        self._hosts = {}
+        self._lock = threading.Lock()
+
+    def get(self, url):
+        '''
+        Returns the `HostGovernor` of the host of `url`.
+
+        :rtype: `HostGovernor` instance
+        '''
+        host = urllib.parse.urlsplit(url).netloc.lower()
+        with self._lock:
+            h = self._hosts.get(host)
+            if h is None:
+                h = self._hosts[host] = HostGovernor(host)
+            return h
+
+    def get_limits(self):
+        '''
+        Returns the current connection limit of every host.
+
+        :rtype: dict
+        '''
+        with self._lock:
+            return dict((host, h.limit) for host, h in self._hosts.items())
+
+    def clear(self):
+        with self._lock:
+            self._hosts.clear()
+
+governor = Governor()
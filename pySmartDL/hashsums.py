@@ -0,0 +1,209 @@
+'''
+Lookup of UNIX checksum files (`SHA256SUMS`, `SHA1SUMS`, `MD5SUMS`) next to a file.
+
+The candidate files of a folder are fetched concurrently, parsed into a dict, and cached
+per url, so the files of one folder cost one request per sums file instead of one per
+file. Cached sums are used as is for `SUMS_TTL` seconds, and are then revalidated with
+their `ETag` (or `Last-Modified`) date.
+
+Usage::
+
+	from pySmartDL import hashsums
+
+	hashes = hashsums.find_hashes(urls)  # {url: (algorithm, hash) or None}
+'''
+
+import os
+import re
+import time
+import threading
+import urllib.error
+import urllib.parse
+from concurrent import futures
+
+from .transport import get_default_transport
+
+SUMS_FILENAMES = ('SHA256SUMS', 'SHA1SUMS', 'MD5SUMS')  # by preference
+SUMS_TTL = 300  # seconds before cached sums are revalidated
+
+_BSD_LINE = re.compile(r'^(\w+) \((.+)\) = ([0-9a-fA-F]+)$')
+
+def parse_sums(text):
+    '''
+    Parses a checksum file, in the GNU format (`<hash>  <filename>`, or `<hash> *<filename>`
+    in binary mode) or the BSD format (`SHA256 (<filename>) = <hash>`).
+
+    >>> parse_sums('e3b0c442...b855  empty.txt')
+    {'empty.txt': 'e3b0c442...b855'}
+
+    :param text: The content of the file.
+    :type text: string
+    :returns: A dict of filename and hash. Filenames are lowercase.
+    :rtype: dict
+    '''
+    sums = {}
+    for line in text.splitlines():
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        match = _BSD_LINE.match(line)
+        if match:
+            filename, hash_ = match.group(2), match.group(3)
+        else:
+            parts = line.split(None, 1)
+            if len(parts) != 2:
+                continue
+            hash_, filename = parts
+            if filename.startswith('*'):
+                filename = filename[1:]
+        if filename.startswith('./'):
+            filename = filename[2:]
+        sums[filename.lower()] = hash_.lower()
+    return sums
+
+class _Entry(object):
+    def __init__(self, sums, etag, last_modified):
+        self.sums = sums  # None if the file doesn't exist
+        self.etag = etag
+        self.last_modified = last_modified
+        self.checked = time.monotonic()
+
+class SumsCache(object):
+    '''
+    A thread-safe cache of parsed checksum files, by url. Concurrent lookups of the same
+    url share a single request.
+    '''
+    def __init__(self):
+        self._entries = {}
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self.requests = 0
+
+    def get(self, sums_url, transport=None, requestArgs=None, context=None, timeout=5):
+        '''
+        Returns the sums of `sums_url`, fetching or revalidating them if needed.
+
+        :returns: A dict of filename and hash, or None if the file doesn't exist.
+        :rtype: dict
+        '''
+        with self._lock:
+            entry = self._entries.get(sums_url)
+            if entry and time.monotonic() - entry.checked < SUMS_TTL:
+                return entry.sums
+            event = self._inflight.get(sums_url)
+            leader = event is None
+            if leader:
+                event = self._inflight[sums_url] = threading.Event()
+
+        if not leader:
+            event.wait()
+            with self._lock:
+                entry = self._entries.get(sums_url)
+            return entry.sums if entry else None
+
+        try:
+            entry = self._fetch(sums_url, entry, transport or get_default_transport(), requestArgs, context, timeout)
+        finally:
+            with self._lock:
+                if entry:
+                    self._entries[sums_url] = entry
+                del self._inflight[sums_url]
+                event.set()
+        return entry.sums
+
+    def _fetch(self, sums_url, entry, transport, requestArgs, context, timeout):
+        requestArgs = dict(requestArgs or {})
+        headers = requestArgs['headers'] = dict(requestArgs.get('headers') or {})
+        if entry and entry.sums is not None:
+            if entry.etag:
+                headers['If-None-Match'] = entry.etag
+            if entry.last_modified:
+                headers['If-Modified-Since'] = entry.last_modified
+
+        with self._lock:
+            self.requests += 1
+        try:
+            obj = transport.open(sums_url, requestArgs, context=context, timeout=timeout)
+        except urllib.error.HTTPError as e:
+            if e.code == 304 and entry:
+                entry.checked = time.monotonic()
+                return entry
+            if e.code in (404, 410):
+                return _Entry(None, None, None)
+            raise
+        try:
+            if obj.status == 304 and entry:
+                entry.checked = time.monotonic()
+                return entry
+            data = obj.read()
+        finally:
+            obj.close()
+        return _Entry(parse_sums(data.decode('utf-8', 'replace')), obj.headers.get('ETag'), obj.headers.get('Last-Modified'))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+cache = SumsCache()
+
+def _folder(url):
+    parsed = urllib.parse.urlsplit(url)
+    path = parsed.path.rsplit('/', 1)[0] + '/'
+    return urllib.parse.urlunsplit((parsed.scheme, parsed.netloc, path, '', ''))
+
+def _filename(url):
+    return urllib.parse.unquote(os.path.basename(urllib.parse.urlsplit(url).path)).lower()
+
+def get_folder_sums(folder, transport=None, requestArgs=None, context=None, timeout=5):
+    '''
+    Fetches the checksum files of a folder concurrently.
+
+    :param folder: The folder's url, ending with a `/`.
+    :type folder: string
+    :returns: A list of `(algorithm, sums)` tuples of the files that exist, by preference.
+    :rtype: list of tuples
+    '''
+    def get(filename):
+        try:
+            return cache.get(folder + filename, transport, requestArgs, context, timeout)
+        except (urllib.error.URLError, OSError):
+            return None
+
+    with futures.ThreadPoolExecutor(len(SUMS_FILENAMES)) as pool:
+        results = list(pool.map(get, SUMS_FILENAMES))
+    return [(filename[:-len('SUMS')].lower(), sums) for filename, sums in zip(SUMS_FILENAMES, results) if sums]
+
+def _find(url, folder_sums):
+    filename = _filename(url)
+    for algorithm, sums in folder_sums:
+        if filename in sums:
+            return algorithm, sums[filename]
+        # the sums file may list the files with a path
+        for name, hash_ in sums.items():
+            if name.rsplit('/', 1)[-1] == filename:
+                return algorithm, hash_
+    return None
+
+def find_hash(url, transport=None, requestArgs=None, context=None, timeout=5):
+    '''
+    Looks for the hash of `url` in the checksum files of its folder.
+
+    :returns: `(algorithm, hash)`, or None if no checksum file lists the file.
+    :rtype: tuple
+    '''
+    return _find(url, get_folder_sums(_folder(url), transport, requestArgs, context, timeout))
+
+def find_hashes(urls, transport=None, requestArgs=None, context=None, timeout=5, max_workers=4):
+    '''
+    Looks for the hashes of many urls. Each folder's checksum files are fetched once, and
+    the folders are looked up concurrently.
+
+    :param urls: Urls of files.
+    :type urls: list of strings
+    :returns: A dict of url and `(algorithm, hash)` (or None if no checksum file lists the file).
+    :rtype: dict
+    '''
+    folders = sorted(set([_folder(url) for url in urls]))
+    with futures.ThreadPoolExecutor(max_workers) as pool:
+        sums = dict(zip(folders, pool.map(lambda folder: get_folder_sums(folder, transport, requestArgs, context, timeout), folders)))
+    return dict((url, _find(url, sums[_folder(url)])) for url in urls)
@@ -0,0 +1,191 @@
+'''
+Hedged requests for straggling ranges, like BitTorrent's endgame mode. The socket
+timeout only applies to each socket operation, so a connection that trickles (or stalls
+just under the timeout) can keep the whole download waiting.
+
+A `StallWatchdog` watches the speed of every range. When a range makes no progress for
+`STALL_TIME` seconds, or its speed drops below `SLOW_RATIO` times the median speed of its
+siblings, a duplicate request is sent for its unfinished tail (on a mirror, if there's
+one). Whichever request finishes the range first wins, and the other is canceled.
+
+Both requests write the same bytes to the same positions of the part file, so the loser's
+writes are harmless. Every request counts its bytes in its own counter; the loser's
+counter is reduced to the bytes that the winner didn't download.
+'''
+
+import time
+import socket
+import threading
+import collections
+
+STALL_TIME = 10  # seconds without progress
+SLOW_RATIO = 0.1  # of the median speed of the siblings
+MIN_AGE = 2  # seconds before a range can be hedged
+MIN_HEDGE_SIZE = 256*1024  # smaller tails are not worth a new request
+SPEED_WINDOW = 3  # the speed of a range is measured over the last seconds
+
+class Attempt(object):
+    "A request that downloads a range, from `start` to the range's end."
+    def __init__(self, task, start, counter, url):
+        self.task = task
+        self.start = start
+        self.counter = counter
+        self.url = url
+        self.canceled = False
+        self.finished = False
+        self.response = None  # set by the download function once the request is open
+
+    def cancel(self):
+        # the download loop checks the flag after every read. a read that trickles may take long
+        # to fill the buffer, so the socket is shut down too, and the read returns right away.
+        self.canceled = True
+        sock = _find_socket(self.response)
+        if sock is not None:
+            try:
+                socket.socket.shutdown(sock, socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+def _find_socket(response):
+    "Returns the socket under a response object of the transports, or None (for example with HTTP/2)."
+    obj = response
+    for i in range(5):
+        if obj is None or isinstance(obj, socket.socket):
+            return obj
+        obj = getattr(obj, '_sock', None) or getattr(obj, 'raw', None) or getattr(obj, 'fp', None) or getattr(obj, '_fp', None)
+    return None
+
+class RangeTask(object):
+    '''
+    A range of the file, that may be downloaded by two racing requests.
+
+    :param start: First byte of the range.
+    :type start: int
+    :param end: Last byte of the range.
+    :type end: int
+    '''
+    def __init__(self, index, start, end):
+        self.index = index
+        self.start = start
+        self.end = end
+        self.attempts = []
+        self.winner = None
+        self.done = threading.Event()
+        self.started = time.monotonic()
+        self.finished = None
+        self._lock = threading.Lock()
+
+    @property
+    def hedged(self):
+        return len(self.attempts) > 1
+
+    def add_attempt(self, start, counter, url):
+        '''
+        Adds a request for the bytes `start` to the end of the range. Returns None if the range is already done.
+
+        :rtype: `Attempt` instance
+        '''
+        with self._lock:
+            if self.done.is_set():
+                return None
+            attempt = Attempt(self, start, counter, url)
+            self.attempts.append(attempt)
+            return attempt
+
+    def run(self, attempt, fn, *args, **kwargs):
+        '''
+        Runs `fn(*args, attempt=attempt, **kwargs)`, the download of `attempt`, and settles the race.
+        If the request fails while another request of the range is still running, waits for it instead of raising.
+        '''
+        error = None
+        if not attempt.canceled:
+            try:
+                fn(*args, attempt=attempt, **kwargs)
+            except Exception as e:
+                error = e
+
+        with self._lock:
+            attempt.finished = True
+            if error is None and not attempt.canceled and self.winner is None:
+                self.winner = attempt
+                for other in self.attempts:
+                    if other is not attempt:
+                        other.cancel()
+            if self.winner is not None or all([a.finished for a in self.attempts]):
+                if self.finished is None:
+                    self.finished = time.monotonic()
+                self.done.set()
+
+        if self.winner is attempt:
+            return
+        if error is not None:
+            self.done.wait()
+            if self.winner is None:
+                raise error
+        # lost the race. only the bytes before the winner's start count.
+        attempt.counter.value = max(0, self.winner.start - attempt.start)
+
+class StallWatchdog(object):
+    '''
+    Watches the ranges, and calls `hedge(task, start, reason)` for a range that stalls or straggles.
+
+    :param tasks: The ranges.
+    :type tasks: list of `RangeTask` instances
+    :param hedge: A function that sends the duplicate request for the bytes `start` to the end of `task`. `reason` is `stalled` or `slow`.
+    '''
+    def __init__(self, tasks, hedge, stall_time=None, slow_ratio=None):
+        self.tasks = tasks
+        self.hedge = hedge
+        self.stall_time = STALL_TIME if stall_time is None else stall_time
+        self.slow_ratio = SLOW_RATIO if slow_ratio is None else slow_ratio
+        self.hedges = 0
+        self._history = dict((t.index, collections.deque()) for t in tasks)  # (time, bytes) samples of every range
+        self._last_progress = {}
+
+    def _recent_speed(self, task):
+        history = self._history[task.index]
+        t0, v0 = history[0]
+        t1, v1 = history[-1]
+        return (v1 - v0) / (t1 - t0) if t1 > t0 else 0
+
+    def check(self, paused=False, now=None):
+        '''
+        Checks the ranges. Called periodically.
+
+        :param paused: If true, the download is paused, and the measurements start over.
+        :type paused: bool
+        '''
+        now = time.monotonic() if now is None else now
+        running = [t for t in self.tasks if not t.done.is_set()]
+        for task in running:
+            history = self._history[task.index]
+            done = task.attempts[0].counter.value
+            if paused:
+                history.clear()
+            if not history or done != history[-1][1]:
+                self._last_progress[task.index] = now
+            history.append((now, done))
+            while now - history[0][0] > SPEED_WINDOW:
+                history.popleft()
+        if paused:
+            return
+
+        speeds = dict((t.index, self._recent_speed(t)) for t in running)
+        for task in running:
+            history = self._history[task.index]
+            if task.hedged or now - task.started < MIN_AGE or now - history[0][0] < SPEED_WINDOW / 2:
+                continue
+            done = history[-1][1]
+            tail = task.end - task.start + 1 - done
+            if tail < MIN_HEDGE_SIZE:
+                continue
+            speed = speeds[task.index]
+            # the siblings are the other running ranges, and the ranges that are done
+            siblings = sorted([speeds[t.index] for t in running if t is not task] +
+                              [(t.end - t.start + 1) / max(t.finished - t.started, 1e-3) for t in self.tasks if t.winner and t.finished])
+            median = siblings[len(siblings)//2] if siblings else 0
+            stalled = now - self._last_progress[task.index] >= self.stall_time
+            straggling = median > 0 and speed < median * self.slow_ratio and tail / max(speed, 1) > self.stall_time
+            if stalled or straggling:
+                self.hedges += 1
+                self.hedge(task, task.start + done, 'stalled' if stalled else 'slow')
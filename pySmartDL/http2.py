@@ -0,0 +1,378 @@
+'''
+An HTTP/2 transport. All the requests to the same host are multiplexed as concurrent
+streams over a single connection, so a multi-threaded download opens one TCP+TLS
+connection instead of one per thread. Requires the `h2 <https://python-hyper.org/projects/h2/>`_ package.
+
+Usage::
+
+	from pySmartDL import SmartDL
+	from pySmartDL.http2 import H2Transport
+
+	obj = SmartDL(url, dest, transport=H2Transport())
+	obj.start()
+
+If the server does not negotiate HTTP/2, the request falls back to HTTP/1.1.
+'''
+
+import io
+import socket
+import threading
+import collections
+import http.client
+import urllib.error, urllib.parse
+
+try:
+    import h2.connection
+    import h2.config
+    import h2.events
+    import h2.errors
+    import h2.settings
+    import h2.exceptions
+except ImportError:
+    h2 = None
+
+from . import tls
+from . import resolver
+from .transport import Transport, HTTPClientTransport, REDIRECT_CODES, _http_error
+
+class H2Stream(object):
+    "Holds the state of a single HTTP/2 stream."
+    def __init__(self, stream_id):
+        self.stream_id = stream_id
+        self.headers = None
+        self.chunks = collections.deque()
+        self.ended = False
+        self.error = None
+
+class H2Connection(object):
+    '''
+    A single multiplexed HTTP/2 connection. A background thread reads the socket
+    and dispatches the frames to the streams.
+    '''
+    def __init__(self, sock, authority, scheme, window_size, max_frame_size):
+        self.sock = sock
+        self.authority = authority
+        self.scheme = scheme
+        self.streams = {}
+        self.closed = False
+        self.error = None
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+
+        self.conn = h2.connection.H2Connection(config=h2.config.H2Configuration(client_side=True, header_encoding='utf-8'))
+        self.conn.initiate_connection()
+        self.conn.update_settings({
+            h2.settings.SettingCodes.INITIAL_WINDOW_SIZE: window_size,
+            h2.settings.SettingCodes.MAX_FRAME_SIZE: max_frame_size,
+            h2.settings.SettingCodes.ENABLE_PUSH: 0,
+        })
+        # the connection-level window is not covered by SETTINGS, and starts at 64KB.
+        self.conn.increment_flow_control_window(window_size - 65535)
+        self._flush()
+
+        self._reader = threading.Thread(target=self._read_loop)
+        self._reader.daemon = True
+        self._reader.start()
+
+    def _flush(self):
+        data = self.conn.data_to_send()
+        if data:
+            self.sock.sendall(data)
+
+    def has_capacity(self):
+        with self._lock:
+            if self.closed:
+                return False
+            return self.conn.open_outbound_streams < self.conn.remote_settings.max_concurrent_streams
+
+    def request(self, method, path, headers):
+        h = [(':method', method), (':authority', self.authority), (':scheme', self.scheme), (':path', path)]
+        for k, v in headers.items():
+            if k.lower() in ('host', 'connection', 'keep-alive', 'proxy-connection', 'transfer-encoding', 'upgrade'):
+                continue
+            h.append((k.lower(), v.decode('latin-1') if isinstance(v, bytes) else str(v)))
+
+        with self._lock:
+            if self.closed:
+                raise urllib.error.URLError(self.error or 'HTTP/2 connection is closed')
+            stream_id = self.conn.get_next_available_stream_id()
+            stream = self.streams[stream_id] = H2Stream(stream_id)
+            self.conn.send_headers(stream_id, h, end_stream=True)
+            self._flush()
+        return stream
+
+    def wait_headers(self, stream, timeout):
+        with self._cond:
+            if not self._cond.wait_for(lambda: stream.headers is not None or stream.error or self.closed, timeout):
+                raise socket.timeout('timed out waiting for HTTP/2 response headers')
+            if stream.error:
+                raise stream.error
+            if stream.headers is None:
+                raise urllib.error.URLError(self.error or 'HTTP/2 connection is closed')
+            return stream.headers
+
+    def readinto(self, stream, b, timeout):
+        with self._cond:
+            if not self._cond.wait_for(lambda: stream.chunks or stream.ended or stream.error or self.closed, timeout):
+                raise socket.timeout('timed out reading HTTP/2 stream')
+            if stream.error:
+                raise stream.error
+            if not stream.chunks:
+                if stream.ended:
+                    return 0
+                raise urllib.error.URLError(self.error or 'HTTP/2 connection is closed')
+
+            chunk = stream.chunks[0]
+            n = min(len(b), len(chunk))
+            b[:n] = chunk[:n]
+            if n == len(chunk):
+                stream.chunks.popleft()
+            else:
+                stream.chunks[0] = chunk[n:]
+
+            # we only open the window again after the data is consumed, so slow readers get backpressure.
+            try:
+                self.conn.acknowledge_received_data(n, stream.stream_id)
+                self._flush()
+            except h2.exceptions.StreamClosedError:
+                pass
+            return n
+
+    def close_stream(self, stream):
+        with self._lock:
+            self.streams.pop(stream.stream_id, None)
+            if not stream.ended and not self.closed:
+                try:
+                    self.conn.reset_stream(stream.stream_id, h2.errors.ErrorCodes.CANCEL)
+                    self._flush()
+                except (h2.exceptions.StreamClosedError, OSError):
+                    pass
+
+    def _read_loop(self):
+        try:
+            while True:
+                data = self.sock.recv(65536)
+                if not data:
+                    raise ConnectionResetError('HTTP/2 connection closed by the server')
+                with self._cond:
+                    for event in self.conn.receive_data(data):
+                        self._handle_event(event)
+                    self._flush()
+                    self._cond.notify_all()
+        except Exception as e:
+            with self._cond:
+                self.closed = True
+                self.error = self.error or e
+                self._cond.notify_all()
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+
+    def _handle_event(self, event):
+        stream = self.streams.get(getattr(event, 'stream_id', None))
+        if isinstance(event, h2.events.ResponseReceived) and stream:
+            stream.headers = event.headers
+        elif isinstance(event, h2.events.DataReceived):
+            if stream:
+                stream.chunks.append(event.data)
+                # padding is not data we'll ever consume, so return it right away.
+                padding = event.flow_controlled_length - len(event.data)
+                if padding:
+                    self.conn.acknowledge_received_data(padding, event.stream_id)
+            else:
+                try:
+                    self.conn.acknowledge_received_data(event.flow_controlled_length, event.stream_id)
+                except h2.exceptions.StreamClosedError:
+                    pass
+        elif isinstance(event, h2.events.StreamEnded) and stream:
+            stream.ended = True
+        elif isinstance(event, h2.events.StreamReset) and stream:
+            stream.error = urllib.error.URLError('HTTP/2 stream was reset (error code {})'.format(event.error_code))
+        elif isinstance(event, h2.events.ConnectionTerminated):
+            self.closed = True
+            self.error = 'HTTP/2 connection terminated (error code {})'.format(event.error_code)
+            for stream in self.streams.values():
+                if stream.stream_id > event.last_stream_id and not stream.ended:
+                    stream.error = urllib.error.URLError(self.error)
+
+    def close(self):
+        with self._lock:
+            if not self.closed:
+                self.closed = True
+                try:
+                    self.conn.close_connection()
+                    self._flush()
+                except OSError:
+                    pass
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+class H2Response(io.RawIOBase):
+    "A response that reads from an HTTP/2 stream."
+    def __init__(self, url, status, headers, connection, stream, timeout):
+        self.url = url
+        self.status = self.code = status
+        self.headers = headers
+        self._connection = connection
+        self._stream = stream
+        self._timeout = timeout
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        return self._connection.readinto(self._stream, memoryview(b).cast('B'), self._timeout)
+
+    def info(self):
+        return self.headers
+
+    def geturl(self):
+        return self.url
+
+    def getcode(self):
+        return self.status
+
+    def close(self):
+        if not self.closed:
+            self._connection.close_stream(self._stream)
+        super().close()
+
+class H2Transport(Transport):
+    '''
+    A transport that multiplexes the requests to each host over one HTTP/2 connection.
+
+    :param window_size: Flow-control window, per stream and per connection, in bytes.
+                        Should be at least the bandwidth-delay product of the link. Default is 16MB.
+    :type window_size: int
+    :param max_frame_size: Largest DATA frame we accept, in bytes. Default is 1MB.
+    :type max_frame_size: int
+    :param allow_h2c: If true, plain `http://` urls use HTTP/2 with prior knowledge (h2c). Default is False.
+    :type allow_h2c: bool
+    :param max_redirects: Maximum number of redirects to follow. Default is 10.
+    :type max_redirects: int
+    '''
+    def __init__(self, window_size=16*1024**2, max_frame_size=1024**2, allow_h2c=False, max_redirects=10):
+        if not h2:
+            raise ImportError("H2Transport requires the h2 package.")
+        self.window_size = min(window_size, 2**31-1)
+        self.max_frame_size = max(16384, min(max_frame_size, 2**24-1))
+        self.allow_h2c = allow_h2c
+        self.max_redirects = max_redirects
+        self.fallback = HTTPClientTransport(max_redirects=max_redirects)
+        self._connections = {}
+        self._http1_hosts = set()
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def _connect(self, scheme, host, port, context, timeout):
+        sock = resolver.create_connection((host, port), timeout=timeout)
+        if scheme == 'https':
+            context = tls.with_alpn(context, ('h2', 'http/1.1'))
+            sock = tls.wrap_socket(context, sock, host, port)
+            if sock.selected_alpn_protocol() != 'h2':
+                sock.close()
+                return None
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.settimeout(None)  # the reader thread blocks on the socket; timeouts are applied per stream.
+        authority = host if port in (80, 443) else '{}:{}'.format(host, port)
+        return H2Connection(sock, authority, scheme, self.window_size, self.max_frame_size)
+
+    def _open_stream(self, key, context, timeout, method, path, headers):
+        # Picking a connection and opening the stream is done under one lock, so
+        # concurrent requests won't exceed the server's max_concurrent_streams.
+        # Connecting is done outside of it, so a slow handshake doesn't block the other hosts;
+        # concurrent requests to the same host wait for the pending connection instead of racing it.
+        while True:
+            with self._lock:
+                if key in self._http1_hosts:
+                    return None, None
+                conns = self._connections.setdefault(key, [])
+                conns[:] = [c for c in conns if not c.closed]
+                for conn in conns:
+                    if conn.has_capacity():
+                        return conn, conn.request(method, path, headers)
+                pending = self._pending.get(key)
+                if pending is None:
+                    pending = self._pending[key] = threading.Event()
+                    break
+            pending.wait(timeout)
+
+        conn = None
+        connected = False
+        try:
+            scheme, host, port = key[:3]
+            conn = self._connect(scheme, host, port, context, timeout)
+            connected = True
+        finally:
+            with self._lock:
+                del self._pending[key]
+                if conn:
+                    self._connections.setdefault(key, []).append(conn)
+                elif connected:
+                    self._http1_hosts.add(key)
+            pending.set()
+        if conn is None:
+            return None, None
+        with self._lock:
+            if conn.has_capacity():
+                return conn, conn.request(method, path, headers)
+        # the waiting requests filled up the new connection first
+        return self._open_stream(key, context, timeout, method, path, headers)
+
+    def open(self, url, requestArgs=None, context=None, timeout=None, startByte=0, endByte=None):
+        requestArgs = requestArgs or {}
+        if requestArgs.get('data') is not None:
+            return self.fallback.open(url, requestArgs, context, timeout, startByte, endByte)
+        headers = self._headers(requestArgs, startByte, endByte)
+        method = requestArgs.get('method') or 'GET'
+
+        for i in range(self.max_redirects+1):
+            parsed = urllib.parse.urlsplit(url)
+            scheme = parsed.scheme.lower()
+            if (scheme == 'http' and not self.allow_h2c) or scheme not in ('http', 'https'):
+                return self.fallback.open(url, requestArgs, context, timeout, startByte, endByte)
+            port = parsed.port or (443 if scheme == 'https' else 80)
+            key = (scheme, parsed.hostname, port, id(context))
+            path = parsed.path or '/'
+            if parsed.query:
+                path += '?' + parsed.query
+
+            try:
+                conn, stream = self._open_stream(key, context, timeout, method, path, headers)
+            except socket.timeout:
+                raise
+            except OSError as e:
+                raise urllib.error.URLError(e)
+            if conn is None:
+                return self.fallback.open(url, requestArgs, context, timeout, startByte, endByte)
+
+            resp_headers = http.client.HTTPMessage()
+            status = None
+            for k, v in conn.wait_headers(stream, timeout):
+                if k == ':status':
+                    status = int(v)
+                elif not k.startswith(':'):
+                    resp_headers[k] = v
+
+            response = H2Response(url, status, resp_headers, conn, stream, timeout)
+            if status in REDIRECT_CODES and resp_headers.get('Location'):
+                response.close()
+                url = urllib.parse.urljoin(url, resp_headers['Location'])
+                continue
+            if status >= 400:
+                raise _http_error(url, status, http.client.responses.get(status, ''), resp_headers, response)
+            return response
+
+        raise _http_error(url, status, 'Too many redirects', resp_headers)
+
+    def close(self):
+        with self._lock:
+            connections, self._connections = self._connections, {}
+        for conns in connections.values():
+            for conn in conns:
+                conn.close()
+        self.fallback.close()
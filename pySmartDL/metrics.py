@@ -0,0 +1,102 @@
+'''
+Lightweight metrics. Low level code (such as the connection code in `pySmartDL.resolver`)
+doesn't know which download it's working for, so every download binds its `Metrics`
+object to the current thread with `bind()`, and the low level code reports to whatever
+is bound with `incr()` and `add_timing()`.
+'''
+
+import threading
+import contextlib
+import collections
+
+MAX_SAMPLES = 1000  # recent samples kept per timing
+
+_local = threading.local()
+
+class Timing(object):
+    '''
+    The aggregates of a timing, and its last `MAX_SAMPLES` samples. Its memory doesn't
+    grow with the number of samples, so a `Metrics` object can be shared by a long-lived process.
+    '''
+    __slots__ = ('count', 'total', 'min', 'max', 'samples')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+        self.samples = collections.deque(maxlen=MAX_SAMPLES)
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.min = seconds if self.min is None else min(self.min, seconds)
+        self.max = seconds if self.max is None else max(self.max, seconds)
+        self.samples.append(seconds)
+
+class Metrics(object):
+    '''
+    A thread-safe collection of counters and timings. Every timing is a `Timing`.
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.timings = {}
+
+    def incr(self, name, n=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def add_timing(self, name, seconds):
+        with self._lock:
+            timing = self.timings.get(name)
+            if timing is None:
+                timing = self.timings[name] = Timing()
+            timing.add(seconds)
+
+    def snapshot(self):
+        '''
+        Returns a copy of the metrics. Counters are returned as is. Every timing is
+        returned as a dict with the keys `count`, `total`, `min`, `max` and `avg` (in seconds).
+
+        :rtype: dict
+        '''
+        with self._lock:
+            d = dict(self.counters)
+            for name, timing in self.timings.items():
+                d[name] = {
+                    'count': timing.count,
+                    'total': timing.total,
+                    'min': timing.min,
+                    'max': timing.max,
+                    'avg': timing.total / timing.count,
+                }
+        return d
+
+@contextlib.contextmanager
+def bind(metrics):
+    '''
+    Binds a `Metrics` object to the current thread for the duration of the `with` block.
+    '''
+    prev = getattr(_local, 'metrics', None)
+    _local.metrics = metrics
+    try:
+        yield metrics
+    finally:
+        _local.metrics = prev
+
+def current():
+    '''
+    Returns the `Metrics` object bound to the current thread, or None.
+    '''
+    return getattr(_local, 'metrics', None)
+
+def incr(name, n=1):
+    m = current()
+    if m:
+        m.incr(name, n)
+
+def add_timing(name, seconds):
+    m = current()
+    if m:
+        m.add_timing(name, seconds)
@@ -0,0 +1,111 @@
+'''
+Mirror probing. All the mirrors are probed concurrently with a small ranged request,
+and ranked by their time to first byte and short-burst throughput.
+'''
+
+import time
+import socket
+import collections
+import urllib.error
+from concurrent import futures
+
+from . import utils
+from .metrics import bind as bind_metrics
+from .transport import get_default_transport
+
+def probe_mirror(url, requestArgs=None, context=None, timeout=5, transport=None, probe_size=64*1024):
+    '''
+    Probes a single mirror with a ranged request.
+
+    :param url: Url address.
+    :type url: string
+    :param probe_size: Number of bytes to fetch. Default is 64KB.
+    :type probe_size: int
+    :returns: A dict with the keys `url`, `ttfb` (seconds), `throughput` (bytes per second), `filesize` (0 if unknown), `range_supported` and `error` (None if the mirror is alive).
+    :rtype: dict
+    '''
+    transport = transport or get_default_transport()
+    result = {'url': url, 'ttfb': None, 'throughput': None, 'filesize': 0, 'range_supported': False, 'error': None}
+    try:
+        t1 = time.time()
+        urlObj = transport.open(url, requestArgs, context=context, timeout=timeout, startByte=0, endByte=probe_size-1)
+        t2 = time.time()
+        try:
+            received = 0
+            buff = bytearray(min(probe_size, 65536))
+            while received < probe_size:
+                n = urlObj.readinto(buff)
+                if not n:
+                    break
+                received += n
+        finally:
+            urlObj.close()
+        t3 = time.time()
+    except (urllib.error.HTTPError, urllib.error.URLError, socket.timeout, OSError) as e:
+        result['error'] = e
+        return result
+
+    result['ttfb'] = t2-t1
+    result['throughput'] = received / max(t3-t2, 1e-6)
+    content_range = utils.parse_content_range(urlObj.headers.get('Content-Range'))
+    if urlObj.status == 206 and content_range:
+        result['range_supported'] = True
+        result['filesize'] = content_range[2] or 0
+    else:
+        try:
+            result['filesize'] = int(urlObj.headers["Content-Length"])
+        except (KeyError, TypeError, ValueError):
+            pass
+    return result
+
+def rank_mirrors(urls, requestArgs=None, context=None, timeout=5, transport=None, probe_size=64*1024, metrics=None, grace=0.5):
+    '''
+    Probes all the mirrors concurrently, and ranks them. Dead mirrors, and mirrors that
+    report a different filesize than the majority, are dropped.
+
+    :param urls: Mirror urls.
+    :type urls: list of strings
+    :param metrics: If given, the connection metrics of the probes are reported to it.
+    :type metrics: `pySmartDL.metrics.Metrics` instance
+    :param grace: Once a mirror answered, the other probes are waited for this long, in seconds. The mirrors that haven't answered by then are ranked last, unprobed (their `ttfb` is None). Default is 0.5.
+    :type grace: float
+    :returns: `(ranking, dropped)`. `ranking` is a list of `probe_mirror` results, best first. `dropped` is a list of the dropped results.
+    :rtype: tuple
+    '''
+    def probe(url):
+        with bind_metrics(metrics):
+            return probe_mirror(url, requestArgs, context, timeout, transport, probe_size)
+
+    pool = futures.ThreadPoolExecutor(len(urls))
+    try:
+        fs = [pool.submit(probe, url) for url in urls]
+        # a hung mirror shouldn't hold up the download until the timeout, once another one answered.
+        for f in futures.as_completed(fs):
+            if not f.result()['error']:
+                break
+        futures.wait(fs, timeout=grace)
+    finally:
+        pool.shutdown(wait=False)
+    results = [f.result() for f in fs if f.done()]
+    slow = [{'url': url, 'ttfb': None, 'throughput': None, 'filesize': 0, 'range_supported': False, 'error': None} for url, f in zip(urls, fs) if not f.done()]
+
+    alive = [r for r in results if not r['error']]
+    dropped = [r for r in results if r['error']]
+
+    sizes = collections.Counter([r['filesize'] for r in alive if r['filesize']])
+    if sizes:
+        filesize = sizes.most_common(1)[0][0]
+        for r in list(alive):
+            if r['filesize'] and r['filesize'] != filesize:
+                r['error'] = ValueError("Mirror reports a filesize of {}, while most mirrors report {}.".format(r['filesize'], filesize))
+                alive.remove(r)
+                dropped.append(r)
+    else:
+        filesize = 0
+
+    def estimated_time(r):
+        # time to the first byte, plus the time to transfer the whole file (or the probe, if the size is unknown).
+        return r['ttfb'] + (filesize or probe_size) / (r['throughput'] or 1)
+
+    alive.sort(key=estimated_time)
+    return alive+slow, dropped
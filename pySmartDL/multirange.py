@@ -0,0 +1,293 @@
+'''
+Fetching many small byte ranges of a file in few round trips, for sparse access (repairing
+chunks, delta sync, reading footers...). The ranges are batched into multi-range requests
+(`Range: bytes=0-99,4096-4199,...`), and the `multipart/byteranges` response is parsed
+as it streams, so the data goes straight to its offset.
+
+Servers that don't support multi-range requests answer with the whole file, or with a
+single range. The fetcher then falls back to one request per range, over `threads`
+connections. With a transport that keeps connections alive (like
+`pySmartDL.transport.HTTPClientTransport`), those requests reuse the connections.
+
+Usage::
+
+	from pySmartDL.multirange import MultiRangeFetcher
+
+	fetcher = MultiRangeFetcher(url)
+	head, footer = fetcher.fetch([(0, 100), (size-1024, size)])
+	fetcher.download([(0, 100), (size-1024, size)], dest)  # writes the ranges into dest, at their offsets
+'''
+
+import io
+import os
+import re
+import bisect
+import threading
+import urllib.error
+from concurrent import futures
+
+from . import utils
+from .transport import get_default_transport
+
+MAX_RANGES = 32  # per request. servers limit the number of ranges (nginx's max_ranges) and the size of the headers.
+
+_BOUNDARY = re.compile(r'boundary\s*=\s*"?([^";]+)"?', re.I)
+
+def merge_ranges(ranges, gap=0):
+    '''
+    Sorts the ranges, and merges those that overlap, or that are at most `gap` bytes apart.
+
+    >>> merge_ranges([(10, 20), (0, 5), (15, 30)])
+    [(0, 5), (10, 30)]
+
+    :param ranges: `(start, end)` tuples, `end` excluded.
+    :type ranges: list of tuples
+    :rtype: list of tuples
+    '''
+    merged = []
+    for start, end in sorted([r for r in ranges if r[1] > r[0]]):
+        if merged and start <= merged[-1][1] + gap:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+def _missing(span, pieces):
+    "Returns the parts of `span` that `pieces` don't cover."
+    missing = []
+    pos = span[0]
+    for start, end in merge_ranges(pieces):
+        if start > pos:
+            missing.append((pos, min(start, span[1])))
+        pos = max(pos, end)
+        if pos >= span[1]:
+            break
+    if pos < span[1]:
+        missing.append((pos, span[1]))
+    return missing
+
+def parse_multipart_byteranges(fp, boundary, write, block_size=64*1024):
+    '''
+    Parses a `multipart/byteranges` body as it's read, and calls `write(offset, data)` for
+    every block of every part.
+
+    :param fp: The body. Must have `readline()` and `readinto()`.
+    :param boundary: The boundary, from the `Content-Type` header.
+    :type boundary: bytes
+    :returns: The `(start, end)` range of every part, `end` excluded.
+    :rtype: list of tuples
+    '''
+    delimiter = b'--' + boundary
+    parts = []
+    buff = bytearray(block_size)
+    view = memoryview(buff)
+    while True:
+        line = fp.readline()
+        if not line:
+            raise urllib.error.URLError('The multipart/byteranges response ended without its closing boundary.')
+        line = line.rstrip(b'\r\n')
+        if line == delimiter + b'--':
+            return parts
+        if line != delimiter:
+            continue  # the preamble, or the line break after a part
+
+        content_range = None
+        while True:
+            line = fp.readline().rstrip(b'\r\n')
+            if not line:
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            if name.strip().lower() == 'content-range':
+                content_range = utils.parse_content_range(value.strip())
+        if not content_range or content_range[0] is None:
+            raise urllib.error.URLError('A part of the multipart/byteranges response has no valid Content-Range.')
+
+        start, remaining = content_range[0], content_range[1] - content_range[0] + 1
+        pos = start
+        while remaining:
+            n = fp.readinto(view[:min(remaining, block_size)])
+            if not n:
+                raise urllib.error.URLError('The multipart/byteranges response ended in the middle of a part.')
+            write(pos, bytes(view[:n]))
+            pos += n
+            remaining -= n
+        parts.append((start, pos))
+
+class MultiRangeFetcher(object):
+    '''
+    Fetches many byte ranges of a url, with as few requests as possible.
+
+    :param url: Url address.
+    :type url: string
+    :param max_ranges: Maximum number of ranges per request. Default is 32.
+    :type max_ranges: int
+    :param gap: Ranges that are at most `gap` bytes apart are fetched as one range. Default is 0.
+    :type gap: int
+    :param threads: Number of connections of the fallback, one request per range. Default is 4.
+    :type threads: int
+    :param shared_var: If given, its `value` counts the fetched bytes.
+    '''
+    def __init__(self, url, transport=None, requestArgs=None, context=None, timeout=5, max_ranges=None, gap=0, threads=4, shared_var=None):
+        self.url = url
+        self.transport = transport or get_default_transport()
+        self.requestArgs = requestArgs
+        self.context = context
+        self.timeout = timeout
+        self.max_ranges = max_ranges or MAX_RANGES
+        self.gap = gap
+        self.threads = threads
+        self.shared_var = shared_var
+        self.multirange_supported = None  # unknown until a multi-range request is answered
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    def fetch(self, ranges):
+        '''
+        Returns the bytes of every range.
+
+        :param ranges: `(start, end)` tuples, `end` excluded.
+        :type ranges: list of tuples
+        :returns: The data of every range, in the order of `ranges`.
+        :rtype: list of bytes
+        '''
+        spans = merge_ranges(ranges, self.gap)
+        buffers = [bytearray(end-start) for start, end in spans]
+        starts = [span[0] for span in spans]
+
+        def write(offset, data):
+            # a server may coalesce close ranges into one part, so a block can span many buffers, and the gaps.
+            end = offset + len(data)
+            i = max(bisect.bisect_right(starts, offset) - 1, 0)
+            while i < len(spans) and spans[i][0] < end:
+                lo, hi = max(offset, spans[i][0]), min(end, spans[i][1])
+                if lo < hi:
+                    buffers[i][lo-spans[i][0]:hi-spans[i][0]] = data[lo-offset:hi-offset]
+                i += 1
+
+        self.fetch_into(ranges, write)
+        results = []
+        for start, end in ranges:
+            if end <= start:
+                results.append(b'')
+                continue
+            i = bisect.bisect_right(starts, start) - 1
+            results.append(bytes(buffers[i][start-spans[i][0]:end-spans[i][0]]))
+        return results
+
+    def download(self, ranges, dest):
+        '''
+        Writes the ranges into `dest`, at their offsets. `dest` is created if it doesn't exist;
+        the rest of an existing file is left as it is.
+
+        :param ranges: `(start, end)` tuples, `end` excluded.
+        :type ranges: list of tuples
+        :param dest: Destination path.
+        :type dest: string
+        '''
+        lock = threading.Lock()
+        with open(dest, 'r+b' if os.path.exists(dest) else 'w+b') as f:
+            def write(offset, data):
+                with lock:
+                    f.seek(offset)
+                    f.write(data)
+            self.fetch_into(ranges, write)
+
+    def fetch_into(self, ranges, write):
+        '''
+        Fetches the ranges, and calls `write(offset, data)` for every block, as it streams.
+        `write()` may be called from many threads.
+
+        :param ranges: `(start, end)` tuples, `end` excluded.
+        :type ranges: list of tuples
+        '''
+        spans = merge_ranges(ranges, self.gap)
+        missing = []
+        if self.multirange_supported is not False:
+            for i in range(0, len(spans), self.max_ranges):
+                batch = spans[i:i+self.max_ranges]
+                if len(batch) == 1 or self.multirange_supported is False:
+                    missing.extend(batch)
+                    continue
+                received = self._fetch_batch(batch, write)
+                for span in batch:
+                    missing.extend(_missing(span, [r for r in received if r[0] < span[1] and r[1] > span[0]]))
+        else:
+            missing = spans
+
+        if len(missing) == 1:
+            self._fetch_range(missing[0], write)
+        elif missing:
+            with futures.ThreadPoolExecutor(min(self.threads, len(missing))) as pool:
+                for future in [pool.submit(self._fetch_range, span, write) for span in missing]:
+                    future.result()
+
+    def _open(self, requestArgs, startByte=0, endByte=None):
+        with self._lock:
+            self.requests += 1
+        return self.transport.open(self.url, requestArgs, context=self.context, timeout=self.timeout, startByte=startByte, endByte=endByte)
+
+    def _read(self, urlObj, start, end, write):
+        "Streams the body of a single range response, from `start`, up to `end`. Returns the position it reached."
+        buff = bytearray(64*1024)
+        view = memoryview(buff)
+        pos = start
+        while pos < end:
+            n = urlObj.readinto(view[:min(len(buff), end-pos)])
+            if not n:
+                break
+            write(pos, bytes(view[:n]))
+            if self.shared_var:
+                self.shared_var.value += n
+            pos += n
+        return pos
+
+    def _fetch_batch(self, batch, write):
+        "Fetches a multi-range request. Returns the ranges that were received."
+        requestArgs = dict(self.requestArgs or {})
+        requestArgs['headers'] = dict(requestArgs.get('headers') or {})
+        requestArgs['headers']['Range'] = 'bytes=' + ','.join(['{}-{}'.format(start, end-1) for start, end in batch])
+        urlObj = self._open(requestArgs)
+        try:
+            content_type = urlObj.headers.get('Content-Type') or ''
+            if urlObj.status == 206 and content_type.lower().startswith('multipart/byteranges'):
+                boundary = _BOUNDARY.search(content_type)
+                if not boundary:
+                    raise urllib.error.URLError('The multipart/byteranges response has no boundary.')
+                self.multirange_supported = True
+                if self.shared_var:
+                    write = _counting(write, self.shared_var)
+                # the parser reads lines. the responses of the non-urllib transports are raw, and need a buffer.
+                fp = urlObj if isinstance(urlObj, io.BufferedIOBase) else io.BufferedReader(urlObj)
+                return parse_multipart_byteranges(fp, boundary.group(1).encode('latin-1'), write)
+
+            content_range = utils.parse_content_range(urlObj.headers.get('Content-Range'))
+            if urlObj.status == 206 and content_range and content_range[0] is not None:
+                # a single range. the server either coalesced the ranges, or only serves the first one.
+                start, end = content_range[0], content_range[1]+1
+                if not (start <= batch[0][0] and end >= batch[-1][1]):
+                    self.multirange_supported = False
+                return [(start, self._read(urlObj, start, end, write))]
+            # the whole file: the server doesn't do range requests at all, or not multi-range ones.
+            self.multirange_supported = False
+            return []
+        finally:
+            urlObj.close()
+
+    def _fetch_range(self, span, write):
+        start, end = span
+        urlObj = self._open(self.requestArgs, start, end-1)
+        try:
+            content_range = utils.parse_content_range(urlObj.headers.get('Content-Range'))
+            if urlObj.status != 206 or not content_range or content_range[0] != start:
+                raise urllib.error.URLError('"{}" does not support range requests.'.format(self.url))
+            pos = self._read(urlObj, start, end, write)
+        finally:
+            urlObj.close()
+        if pos != end:
+            raise urllib.error.URLError("Expected {} bytes for range {}-{}, got {}.".format(end-start, start, end-1, pos-start))
+
+def _counting(write, shared_var):
+    def counting_write(offset, data):
+        write(offset, data)
+        shared_var.value += len(data)
+    return counting_write
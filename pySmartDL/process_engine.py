@@ -0,0 +1,110 @@
+'''
+The process engine runs the range workers in separate processes, so TLS reads and
+the read loop aren't bound by a single interpreter's GIL. All the workers write into
+one preallocated file, each at its own offset, and report their progress through
+shared memory.
+'''
+
+import multiprocessing
+import collections.abc
+from ctypes import c_longlong, c_double
+
+from . import tls
+from . import utils
+from .download import download
+
+SHARED_CMDS_KEYS = ('stop', 'pause', 'limit')
+_counters = None
+_cmds = None
+
+class SharedCounters(object):
+    '''
+    Per-range byte counters in shared memory. `value` is the total, like the
+    `ctypes` counter used by the thread engine.
+
+    :param size: Number of counters.
+    :type size: int
+    '''
+    def __init__(self, size):
+        self.array = multiprocessing.Array(c_longlong, size, lock=False)
+
+    @property
+    def value(self):
+        return sum(self.array)
+
+    @value.setter
+    def value(self, value):
+        for i in range(len(self.array)):
+            self.array[i] = 0
+        self.array[0] = value
+
+class SlotCounter(object):
+    "A view of a single counter of `SharedCounters`. Each worker only writes to its own slot, so no locking is needed."
+    def __init__(self, array, index):
+        self.array = array
+        self.index = index
+
+    @property
+    def value(self):
+        return self.array[self.index]
+
+    @value.setter
+    def value(self, value):
+        self.array[self.index] = value
+
+class SharedCmds(collections.abc.MutableMapping):
+    '''
+    A dict of the commands sent to the workers (`stop`, `pause` and `limit`), kept in shared memory.
+    '''
+    def __init__(self):
+        self.array = multiprocessing.Array(c_double, [float('nan')]*len(SHARED_CMDS_KEYS), lock=False)
+
+    def _index(self, key):
+        try:
+            return SHARED_CMDS_KEYS.index(key)
+        except ValueError:
+            raise KeyError(key)
+
+    def __getitem__(self, key):
+        value = self.array[self._index(key)]
+        if value != value:  # nan means the key is not set
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.array[self._index(key)] = value if isinstance(value, (int, float)) else 0
+
+    def __delitem__(self, key):
+        self[key]
+        self.array[self._index(key)] = float('nan')
+
+    def __iter__(self):
+        return iter([key for key in SHARED_CMDS_KEYS if key in self])
+
+    def __contains__(self, key):
+        try:
+            self[key]
+            return True
+        except KeyError:
+            return False
+
+    def __len__(self):
+        return len(list(iter(self)))
+
+def _init_worker(counters, cmds):
+    global _counters, _cmds
+    _counters = counters
+    _cmds = cmds
+
+def process_download(index, url, dest, requestArgs, verify, startByte, endByte, timeout, logger, transport, decompress=False, fallback_url=None):
+    "Runs `download()` in a worker process. `dest` must be preallocated; the range is written at `startByte`."
+    download(url, dest, requestArgs, tls.get_ssl_context(verify), startByte, endByte, timeout, SlotCounter(_counters, index), _cmds, logger,
+             transport=transport, decompress=decompress, offset=startByte, fallback_url=fallback_url)
+
+def create_pool(max_workers, counters, cmds):
+    '''
+    Creates a `ManagedProcessPoolExecutor` whose workers share `counters` and `cmds`.
+
+    :rtype: `pySmartDL.utils.ManagedProcessPoolExecutor` instance
+    '''
+    return utils.ManagedProcessPoolExecutor(max_workers, initializer=_init_worker, initargs=(counters.array, cmds))
@@ -0,0 +1,114 @@
+'''
+Progress reporting. The range workers push their progress to the callbacks registered
+with `SmartDL.on_progress()`, and every callback is throttled on its own. The built-in
+progress bars are such callbacks.
+'''
+
+import sys
+import time
+import threading
+import collections
+
+from . import utils
+
+class ProgressCallback(object):
+    '''
+    Wraps a progress callback, so it's called at most every `min_interval` seconds,
+    and only if at least `min_delta` bytes were downloaded since the last call.
+    '''
+    def __init__(self, fn, min_interval=0.1, min_delta=0):
+        self.fn = fn
+        self.min_interval = min_interval
+        self.min_delta = min_delta
+        self.last_time = 0
+        self.last_value = 0
+
+    def __call__(self, obj, now, value, force=False):
+        if not force:
+            if now - self.last_time < self.min_interval or abs(value - self.last_value) < self.min_delta:
+                return
+        self.last_time = now
+        self.last_value = value
+        self.fn(obj)
+
+class ProgressBar(object):
+    '''
+    A one-line progress bar. Nothing but the final line is printed if the stream is not a terminal.
+
+    :param stream: Output stream. Default is `sys.stdout`.
+    :param min_interval: Minimum time between two renders, in seconds. Default is 0.1.
+    :type min_interval: float
+    '''
+    def __init__(self, stream=None, min_interval=0.1):
+        self.stream = stream or sys.stdout
+        self.min_interval = min_interval
+        isatty = getattr(self.stream, 'isatty', None)
+        self.enabled = bool(isatty and isatty())
+
+    def on_progress(self, obj):
+        if self.enabled:
+            self.render(obj)
+
+    def on_state_change(self, obj, old, new):
+        if new == 'finished' and old != 'ready' and obj.control_thread and not obj._killed:
+            self.render(obj, final=True)
+
+    def format(self, obj, final=False):
+        dl_size = obj.shared_var.value
+        speed = obj.control_thread.get_speed() if obj.control_thread else 0
+        if final:
+            if obj.filesize:
+                s = "[*] %s / %s @ %s/s %s [100%%, 0s left]" % (utils.sizeof_human(obj.filesize), utils.sizeof_human(obj.filesize), utils.sizeof_human(speed), utils.progress_bar(1.0))
+            else:
+                s = "[*] %s / %s @ %s/s" % (utils.sizeof_human(dl_size), utils.sizeof_human(dl_size), utils.sizeof_human(speed))
+        elif obj.filesize:
+            eta = obj.control_thread.get_eta() if obj.control_thread else 0
+            progress = min(1.0*dl_size/obj.filesize, 1.0)
+            s = "[*] %s / %s @ %s/s %s [%3.1f%%, %s left]" % (utils.sizeof_human(dl_size), utils.sizeof_human(obj.filesize), utils.sizeof_human(speed), utils.progress_bar(progress), progress*100.0, utils.time_human(eta, fmt_short=True))
+        else:
+            s = "[*] %s / ??? MB @ %s/s" % (utils.sizeof_human(dl_size), utils.sizeof_human(speed))
+        if obj.content_encoding:
+            s += " (%s decoded)" % utils.sizeof_human(obj.decoded_var.value)
+        return s
+
+    def render(self, obj, final=False):
+        line = self.format(obj, final)
+        if self.enabled:
+            # \x1b[K clears what's left of a longer previous line.
+            self.stream.write("\r" + line + "\x1b[K" + ("\n" if final else ""))
+        else:
+            self.stream.write(line + "\n")
+        self.stream.flush()
+
+class MultiProgressBar(ProgressBar):
+    '''
+    A progress bar that can be shared by many downloads, one line per running download.
+    The final line of a finished download is printed once, above the others.
+    Pass the same instance as the `progress_bar` argument of every `SmartDL`.
+    '''
+    def __init__(self, stream=None, min_interval=0.1):
+        super().__init__(stream, min_interval)
+        self._lines = collections.OrderedDict()
+        self._drawn = 0
+        self._lock = threading.Lock()
+
+    def render(self, obj, final=False):
+        with self._lock:
+            line = self.format(obj, final)
+            if final:
+                self._lines.pop(id(obj), None)
+            else:
+                self._lines[id(obj)] = line
+            if not self.enabled:
+                if final:
+                    self.stream.write(line + "\n")
+                    self.stream.flush()
+                return
+            # move the cursor back to the first line, and redraw all the lines. a final line is
+            # written above the others, and is left there: the block only holds the running downloads.
+            out = "\x1b[{}F".format(self._drawn) if self._drawn else ""
+            lines = ([line] if final else []) + list(self._lines.values())
+            out += "".join(line + "\x1b[K\n" for line in lines)
+            self._drawn = len(self._lines)
+            self.stream.write(out)
+            self.stream.flush()
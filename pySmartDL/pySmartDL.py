@@ -8,17 +8,35 @@ import math
 import tempfile
 import base64
 import hashlib
+import shutil
 import socket
 import logging
+import io
 from io import StringIO
 import multiprocessing.dummy as multiprocessing
-from ctypes import c_int
+from ctypes import c_longlong
 import json
-import ssl
+import functools
+import mmap as mmap_module
 
 from . import utils
+from . import compression
+from . import extract
+from . import tls
+from . import singleflight
+from . import tracing
+from . import hedging
+from . import hashsums
+from . import supervisor
+from .progress import ProgressBar, ProgressCallback
+from . import process_engine
+from . import mirrors as mirrors_module
+from .metrics import Metrics, bind as bind_metrics
+from .writer import get_default_writer
 from .control_thread import ControlThread
 from .download import download
+from .transport import get_default_transport
+from .utils import CanceledException
 
 __all__ = ['SmartDL', 'utils']
 __version_mjaor__ = 1
@@ -37,15 +55,6 @@ class HashFailedException(Exception):
     def __repr__(self):
         return '<HashFailedException {}, got {}, expected {}>'.format(self.filename, self.calculated_hash, self.needed_hash)
         
-class CanceledException(Exception):
-    "Raised when the job is canceled."
-    def __init__(self):
-        pass
-    def __str__(self):
-        return 'CanceledException'
-    def __repr__(self):
-        return "<CanceledException>"
-
 class SmartDL:
     '''
     The main SmartDL class
@@ -54,8 +63,8 @@ class SmartDL:
     :type urls: string or list of strings
     :param dest: Destination path. Default is `%TEMP%/pySmartDL/`.
     :type dest: string
-    :param progress_bar: If True, prints a progress bar to the `stdout stream <http://docs.python.org/2/library/sys.html#sys.stdout>`_. Default is `True`.
-    :type progress_bar: bool
+    :param progress_bar: If True, prints a progress bar to the `stdout stream <http://docs.python.org/2/library/sys.html#sys.stdout>`_, if it's a terminal. Pass a `pySmartDL.progress.MultiProgressBar` instance to many downloads to show one line per download. Default is `True`.
+    :type progress_bar: bool or `pySmartDL.progress.ProgressBar` instance
 	:param fix_urls: If true, attempts to fix urls with unsafe characters.
 	:type fix_urls: bool
 	:param threads: Number of threads to use.
@@ -71,6 +80,22 @@ class SmartDL:
     :rtype: `SmartDL` instance
     :param verify: If ssl certificates should be validated.
     :type verify: bool
+    :param transport: The transport that performs the network I/O. Default is `pySmartDL.transport.UrllibTransport`.
+    :type transport: `pySmartDL.transport.Transport` instance
+    :param compression: If true, asks the server for a compressed transfer (gzip/deflate, and br/zstd if `brotli`/`zstandard` are installed), and decodes it on the fly. A compressed transfer uses a single connection; if the server doesn't compress the file, the usual parallel ranges are used. Default is *False*.
+    :type compression: bool
+    :param engine: `thread` runs the range workers as threads. `process` runs them in separate processes that write into one preallocated file, so TLS reads and the read loop scale past the GIL. Compressed transfers are read by a thread with either engine. The `process` engine requires Python 3.7 or later. Default is `thread`.
+    :type engine: string
+    :param probe_mirrors: If true and mirrors are given, all the mirrors are probed concurrently before the download, and the fastest one is used. Dead mirrors and mirrors that report a mismatched filesize are dropped. See `get_mirror_ranking()`. Default is *True*.
+    :type probe_mirrors: bool
+    :param writer: A `pySmartDL.writer.FileWriter` that does the disk writes for the range workers, so network reads and disk writes don't share a thread, and writes are coalesced. Pass *True* to use the process-wide default writer. Not used by the `process` engine. Default is *None* (every worker writes its own data).
+    :type writer: `pySmartDL.writer.FileWriter` instance or bool
+    :param single_flight: If true, concurrent downloads of the same url (or of the same hash, if `add_hash_verification()` is used) are deduplicated: only one transfer happens, and the other `SmartDL` objects wait for it and share its result, errors included. Across processes, downloads to the same `dest` are coordinated with a lock file next to it (`dest.lock`). See `pySmartDL.singleflight`. Default is *False*.
+    :type single_flight: bool
+    :param tracer: A `pySmartDL.tracing.Tracer` that records where the time of the download goes (DNS, connect, TLS, reads, writes, hashing...), for `export_chrome()` or a span callback. Pass *True* to create one; it's available as the `tracer` attribute. Default is *None* (no tracing).
+    :type tracer: `pySmartDL.tracing.Tracer` instance or bool
+    :param hedging: If true, a range that stalls or falls far behind its siblings gets a duplicate request for its unfinished tail (on a mirror, if there's one), and the first request to finish wins. See `pySmartDL.hedging`. Only used by the `thread` engine. Default is *True*.
+    :type hedging: bool
     
     .. NOTE::
             The provided dest may be a folder or a full path name (including filename). The workflow is:
@@ -81,7 +106,12 @@ class SmartDL:
             * If no path is provided, `%TEMP%/pySmartDL/` will be used.
     '''
     
-    def __init__(self, urls, dest=None, progress_bar=True, fix_urls=True, threads=5, timeout=5, logger=None, connect_default_logger=False, request_args=None, verify=True):
+    def __init__(self, urls, dest=None, progress_bar=True, fix_urls=True, threads=5, timeout=5, logger=None, connect_default_logger=False, request_args=None, verify=True, transport=None, compression=False, engine='thread', probe_mirrors=True, writer=None, single_flight=False, tracer=None, hedging=True):
+        if engine not in ('thread', 'process'):
+            raise ValueError("engine must be 'thread' or 'process' (got {!r})".format(engine))
+        if engine == 'process' and sys.version_info < (3, 7):
+            # the workers get the shared memory from the initializer of the pool, which is new in Python 3.7.
+            raise ValueError("The process engine requires Python 3.7 or later.")
         if logger:
             self.logger = logger
         elif connect_default_logger:
@@ -96,6 +126,10 @@ class SmartDL:
             self.requestArgs = {"headers": dict()}
         if "User-Agent" not in self.requestArgs["headers"]:
             self.requestArgs["headers"]["User-Agent"] = utils.get_random_useragent()
+        self.transport = transport or get_default_transport()
+        self.metrics = Metrics()
+        self.tracer = tracing.Tracer() if tracer is True else tracer or None
+        self._trace_start = None
         self.mirrors = [urls] if isinstance(urls, str) else urls
         if fix_urls:
             self.mirrors = [utils.url_fix(x) for x in self.mirrors]
@@ -111,47 +145,116 @@ class SmartDL:
         if os.path.isdir(self.dest):
             self.dest = os.path.join(self.dest, fn)
         
-        self.progress_bar = progress_bar
+        self._progress_callbacks = []
+        self._state_callbacks = []
+        self.single_flight = single_flight
+        self._flight = None
+        self._flight_lock = None
+        self._notify_lock = threading.Lock()
+        self.progress_bar = ProgressBar() if progress_bar is True else progress_bar or None
+        if self.progress_bar:
+            self.on_progress(self.progress_bar.on_progress, self.progress_bar.min_interval)
+            self.on_state_change(self.progress_bar.on_state_change)
         self.threads_count = threads
+        self.requested_threads_count = threads
         self.timeout = timeout
         self.current_attemp = 1 
         self.attemps_limit = 4
         self.minChunkFile = 1024**2*2 # 2MB
+        self.fastPathFilesize = self.minChunkFile*2  # smaller files are downloaded with the probe request, on the calling thread
         self.filesize = 0
-        self.shared_var = multiprocessing.Value(c_int, 0)  # a ctypes var that counts the bytes already downloaded
+        self.decoded_var = multiprocessing.Value(c_longlong, 0)  # counts the decoded bytes, if the transfer is compressed
+        self.compression = compression
+        self.content_encoding = None
+        self.engine = engine
+        self.verify = verify
+        self.probe_mirrors = probe_mirrors
+        self.writer = get_default_writer() if writer is True else writer
+        self.hedging = hedging and engine == 'thread'
+        self._watchdog = None
+        self.mirror_ranking = None
+        self._resolved = None  # (url, the target of its redirects), found by the probe request
+        self.extract_path = None
+        self.extract_format = None
+        self.keep_archive = True
+        self._extract_thread = None
+        self._extract_stop = threading.Event()
+        self._extract_errors = []
+        self._extracted = False
         self.thread_shared_cmds = {}
+        self._done = threading.Event()  # set when the download is finished, or stopped
         self.status = "ready"
         self.verify_hash = False
+        self._digests = {}  # digests of dest computed by the hash verification, by algorithm
         self._killed = False
         self._failed = False
         self._start_func_blocking = True
         self.errors = []
         
-        self.post_threadpool_thread = None
+        self.pool = None
+        self.shared_var = None
         self.control_thread = None
         
+        # a shared context, so TLS sessions are resumed across connections and downloads.
+        self.context = tls.get_ssl_context(verify)
+
         if not os.path.exists(os.path.dirname(self.dest)):
             self.logger.info('Folder "{}" does not exist. Creating...'.format(os.path.dirname(self.dest)))
             os.makedirs(os.path.dirname(self.dest))
-        if not utils.is_HTTPRange_supported(self.url, timeout=self.timeout):
-            self.logger.warning("Server does not support HTTPRange. threads_count is set to 1.")
-            self.threads_count = 1
+        if self.probe_mirrors and self.mirrors:
+            # start() probes all the mirrors concurrently, and takes the range support of the chosen one.
+            # checking the first url here would block on it if it hangs.
+            self.range_supported = None
+        else:
+            with bind_metrics(self.metrics), tracing.bind(self.tracer), tracing.span('range_probe'):
+                self.range_supported = utils.is_HTTPRange_supported(self.url, timeout=self.timeout, transport=self.transport, context=self.context, requestArgs=self.requestArgs)
+            if not self.range_supported:
+                self.logger.warning("Server does not support HTTPRange. threads_count is set to 1.")
+                self.threads_count = 1
         if os.path.exists(self.dest):
             self.logger.warning('Destination "{}" already exists. Existing file will be removed.'.format(self.dest))
         if not os.path.exists(os.path.dirname(self.dest)):
             self.logger.warning('Directory "{}" does not exist. Creating it...'.format(os.path.dirname(self.dest)))
             os.makedirs(os.path.dirname(self.dest))
-        
-        self.logger.info("Creating a ThreadPool of {} thread(s).".format(self.threads_count))
-        self.pool = utils.ManagedThreadPoolExecutor(self.threads_count)
 
-        if verify:
-            self.context = None
+    def _create_pool(self, processes=None):
+        # counts the bytes already downloaded, one counter per connection. hedged requests use the second half.
+        connections = self.threads_count*2 if self.hedging else self.threads_count
+        self.shared_var = process_engine.SharedCounters(connections)
+        if self.pool:
+            self.pool.shutdown(wait=False)
+        if self.engine == 'process' if processes is None else processes:
+            self.logger.info("Creating a ProcessPool of {} process(es).".format(self.threads_count))
+            self.thread_shared_cmds = process_engine.SharedCmds()
+            self.pool = process_engine.create_pool(self.threads_count, self.shared_var, self.thread_shared_cmds)
         else:
-            self.context = ssl.create_default_context()
-            self.context.check_hostname = False
-            self.context.verify_mode = ssl.CERT_NONE
-        
+            # the ranges run in the pool shared by all the downloads. the group only keeps the futures of this run.
+            self.pool = supervisor.TaskGroup(supervisor.supervisor.executor())
+
+    @property
+    def status(self):
+        return self._status
+
+    @status.setter
+    def status(self, value):
+        old = getattr(self, '_status', None)
+        self._status = value
+        if value == "finished" and self._trace_start is not None:
+            trace_start, self._trace_start = self._trace_start, None
+            self.tracer.add_span('smartdl', trace_start, self.tracer.now(), {'url': self.url, 'dest': self.dest, 'failed': self._failed})
+        if value == "finished" and self._flight:
+            self._land_flight()
+        if old != value:
+            for callback in self._state_callbacks:
+                try:
+                    callback(self, old, value)
+                except Exception as e:
+                    self.logger.exception(e)
+        if value == "ready":
+            self._done.clear()
+        elif value == "finished":
+            self._done.set()
+
     def __str__(self):
         return 'SmartDL(r"{}", dest=r"{}")'.format(self.url, self.dest)
 
@@ -171,6 +274,45 @@ class SmartDL:
         base64string = base64.standard_b64encode(auth_string.encode('utf-8'))
         self.requestArgs['headers']['Authorization'] = b"Basic " + base64string
         
+    def on_progress(self, callback, min_interval=0.1, min_delta=0):
+        '''
+        Registers a function that is called with the `SmartDL` object as the download progresses.
+        The function is called by the download threads as they receive data (there's no polling),
+        so it should return quickly.
+
+        :param callback: A function that receives the `SmartDL` object.
+        :param min_interval: Minimum time between two calls, in seconds. Default is 0.1.
+        :type min_interval: float
+        :param min_delta: Minimum number of bytes downloaded between two calls. Default is 0.
+        :type min_delta: int
+        '''
+        self._progress_callbacks.append(ProgressCallback(callback, min_interval, min_delta))
+
+    def on_state_change(self, callback):
+        '''
+        Registers a function that is called when the status of the task changes (see `get_status()`).
+
+        :param callback: A function that receives the `SmartDL` object, the old status and the new status.
+        '''
+        self._state_callbacks.append(callback)
+
+    def _notify_progress(self, force=False):
+        if not self._progress_callbacks:
+            return
+        # if another thread is already notifying, there's no need to do it twice.
+        if not self._notify_lock.acquire(force):
+            return
+        try:
+            now = time.monotonic()
+            value = self.shared_var.value
+            for callback in self._progress_callbacks:
+                try:
+                    callback(self, now, value, force)
+                except Exception as e:
+                    self.logger.exception(e)
+        finally:
+            self._notify_lock.release()
+
     def add_hash_verification(self, algorithm, hash):
         '''
         Adds hash verification to the download.
@@ -193,11 +335,38 @@ class SmartDL:
         self.verify_hash = True
         self.hash_algorithm = algorithm
         self.hash_code = hash
+
+    def add_extraction(self, path, keep_archive=True):
+        '''
+        Extracts the downloaded archive into a folder. Zip and tar archives (`.tar`, `.tar.gz`, `.tgz`,
+        `.tar.bz2`, `.tar.xz`, and `.tar.zst` if `zstandard` is installed) are supported, by the filename.
+
+        The archive is extracted while it downloads: a tar archive is fed in order to `tarfile`'s
+        stream mode, and a zip archive's central directory is fetched first, so every member is
+        extracted as soon as its ranges are downloaded. If `keep_archive` is false and the server
+        supports ranges, a zip archive is never written to disk: its members are fetched directly.
+
+        .. NOTE::
+            With the `process` engine, compressed transfers, or when the filesize is unknown, the archive
+            is extracted after the download.
+
+        :param path: Destination folder. Created if it doesn't exist.
+        :type path: string
+        :param keep_archive: If false, the archive is deleted after the extraction. Default is *True*.
+        :type keep_archive: bool
+        '''
+        fmt = extract.detect_format(self.dest)
+        if not fmt:
+            raise ValueError('Cannot extract "{}": not a supported archive.'.format(os.path.basename(self.dest)))
+        self.extract_path = path
+        self.extract_format = fmt
+        self.keep_archive = keep_archive
         
     def fetch_hash_sums(self):
         '''
         Will attempt to fetch UNIX hash sums files (`SHA256SUMS`, `SHA1SUMS` or `MD5SUMS` files in
-        the same url directory).
+        the same url directory). The sums files are fetched concurrently, and cached per folder,
+        so downloads from the same folder don't fetch them again. See `pySmartDL.hashsums`.
         
         Calls `self.add_hash_verification` if successful. Returns if a matching hash was found.
         
@@ -205,29 +374,13 @@ class SmartDL:
         
         *New in 1.2.1*
         '''
-        default_sums_filenames = ['SHA256SUMS', 'SHA1SUMS', 'MD5SUMS']
-        folder = os.path.dirname(self.url)
-        orig_basename = os.path.basename(self.url)
-        
         self.logger.info("Looking for SUMS files...")
-        for filename in default_sums_filenames:
-            try:
-                sums_url = "%s/%s" % (folder, filename)
-                sumsRequest = urllib.request.Request(sums_url, **self.requestArgs)
-                obj = urllib.request.urlopen(sumsRequest)
-                data = obj.read().split('\n')
-                obj.close()
-                
-                for line in data:
-                    if orig_basename.lower() in line.lower():
-                        self.logger.info("Found a matching hash in %s" % sums_url)
-                        algo = filename.rstrip('SUMS')
-                        hash = line.split(' ')[0]
-                        self.add_hash_verification(algo, hash)
-                        return
-                
-            except urllib.error.HTTPError:
-                continue
+        found = hashsums.find_hash(self.url, self.transport, self.requestArgs, self.context, self.timeout)
+        if not found:
+            return False
+        self.logger.info("Found a matching {} hash.".format(found[0]))
+        self.add_hash_verification(*found)
+        return True
         
     def start(self, blocking=None):
         '''
@@ -249,22 +402,39 @@ class SmartDL:
             blocking = self._start_func_blocking
         else:
             self._start_func_blocking = blocking
+
+        if self.tracer and self._trace_start is None:
+            self._trace_start = self.tracer.now()
+        self._create_pool()
+
+        if self.single_flight and not self._flight and self._join_flight(blocking):
+            return
         
         if self.mirrors:
             self.logger.info('One URL and {} mirrors are loaded.'.format(len(self.mirrors)))
         else:
             self.logger.info('One URL is loaded.')
         
+        self._digests = {}
         if self.verify_hash and os.path.exists(self.dest):
-            if utils.get_file_hash(self.hash_algorithm, self.dest) == self.hash_code:
+            hash_ = utils.get_file_hash(self.hash_algorithm, self.dest)
+            if hash_ == self.hash_code:
+                self._digests[self.hash_algorithm.lower()] = hash_
                 self.logger.info("Destination '%s' already exists, and the hash matches. No need to download." % self.dest)
                 self.status = 'finished'
                 return
 
+        if self.probe_mirrors and self.mirrors and self.mirror_ranking is None:
+            self._rank_mirrors()
+
         self.logger.info("Downloading '{}' to '{}'...".format(self.url, self.dest))
-        req = urllib.request.Request(self.url, **self.requestArgs)
+        requestArgs = self.requestArgs
+        if self.compression:
+            requestArgs = dict(self.requestArgs, headers=dict(self.requestArgs['headers']))
+            requestArgs['headers']['Accept-Encoding'] = compression.accept_encoding()
         try:
-            urlObj = urllib.request.urlopen(req, timeout=self.timeout, context=self.context)
+            with bind_metrics(self.metrics), tracing.bind(self.tracer), tracing.span('probe'):
+                urlObj = self._open_probe(requestArgs)
         except (urllib.error.HTTPError, urllib.error.URLError, socket.timeout) as e:
             self.errors.append(e)
             if self.mirrors:
@@ -280,14 +450,53 @@ class SmartDL:
                 self.status = "finished"
                 raise
         
+        self.content_encoding = compression.get_content_encoding(urlObj.headers) if self.compression else None
+        identityArgs = None
+        if self.content_encoding and not compression.is_supported(self.content_encoding):
+            # retrying would get the same answer. ask for the file unencoded instead, once.
+            urlObj.close()
+            self.logger.warning("Server sent the file {}-encoded, which can't be decoded. Asking for it unencoded...".format(self.content_encoding))
+            requestArgs = identityArgs = dict(self.requestArgs, headers=dict(self.requestArgs['headers'], **{'Accept-Encoding': 'identity'}))
+            with bind_metrics(self.metrics), tracing.bind(self.tracer), tracing.span('probe'):
+                urlObj = self._open_probe(requestArgs)
+            self.content_encoding = compression.get_content_encoding(urlObj.headers)
+            if self.content_encoding:
+                urlObj.close()
+                e = ValueError("Server sent the file {}-encoded, which can't be decoded, even when asked for it unencoded.".format(self.content_encoding))
+                self.logger.warning(str(e))
+                self.errors.append(e)
+                self._failed = True
+                self.status = "finished"
+                raise e
         try:
             self.filesize = int(urlObj.headers["Content-Length"])
             self.logger.info("Content-Length is {} ({}).".format(self.filesize, utils.sizeof_human(self.filesize)))
         except (IndexError, KeyError, TypeError):
-            self.logger.warning("Server did not send Content-Length. Filesize is unknown.")
             self.filesize = 0
+            if not self.content_encoding:
+                # a chunked response. the size may still be known from a range request or a HEAD.
+                with bind_metrics(self.metrics), tracing.bind(self.tracer), tracing.span('size_probe'):
+                    self.filesize = utils.discover_filesize(self.url, timeout=self.timeout, transport=self.transport, context=self.context, requestArgs=requestArgs)
+            if self.filesize:
+                self.logger.info("Server did not send Content-Length. Filesize is {} ({}).".format(self.filesize, utils.sizeof_human(self.filesize)))
+            else:
+                self.logger.warning("Server did not send Content-Length. Filesize is unknown.")
             
-        args = utils.calc_chunk_size(self.filesize, self.threads_count, self.minChunkFile)
+        if self.content_encoding:
+            # ranges of a compressed response can't be decoded on their own, so we use a single stream.
+            self.logger.info("Server sent the file {}-encoded. Using a single connection.".format(self.content_encoding))
+            args = [(0, 0)]
+            if self.engine == 'process':
+                # the decoded size isn't known ahead, so the file can't be preallocated for the workers. the stream is read by a thread instead.
+                self._create_pool(processes=False)
+        else:
+            requestArgs = identityArgs or self.requestArgs
+            args = utils.calc_chunk_size(self.filesize, self.threads_count, self.minChunkFile)
+        if blocking and (not self.filesize or self.filesize < self.fastPathFilesize or len(args) == 1) and not self._can_extract_remote_zip():
+            self._download_single_request(urlObj, requestArgs)
+            return
+        urlObj.close()
+
         bytes_per_thread = args[0][1] - args[0][0] + 1
         if len(args)>1:
             self.logger.info("Launching {} threads (downloads {}/thread).".format(len(args),  utils.sizeof_human(bytes_per_thread)))
@@ -295,50 +504,378 @@ class SmartDL:
             self.logger.info("Launching 1 thread (downloads {}).".format(utils.sizeof_human(bytes_per_thread)))
         
         self.status = "downloading"
+        self._extract_thread = None
+        self._extract_stop = threading.Event()
+        self._extract_errors = []
+        self._extracted = False
+        self._watchdog = None
+        if self.extract_path:
+            os.makedirs(self.extract_path, exist_ok=True)
         
-        for i, arg in enumerate(args):
-            req = self.pool.submit(
-                download,
-                self.url,
-                self.dest+".%.3d" % i,
-                self.requestArgs,
-                self.context,
-                arg[0],
-                arg[1],
-                self.timeout,
-                self.shared_var,
-                self.thread_shared_cmds,
-                self.logger
-            )
-        
-        self.post_threadpool_thread = threading.Thread(
-            target=post_threadpool_actions,
-            args=(
-                self.pool,
-                [[(self.dest+".%.3d" % i) for i in range(len(args))], self.dest],
-                self.filesize,
-                self
-            )
-        )
-        self.post_threadpool_thread.daemon = True
-        self.post_threadpool_thread.start()
+        if self._can_extract_remote_zip():
+            # the archive isn't kept, so only the members are fetched.
+            parts = []
+            url = self.get_resolved_url()
+            fetch = extract.make_range_fetcher(url, self.transport, requestArgs, self.context, self.timeout, process_engine.SlotCounter(self.shared_var.array, 0),
+                                               self.url if url != self.url else None)
+            self.pool.submit(self._run_extraction, extract.extract_remote_zip, self.filesize, fetch, self.extract_path, self.threads_count, self._extract_stop)
+            self._extracted = True
+        elif self.engine == 'process' and not self.content_encoding:
+            url = self.get_resolved_url()
+            parts = [self.dest+".000"]
+            with open(parts[0], 'wb') as f:
+                f.truncate(self.filesize)
+            for i, arg in enumerate(args):
+                self.pool.submit(
+                    process_engine.process_download,
+                    i,
+                    url,
+                    parts[0],
+                    requestArgs,
+                    self.verify,
+                    arg[0],
+                    arg[1],
+                    self.timeout,
+                    self.logger,
+                    self.transport,
+                    fallback_url=self.url if url != self.url else None
+                )
+        else:
+            url = self.get_resolved_url()
+            parts = [(self.dest+".%.3d" % i) for i in range(len(args))]
+            for part in parts:
+                # the parts exist before their requests start, so a hedge that starts first can open its part, and is never truncated by the original request.
+                open(part, 'wb').close()
+            part_futures = []
+            tasks = [hedging.RangeTask(i, arg[0], arg[1]) for i, arg in enumerate(args)]
+            # tar archives are extracted by reading the parts in order, so a hedged tail, written ahead, would be read as a hole.
+            if self.hedging and self.range_supported and not self.content_encoding and not (self.extract_path and self.extract_format != 'zip'):
+                self._watchdog = hedging.StallWatchdog(tasks, functools.partial(self._hedge, parts, requestArgs))
+            for i, arg in enumerate(args):
+                counter = process_engine.SlotCounter(self.shared_var.array, i)
+                future = self.pool.submit(
+                    tracing.wrap(self.tracer, tasks[i].run, 'range', index=i, start=arg[0], end=arg[1]),
+                    tasks[i].add_attempt(arg[0], counter, url),
+                    download,
+                    url,
+                    parts[i],
+                    requestArgs,
+                    self.context,
+                    arg[0],
+                    arg[1],
+                    self.timeout,
+                    counter,
+                    self.thread_shared_cmds,
+                    self.logger,
+                    transport=self.transport,
+                    decompress=bool(self.content_encoding),
+                    decoded_var=self.decoded_var,
+                    metrics=self.metrics,
+                    writer=self.writer,
+                    progress=self._notify_progress,
+                    offset=0,
+                    resumable=self.range_supported,
+                    fallback_url=self.url if url != self.url else None
+                )
+                part_futures.append(future)
+            if self.extract_path and self.filesize and not self.content_encoding:
+                self._start_extraction(args, parts, part_futures)
         
-        self.control_thread = ControlThread(self)
+        self.control_thread = ControlThread(self, functools.partial(
+            post_threadpool_actions,
+            self.pool,
+            [parts, self.dest],
+            0 if self.content_encoding or not parts else self.filesize,
+            self
+        ))
+        supervisor.supervisor.watch(self.control_thread)
         
         if blocking:
             self.wait(raise_exceptions=True)
             
+    def _open_probe(self, requestArgs):
+        # the probe goes straight to the target of the last redirects, if it's still valid. the target it ends up at
+        # is kept for the range requests, so they don't follow the same redirects again.
+        url = self.get_resolved_url()
+        urlObj = None
+        if url != self.url:
+            try:
+                urlObj = self.transport.open(url, requestArgs, context=self.context, timeout=self.timeout)
+            except urllib.error.HTTPError as e:
+                if e.code not in utils.EXPIRED_URL_CODES:
+                    raise
+                self.logger.info("'{}' was refused (HTTP {}). Using '{}'.".format(url, e.code, self.url))
+        if urlObj is None:
+            urlObj = self.transport.open(self.url, requestArgs, context=self.context, timeout=self.timeout)
+            final_url = urlObj.geturl() or self.url
+            self._resolved = (self.url, final_url) if final_url != self.url else None
+            if self._resolved:
+                expiry = utils.get_url_expiry(final_url)
+                self.logger.info("'{}' redirects to '{}'{}.".format(self.url, final_url, '' if expiry is None else ', which expires in {}'.format(utils.time_human(max(expiry-time.time(), 0)))))
+        return urlObj
+
+    def get_resolved_url(self):
+        '''
+        Returns the url that the range requests use: the target of the url's redirects, as found by the
+        last probe request, unless it's a signed url that expired. Else, returns the url itself.
+        
+        :rtype: string
+        '''
+        if self._resolved and self._resolved[0] == self.url and not utils.is_url_expired(self._resolved[1]):
+            return self._resolved[1]
+        return self.url
+
+    def _hedge(self, parts, requestArgs, task, start, reason):
+        # the tail goes to the next mirror that supports ranges, if the mirrors were probed and have the same file.
+        ranged = [r['url'] for r in self.mirror_ranking or [] if r['range_supported']]
+        mirrors = [url for url in self.mirrors if url in ranged]
+        url = mirrors[0] if mirrors else self.get_resolved_url()
+        counter = process_engine.SlotCounter(self.shared_var.array, self.threads_count + task.index)
+        attempt = task.add_attempt(start, counter, url)
+        if not attempt or self._killed:
+            return
+        self.logger.info("Range {} is {}. Requesting its last {} from '{}'...".format(task.index, reason, utils.sizeof_human(task.end-start+1), url))
+        self.metrics.incr('hedged_requests')
+        self.pool.submit(
+            tracing.wrap(self.tracer, task.run, 'hedge', index=task.index, start=start, end=task.end),
+            attempt,
+            download,
+            url,
+            parts[task.index],
+            requestArgs,
+            self.context,
+            start,
+            task.end,
+            self.timeout,
+            counter,
+            self.thread_shared_cmds,
+            self.logger,
+            transport=self.transport,
+            metrics=self.metrics,
+            writer=self.writer,
+            progress=self._notify_progress,
+            offset=start-task.start,
+            resumable=True,
+            fallback_url=self.url if url == self.get_resolved_url() and url != self.url else None
+        )
+
+    def _join_flight(self, blocking):
+        # returns True if another download does the work, and this one only waits for its result.
+        if self.verify_hash:
+            key = ('hash', self.hash_algorithm.lower(), self.hash_code.lower())
+        else:
+            key = ('url', self.url)
+        flight, leader = singleflight.flights.join(key)
+        if not leader:
+            self.logger.info('The same file is already being downloaded. Waiting for it...')
+            self._wait_for(self._wait_for_flight, flight, blocking)
+            return True
+
+        self._flight = flight
+        flight.dest = self.dest
+        lock = singleflight.FileLock(self.dest + '.lock')
+        if lock.acquire(blocking=False, clear=True):
+            self._flight_lock = lock
+            return False
+        self.logger.info('Another process is downloading "{}". Waiting for it...'.format(self.dest))
+        self._wait_for(self._wait_for_process, lock, blocking)
+        return True
+
+    def _wait_for(self, target, arg, blocking):
+        self.status = "downloading"
+        self.control_thread = ControlThread(self)
+        t1 = time.time()
+        if isinstance(arg, singleflight.Flight):
+            # no thread waits for the flight: the result is handled in the shared pool once it lands.
+            arg.add_done_callback(lambda: supervisor.supervisor.submit(target, arg, t1))
+        else:
+            # the lock of another process can only be waited for by blocking on it.
+            thread = threading.Thread(target=target, args=(arg, t1))
+            thread.daemon = True
+            thread.start()
+        if blocking:
+            self.wait(raise_exceptions=True)
+
+    def _wait_for_flight(self, flight, t1):
+        self.errors.extend(flight.errors)
+        self._failed = flight.failed
+        self.filesize = flight.filesize
+        if not self._failed and os.path.abspath(flight.dest) != os.path.abspath(self.dest):
+            try:
+                shutil.copyfile(flight.dest, self.dest)
+            except OSError as e:
+                self.errors.append(e)
+                self._failed = True
+        self._finish_waiting(t1)
+
+    def _wait_for_process(self, lock, t1):
+        lock.acquire()
+        result = lock.read_result()
+        lock.release()
+        if not result:
+            self.errors.append(urllib.error.URLError('The process that downloaded "{}" exited without a result.'.format(self.dest)))
+            self._failed = True
+        elif not result['ok']:
+            self.errors.append(urllib.error.URLError('The download by process {} failed: {}'.format(result['pid'], result['error'])))
+            self._failed = True
+        elif not os.path.exists(self.dest):
+            self.errors.append(urllib.error.URLError('The download by process {} succeeded, but "{}" does not exist.'.format(result['pid'], self.dest)))
+            self._failed = True
+        else:
+            self.filesize = result['filesize']
+        self._finish_waiting(t1)
+
+    def _finish_waiting(self, t1):
+        if not self._failed:
+            self.shared_var.value = self.filesize
+        self.control_thread.finish(time.time()-t1)
+        self.status = "finished"
+
+    def _land_flight(self, canceled=False):
+        flight, self._flight = self._flight, None
+        failed = self._failed or canceled
+        errors = list(self.errors)
+        if canceled:
+            errors.append(CanceledException())
+        if self._flight_lock:
+            lock, self._flight_lock = self._flight_lock, None
+            lock.release({
+                'ok': not failed,
+                'error': str(errors[-1]) if failed and errors else None,
+                'pid': os.getpid(),
+                'filesize': self.filesize,
+            })
+        singleflight.flights.land(flight, errors, failed, self.filesize)
+
+    def _download_single_request(self, urlObj, requestArgs):
+        # a single connection would be used anyway, so the probe response is written straight
+        # into dest, on the calling thread: no pool, no extra threads and no part file.
+        self.logger.info("Downloading with a single request.")
+        self.status = "downloading"
+        self._extract_thread = None
+        self._extracted = False
+        self._extract_errors = []
+        self.control_thread = ControlThread(self)
+        url = self.get_resolved_url()
+        t1 = time.time()
+        try:
+            tracing.wrap(self.tracer, download, 'single_request')(
+                url,
+                self.dest,
+                requestArgs,
+                self.context,
+                timeout=self.timeout,
+                shared_var=process_engine.SlotCounter(self.shared_var.array, 0),
+                thread_shared_cmds=self.thread_shared_cmds,
+                logger=self.logger,
+                transport=self.transport,
+                decompress=bool(self.content_encoding),
+                decoded_var=self.decoded_var,
+                metrics=self.metrics,
+                writer=self.writer,
+                progress=self._notify_progress,
+                urlObj=urlObj,
+                resumable=self.range_supported,
+                fallback_url=self.url if url != self.url else None
+            )
+        except Exception as e:
+            if self._killed:
+                return
+            self.logger.exception(e)
+            self.retry(str(e))
+        else:
+            self.control_thread.finish(time.time()-t1)
+            if self.extract_path:
+                os.makedirs(self.extract_path, exist_ok=True)
+            tracing.wrap(self.tracer, post_download_actions)(self, [self.dest], self.dest)
+        
+        if self.status != "finished":
+            self.status = "finished"
+        if self._failed:
+            raise self.errors[-1]
+
+    def _can_extract_remote_zip(self):
+        # the archive itself is never fetched, so it can't be hashed.
+        return self.extract_format == 'zip' and not self.keep_archive and not self.verify_hash and self.range_supported and self.filesize and not self.content_encoding
+
+    def _start_extraction(self, args, parts, part_futures):
+        if self.extract_format == 'zip':
+            if not self.range_supported:
+                return  # the central directory can't be fetched first. extract after the download.
+            url = self.get_resolved_url()
+            fetch = extract.make_range_fetcher(url, self.transport, self.requestArgs, self.context, self.timeout, fallback_url=self.url if url != self.url else None)
+            target = extract.extract_zip_while_downloading
+            target_args = (self.filesize, fetch, self.extract_path, args, parts, part_futures, self._extract_stop, self.threads_count)
+        else:
+            reader = extract.PartsReader(parts, [arg[1]-arg[0]+1 for arg in args], self.pool.done, self._extract_stop)
+            target = extract.extract_tar_stream
+            target_args = (io.BufferedReader(reader, 1024**2), self.extract_path, self.extract_format)
+
+        self.logger.info('Extracting to "{}" while downloading...'.format(self.extract_path))
+        self._extract_thread = threading.Thread(target=self._run_extraction, args=(target,)+target_args)
+        self._extract_thread.daemon = True
+        self._extract_thread.start()
+        self._extracted = True
+
+    def _run_extraction(self, target, *args):
+        with bind_metrics(self.metrics), tracing.bind(self.tracer), tracing.span('extract'):
+            try:
+                target(*args)
+            except extract.ExtractionCanceled:
+                pass
+            except Exception as e:
+                self._extract_errors.append(e)
+                self._extract_stop.set()
+                raise
+
+    def _rank_mirrors(self):
+        self.logger.info('Probing {} mirrors...'.format(len(self.mirrors)+1))
+        ranking, dropped = mirrors_module.rank_mirrors([self.url]+self.mirrors, self.requestArgs, self.context, self.timeout, self.transport, metrics=self.metrics)
+        self.mirror_ranking = ranking
+        for r in dropped:
+            self.logger.warning('Mirror "{}" was dropped: {}'.format(r['url'], r['error']))
+            self.errors.append(r['error'])
+        if not ranking:
+            self.mirrors = []
+            if self.range_supported is None:
+                self.range_supported = False
+                self.threads_count = 1
+                self._create_pool()
+            return
+
+        self.url = ranking[0]['url']
+        self.mirrors = [r['url'] for r in ranking[1:]]
+        self.logger.info('Using the fastest mirror "{}" (ttfb {:.0f}ms, {}/s).'.format(self.url, ranking[0]['ttfb']*1000, utils.sizeof_human(ranking[0]['throughput'])))
+
+        # the range support of the chosen mirror, from its probe.
+        self.range_supported = ranking[0]['range_supported']
+        threads_count = self.requested_threads_count if self.range_supported else 1
+        if threads_count != self.threads_count:
+            self.threads_count = threads_count
+            self._create_pool()
+
+    def get_mirror_ranking(self):
+        '''
+        Returns the ranking of the mirrors, best first. Each item is a dict with the keys `url`, `ttfb` (seconds),
+        `throughput` (bytes per second), `filesize` and `range_supported`. Returns an empty list if the mirrors
+        were not probed (see the `probe_mirrors` parameter).
+        
+        :rtype: list of dicts
+        '''
+        return [dict(r) for r in self.mirror_ranking or []]
+
     def _exc_callback(self, req, e):
         self.errors.append(e[0])
         self.logger.exception(e[1])
         
-    def retry(self, eStr=""):
+    def retry(self, eStr="", blocking=None):
         if self.current_attemp < self.attemps_limit:
             self.current_attemp += 1
             self.status = "ready"
             self.shared_var.value = 0
-            self.thread_shared_cmds = {}
-            self.start()
+            self.decoded_var.value = 0
+            self.thread_shared_cmds.clear()
+            self.start(blocking)
              
         else:
             s = 'The maximum retry attempts reached'
@@ -347,15 +884,16 @@ class SmartDL:
             self.errors.append(urllib.error.HTTPError(self.url, "0", s, {}, StringIO()))
             self._failed = True
             
-    def try_next_mirror(self, e=None):
+    def try_next_mirror(self, e=None, blocking=None):
         if self.mirrors:
             if e:
                 self.errors.append(e)
             self.status = "ready"
             self.shared_var.value = 0
+            self.decoded_var.value = 0
             self.url = self.mirrors.pop(0)
             self.logger.info('Using url "{}"'.format(self.url))
-            self.start()
+            self.start(blocking)
         else:
             self._failed = True
             self.errors.append(e)
@@ -363,8 +901,8 @@ class SmartDL:
     def get_eta(self, human=False):
         '''
         Get estimated time of download completion, in seconds. Returns `0` if there is
-        no enough data to calculate the estimated time (this will happen on the approx.
-        first 5 seconds of each download).
+        no enough data to calculate the estimated time (this will happen on the first
+        2 seconds of each download).
         
         :param human: If true, returns a human-readable formatted string. Else, returns an int type number
         :type human: bool
@@ -422,7 +960,7 @@ class SmartDL:
             return False
         if self.status == "finished":
             return True
-        return not self.post_threadpool_thread.is_alive()
+        return self._done.is_set()
 
     def isSuccessful(self):
         '''
@@ -463,7 +1001,7 @@ class SmartDL:
     def get_status(self):
         '''
         Returns the current status of the task. Possible values: *ready*,
-        *downloading*, *paused*, *combining*, *finished*.
+        *downloading*, *paused*, *extracting*, *combining*, *finished*.
         
         :rtype: string
         '''
@@ -479,10 +1017,7 @@ class SmartDL:
         if self.status in ["ready", "finished"]:
             return
             
-        while not self.isFinished():
-            time.sleep(0.1)
-        self.post_threadpool_thread.join()
-        self.control_thread.join()
+        self._done.wait()
         
         if self._failed and raise_exceptions:
             raise self.errors[-1]
@@ -493,11 +1028,17 @@ class SmartDL:
         '''
         if self.status == "downloading":
             self.thread_shared_cmds['stop'] = ""
+            self._extract_stop.set()
             self._killed = True
+            if isinstance(self.pool, supervisor.TaskGroup):
+                self.pool.shutdown(wait=False)  # the ranges that wait for a worker won't start
+            if self._flight:
+                self._land_flight(canceled=True)
 
     def pause(self):
         '''
-        Pauses the download.
+        Pauses the download. If the server supports ranges, the connections are closed
+        while the download is paused, and `resume()` requests the rest of every range.
         '''
         if self.status == "downloading":
             self.status = "paused"
@@ -572,6 +1113,46 @@ class SmartDL:
             return utils.sizeof_human(self.control_thread.get_dl_size())    
         return self.control_thread.get_dl_size()
 
+    def get_decoded_size(self, human=False):
+        '''
+        Get the number of decoded bytes written so far. Same as `get_dl_size()`, unless
+        the transfer is compressed (see the `compression` parameter).
+        
+        :param human: If true, returns a human-readable formatted string. Else, returns an int type number
+        :type human: bool
+        :rtype: int/string
+        '''
+        size = self.decoded_var.value if self.content_encoding else self.get_dl_size()
+        if human:
+            return utils.sizeof_human(size)
+        return size
+
+    def get_metrics(self):
+        '''
+        Returns the network metrics of the task, such as `connect_time` (the connect latency),
+        `dns_time`, `dns_cache_hits` and `connections`. Counters are ints; timings are dicts with
+        the keys `count`, `total`, `min`, `max` and `avg` (in seconds).
+        
+        .. NOTE::
+            Metrics are not collected from the workers of the `process` engine.
+        
+        :rtype: dict
+        '''
+        return self.metrics.snapshot()
+
+    def get_telemetry(self):
+        '''
+        Returns the raw transfer time series, for the analysis of slow transfers: the downloaded
+        bytes of the task and of every connection (the ranges, then their hedged requests), sampled
+        every 100ms (for up to the last 2 minutes). See `pySmartDL.telemetry.Telemetry.export()`
+        for the format. Returns an empty dict if the download has not started.
+        
+        :rtype: dict
+        '''
+        if not self.control_thread:
+            return {}
+        return self.control_thread.telemetry.export()
+
     def get_final_filesize(self, human=False):
         '''
         Get total download size in bytes.
@@ -587,7 +1168,7 @@ class SmartDL:
         return self.control_thread.get_final_filesize()
     
     
-    def get_data(self, binary=False, bytes=-1):
+    def get_data(self, binary=False, bytes=-1, mapped=False):
         '''
         Returns the downloaded data. Will raise `RuntimeError` if it's
         called when the download task is not finished yet.
@@ -596,11 +1177,25 @@ class SmartDL:
         :type binary: bool
         :param bytes: Number of bytes to read. Negative values will read until EOF. Default is `-1`.
         :type bytes: int
-        :rtype: string
+        :param mapped: If true, returns a read-only `memoryview` over a memory map of the file instead of reading it into memory, so even huge files cost no memory. The data is paged in as it's accessed. When done, call the view's `release()`, and then `view.obj.close()` to unmap the file right away (else it's unmapped when the map is garbage collected). Default is *False*.
+        :type mapped: bool
+        :rtype: string, or `memoryview` if `mapped` is true
         '''
         if self.status != 'finished':
             raise RuntimeError("The download task must be finished in order to read the data. (current status is %s)" % self.status)
             
+        if mapped:
+            with open(self.get_dest(), 'rb') as f:
+                try:
+                    view = memoryview(mmap_module.mmap(f.fileno(), 0, access=mmap_module.ACCESS_READ))
+                except ValueError:  # an empty file can't be mapped
+                    view = memoryview(b'')
+            if bytes>0:
+                # the slice keeps the map alive on its own. releasing the whole view lets the caller close the map.
+                view, whole = view[:bytes], view
+                whole.release()
+            return view
+
         flags = 'rb' if binary else 'r'
         with open(self.get_dest(), flags) as f:
             data = f.read(bytes) if bytes>0 else f.read()
@@ -611,6 +1206,9 @@ class SmartDL:
         Returns the downloaded data's hash. Will raise `RuntimeError` if it's
         called when the download task is not finished yet.
         
+        The file is hashed in blocks, so it's never loaded into memory. If the hash
+        verification already calculated the digest with `algorithm`, it's reused.
+        
         :param algorithm: Hashing algorithm.
         :type algorithm: bool
         :rtype: string
@@ -618,7 +1216,12 @@ class SmartDL:
         .. WARNING::
             The hashing algorithm must be supported on your system, as documented at `hashlib documentation page <http://docs.python.org/3/library/hashlib.html>`_.
         '''
-        return hashlib.new(algorithm, self.get_data(binary=True)).hexdigest()
+        if self.status != 'finished':
+            raise RuntimeError("The download task must be finished in order to read the data. (current status is %s)" % self.status)
+        digest = self._digests.get(algorithm.lower())
+        if digest is None:
+            digest = utils.get_file_hash(algorithm, self.get_dest())
+        return digest
 
     def get_json(self):
         '''
@@ -628,22 +1231,31 @@ class SmartDL:
         
         :rtype: dict
         '''
-        data = self.get_data()
-        return json.loads(data)
+        # the text is decoded straight from the mapped file, without reading the bytes into memory first.
+        view = self.get_data(mapped=True)
+        try:
+            text = str(view, utils.detect_json_encoding(view[:4].tobytes()))
+        finally:
+            mapping = view.obj
+            view.release()
+            if isinstance(mapping, mmap_module.mmap):
+                mapping.close()
+        return json.loads(text)
 
 def post_threadpool_actions(pool, args, expected_filesize, SmartDLObj):
-    "Run function after thread pool is done. Run this in a thread."
-    while not pool.done():
-        time.sleep(0.1)
-
+    "Run function after thread pool is done. The supervisor runs it in the shared pool."
     if SmartDLObj._killed:
+        SmartDLObj._extract_stop.set()
         return
         
     if pool.get_exception():
+        SmartDLObj._extract_stop.set()
         for exc in pool.get_exceptions():
             SmartDLObj.logger.exception(exc)
             
-        SmartDLObj.retry(str(pool.get_exception()))
+        # the new run is supervised on its own, so this one ends here.
+        SmartDLObj.retry(str(pool.get_exception()), blocking=False)
+        return
        
     if SmartDLObj._failed:
         SmartDLObj.logger.warning("Task had errors. Exiting...")
@@ -651,25 +1263,63 @@ def post_threadpool_actions(pool, args, expected_filesize, SmartDLObj):
         
     if expected_filesize:  # if not zero, expected filesize is known
         threads = len(args[0])
-        total_filesize = sum([os.path.getsize(x) for x in args[0]])
+        if SmartDLObj.engine == 'process':
+            # the file is preallocated, so we count the bytes the workers have written.
+            total_filesize = SmartDLObj.shared_var.value
+        else:
+            total_filesize = sum([os.path.getsize(x) for x in args[0]])
         diff = math.fabs(expected_filesize - total_filesize)
         
         # if the difference is more than 4*thread numbers (because a thread may download 4KB extra per thread because of NTFS's block size)
         if diff > 4*1024*threads:
             errMsg = 'Diff between downloaded files and expected filesizes is {}B (filesize: {}, expected_filesize: {}, {} threads).'.format(total_filesize, expected_filesize, diff, threads)
             SmartDLObj.logger.warning(errMsg)
-            SmartDLObj.retry(errMsg)
+            SmartDLObj.retry(errMsg, blocking=False)
             return
     
-    SmartDLObj.status = "combining"
-    utils.combine_files(*args)
+    post_download_actions(SmartDLObj, *args, blocking=False)
+
+def post_download_actions(SmartDLObj, parts, dest_path, blocking=None):
+    "Combines the parts, verifies the hash and extracts the archive, once all the data is downloaded. `blocking` is passed to `start()` if the next mirror is tried."
+    if SmartDLObj._extract_thread:
+        SmartDLObj.status = "extracting"
+        SmartDLObj._extract_thread.join()
+    if SmartDLObj._extract_errors:
+        SmartDLObj.logger.warning("Extraction failed: {}".format(SmartDLObj._extract_errors[0]))
+        SmartDLObj.errors.extend(SmartDLObj._extract_errors)
+        SmartDLObj._failed = True
+        return
+
+    keep_archive = SmartDLObj.keep_archive or not SmartDLObj.extract_path
+    if parts and parts != [dest_path] and (keep_archive or not SmartDLObj._extracted):
+        SmartDLObj.status = "combining"
+        with tracing.span('combine', parts=len(parts)):
+            utils.combine_files(parts, dest_path)
+        parts = [dest_path]
     
-    if SmartDLObj.verify_hash:
-        dest_path = args[-1]            
-        hash_ = utils.get_file_hash(SmartDLObj.hash_algorithm, dest_path)
+    if SmartDLObj.verify_hash and parts:
+        with tracing.span('hash', algorithm=SmartDLObj.hash_algorithm):
+            hash_ = utils.get_file_hash(SmartDLObj.hash_algorithm, parts)
 	
         if hash_ == SmartDLObj.hash_code:
             SmartDLObj.logger.info('Hash verification succeeded.')
+            if parts == [dest_path]:
+                SmartDLObj._digests[SmartDLObj.hash_algorithm.lower()] = hash_
         else:
             SmartDLObj.logger.warning('Hash verification failed.')
-            SmartDLObj.try_next_mirror(HashFailedException(os.path.basename(dest_path), hash, SmartDLObj.hash_code))
+            SmartDLObj.try_next_mirror(HashFailedException(os.path.basename(dest_path), hash_, SmartDLObj.hash_code), blocking)
+            return
+
+    if SmartDLObj.extract_path and not SmartDLObj._extracted:
+        SmartDLObj.status = "extracting"
+        try:
+            with tracing.span('extract'):
+                extract.extract_file(dest_path, SmartDLObj.extract_path, SmartDLObj.extract_format)
+        except Exception as e:
+            SmartDLObj.logger.warning("Extraction failed: {}".format(e))
+            SmartDLObj.errors.append(e)
+            SmartDLObj._failed = True
+            return
+    if not keep_archive:
+        for part in parts:
+            os.remove(part)
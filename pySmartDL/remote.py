@@ -0,0 +1,157 @@
+'''
+A seekable, read-only file object over HTTP range requests, for when only parts of a
+remote file are needed (a zip's central directory, a Parquet footer...). Blocks are kept
+in an LRU cache, missing blocks are fetched in parallel, and sequential reads trigger
+readahead.
+
+Usage::
+
+	import zipfile
+	from pySmartDL import RemoteFile
+
+	with RemoteFile(url) as f:
+		print(zipfile.ZipFile(f).namelist())
+'''
+
+import io
+import threading
+import collections
+from concurrent import futures
+
+from . import tls
+from . import utils
+from .extract import make_range_fetcher
+from .transport import get_default_transport
+
+class RemoteFile(io.RawIOBase):
+    '''
+    :param url: Url address. The server must support range requests.
+    :type url: string
+    :param block_size: Size of a cached block, in bytes. Default is 1MB.
+    :type block_size: int
+    :param cache_blocks: Maximum number of cached blocks. Default is 64.
+    :type cache_blocks: int
+    :param readahead: Number of blocks fetched ahead of sequential reads. Default is 2.
+    :type readahead: int
+    :param threads: Number of blocks fetched in parallel. Default is 4.
+    :type threads: int
+    :param request_args: Arguments to be passed to a new urllib.request.Request instance in dictionary form.
+    :type request_args: dict
+    :param verify: If ssl certificates should be validated. Default is True.
+    :type verify: bool
+    :param transport: The transport that performs the range requests. Default is the default transport.
+    :type transport: `pySmartDL.transport.Transport` instance
+    '''
+    def __init__(self, url, block_size=1024**2, cache_blocks=64, readahead=2, threads=4, timeout=5, request_args=None, verify=True, transport=None):
+        self.url = url
+        self.block_size = block_size
+        self.cache_blocks = max(cache_blocks, 1)
+        self.readahead = readahead
+        self.threads = threads
+        self.timeout = timeout
+        self.requestArgs = request_args or {"headers": {}}
+        self.context = tls.get_ssl_context(verify)
+        self.transport = transport or get_default_transport()
+        self.requests = 0  # number of range requests made
+        self.bytes_fetched = 0
+
+        self._fetch = make_range_fetcher(url, self.transport, self.requestArgs, self.context, timeout)
+        self._cache = collections.OrderedDict()
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self._pool = None
+        self._pos = 0
+        self._last_end = None
+        self.size = self._get_size()
+
+    def _get_size(self):
+        urlObj = self.transport.open(self.url, self.requestArgs, context=self.context, timeout=self.timeout, startByte=0, endByte=1)
+        urlObj.close()
+        content_range = utils.parse_content_range(urlObj.headers.get('Content-Range'))
+        if urlObj.status != 206 or not content_range or content_range[2] is None:
+            raise io.UnsupportedOperation('"{}" does not support range requests.'.format(self.url))
+        return content_range[2]
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            pos = offset
+        elif whence == io.SEEK_CUR:
+            pos = self._pos + offset
+        elif whence == io.SEEK_END:
+            pos = self.size + offset
+        else:
+            raise ValueError("invalid whence ({}, should be 0, 1 or 2)".format(whence))
+        if pos < 0:
+            raise ValueError("negative seek position {}".format(pos))
+        self._pos = pos
+        return pos
+
+    def readinto(self, b):
+        if self.closed:
+            raise ValueError("I/O operation on closed file.")
+        n = min(len(b), self.size - self._pos)
+        if n <= 0:
+            return 0
+        start, end = self._pos, self._pos + n
+        sequential = start == self._last_end
+        first, last = start // self.block_size, (end-1) // self.block_size
+
+        view = memoryview(b)
+        for i, data in zip(range(first, last+1), self._get_blocks(first, last, self.readahead if sequential else 0)):
+            block_start = i * self.block_size
+            lo, hi = max(start, block_start), min(end, block_start + len(data))
+            view[lo-start:hi-start] = data[lo-block_start:hi-block_start]
+
+        self._pos = self._last_end = end
+        return n
+
+    def _get_blocks(self, first, last, readahead):
+        "Returns the blocks `first` to `last`. Missing blocks, and the readahead blocks, are fetched in parallel."
+        last_block = (self.size-1) // self.block_size
+        results = []
+        with self._lock:
+            for i in range(first, min(last+readahead, last_block)+1):
+                if i not in self._cache and i not in self._inflight:
+                    if self._pool is None:
+                        self._pool = futures.ThreadPoolExecutor(self.threads)
+                    self._inflight[i] = self._pool.submit(self._fetch_block, i)
+            for i in range(first, last+1):
+                if i in self._cache:
+                    self._cache.move_to_end(i)
+                    results.append(self._cache[i])
+                else:
+                    results.append(self._inflight[i])
+        return [r.result() if isinstance(r, futures.Future) else r for r in results]
+
+    def _fetch_block(self, i):
+        start = i * self.block_size
+        try:
+            data = self._fetch(start, min(start + self.block_size, self.size))
+        except Exception:
+            with self._lock:
+                self._inflight.pop(i, None)
+            raise
+        with self._lock:
+            self._inflight.pop(i, None)
+            self.requests += 1
+            self.bytes_fetched += len(data)
+            self._cache[i] = data
+            while len(self._cache) > self.cache_blocks:
+                self._cache.popitem(last=False)
+        return data
+
+    def close(self):
+        if self._pool:
+            self._pool.shutdown(wait=False)
+            self._pool = None
+        self._cache.clear()
+        super().close()
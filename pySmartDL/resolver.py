@@ -0,0 +1,284 @@
+'''
+Connection setup shared by all the transports: a process-wide DNS cache, and
+`RFC 8305 <https://tools.ietf.org/html/rfc8305>`_ ("Happy Eyeballs") connection racing,
+so a broken IPv6 (or IPv4) path doesn't stall a connection until the timeout.
+
+The system resolver doesn't expose the records' TTL, so cached entries expire after
+a fixed time (see `configure()`).
+'''
+
+import os
+import time
+import errno
+import socket
+import ssl
+import selectors
+import threading
+import http.client
+import collections
+
+from . import tls
+from . import metrics
+from . import tracing
+
+DNS_TTL = 60
+DNS_NEGATIVE_TTL = 5
+DNS_CACHE_SIZE = 1024  # entries
+HAPPY_EYEBALLS = True
+CONNECTION_ATTEMPT_DELAY = 0.25  # RFC 8305 recommends 250ms
+
+_IN_PROGRESS = (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EAGAIN, getattr(errno, 'WSAEWOULDBLOCK', errno.EWOULDBLOCK))
+
+def configure(dns_ttl=None, dns_negative_ttl=None, happy_eyeballs=None, connection_attempt_delay=None, dns_cache_size=None):
+    '''
+    Changes the process-wide connection settings. Arguments left as None are not changed.
+
+    :param dns_ttl: For how long resolved addresses are cached, in seconds. 0 disables the cache. Default is 60.
+    :type dns_ttl: int
+    :param dns_negative_ttl: For how long resolution failures are cached, in seconds. Default is 5.
+    :type dns_negative_ttl: int
+    :param happy_eyeballs: If true, races connection attempts to all the resolved addresses. Default is True.
+    :type happy_eyeballs: bool
+    :param connection_attempt_delay: Delay between two connection attempts, in seconds. Default is 0.25.
+    :type connection_attempt_delay: float
+    :param dns_cache_size: Maximum number of cached names. The oldest ones are dropped first. Default is 1024.
+    :type dns_cache_size: int
+    '''
+    global DNS_TTL, DNS_NEGATIVE_TTL, HAPPY_EYEBALLS, CONNECTION_ATTEMPT_DELAY, DNS_CACHE_SIZE
+    if dns_ttl is not None:
+        DNS_TTL = dns_ttl
+    if dns_negative_ttl is not None:
+        DNS_NEGATIVE_TTL = dns_negative_ttl
+    if happy_eyeballs is not None:
+        HAPPY_EYEBALLS = happy_eyeballs
+    if connection_attempt_delay is not None:
+        CONNECTION_ATTEMPT_DELAY = connection_attempt_delay
+    if dns_cache_size is not None:
+        DNS_CACHE_SIZE = dns_cache_size
+
+class DNSCache(object):
+    '''
+    A thread-safe cache of `socket.getaddrinfo` results. Expired entries are dropped when a name is
+    added, and the cache holds `DNS_CACHE_SIZE` names at most.
+    '''
+    def __init__(self):
+        self._cache = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._inflight = {}
+
+    def getaddrinfo(self, host, port):
+        key = (host, port)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry and entry[0] > now:
+                metrics.incr('dns_cache_hits')
+                if isinstance(entry[1], Exception):
+                    raise entry[1]
+                return entry[1]
+            # only one thread resolves a name at a time. the others wait for its result.
+            event = self._inflight.get(key)
+            leader = event is None
+            if leader:
+                event = self._inflight[key] = threading.Event()
+
+        if not leader:
+            event.wait()
+            return self.getaddrinfo(host, port)
+
+        metrics.incr('dns_cache_misses')
+        t1 = time.monotonic()
+        result = None
+        try:
+            result = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+            ttl = DNS_TTL
+        except socket.gaierror as e:
+            result = e
+            ttl = DNS_NEGATIVE_TTL
+        finally:
+            metrics.add_timing('dns_time', time.monotonic() - t1)
+            with self._lock:
+                if result is not None:
+                    self._add(key, (time.monotonic() + ttl, result))
+                del self._inflight[key]
+                event.set()
+
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def _add(self, key, entry):
+        # called with the lock held. the entries are kept in the order they were added, so the oldest are dropped first.
+        now = time.monotonic()
+        for k in [k for k, (expires, result) in self._cache.items() if expires <= now]:
+            del self._cache[k]
+        self._cache.pop(key, None)
+        self._cache[key] = entry
+        while len(self._cache) > max(DNS_CACHE_SIZE, 1):
+            self._cache.popitem(last=False)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._cache)
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+dns_cache = DNSCache()
+
+def _interleave(infos):
+    "Orders the addresses as RFC 8305 says: alternate between families, starting with the first family returned."
+    families = []
+    by_family = {}
+    for info in infos:
+        if info[0] not in by_family:
+            families.append(info[0])
+            by_family[info[0]] = []
+        by_family[info[0]].append(info)
+    result = []
+    while any(by_family.values()):
+        for family in families:
+            if by_family[family]:
+                result.append(by_family[family].pop(0))
+    return result
+
+def create_connection(address, timeout=socket._GLOBAL_DEFAULT_TIMEOUT, source_address=None):
+    '''
+    A drop-in replacement for `socket.create_connection`, that uses the DNS cache and
+    races the connection attempts to all the resolved addresses. The connect latency is
+    reported as the `connect_time` metric.
+    '''
+    host, port = address[:2]
+    if timeout is socket._GLOBAL_DEFAULT_TIMEOUT:
+        timeout = socket.getdefaulttimeout()
+    with tracing.span('dns', host=host):
+        if DNS_TTL > 0:
+            infos = dns_cache.getaddrinfo(host, port)
+        else:
+            infos = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+
+    t1 = time.monotonic()
+    with tracing.span('connect', host=host, port=port, addresses=len(infos)):
+        if HAPPY_EYEBALLS and len(infos) > 1:
+            sock = _race(_interleave(infos), timeout, source_address, t1)
+        else:
+            sock = _connect_sequential(infos, timeout, source_address)
+    metrics.add_timing('connect_time', time.monotonic() - t1)
+    metrics.incr('connections')
+    return sock
+
+def _connect_sequential(infos, timeout, source_address):
+    err = None
+    for family, type_, proto, _, sockaddr in infos:
+        sock = None
+        try:
+            sock = socket.socket(family, type_, proto)
+            if timeout is not None:
+                sock.settimeout(timeout)
+            if source_address:
+                sock.bind(source_address)
+            sock.connect(sockaddr)
+            return sock
+        except OSError as e:
+            err = e
+            if sock is not None:
+                sock.close()
+    raise err or OSError("getaddrinfo returns an empty list")
+
+def _race(infos, timeout, source_address, t1):
+    deadline = t1 + timeout if timeout is not None else None
+    sel = selectors.DefaultSelector()
+    pending = []
+    errors = []
+    winner = None
+    next_attempt = t1
+    i = 0
+    try:
+        while winner is None:
+            now = time.monotonic()
+            if i < len(infos) and now >= next_attempt:
+                family, type_, proto, _, sockaddr = infos[i]
+                i += 1
+                try:
+                    sock = socket.socket(family, type_, proto)
+                except OSError as e:
+                    errors.append(e)
+                    continue
+                try:
+                    sock.setblocking(False)
+                    if source_address:
+                        sock.bind(source_address)
+                    err = sock.connect_ex(sockaddr)
+                except OSError as e:
+                    err = e.errno
+                if err == 0:
+                    winner = sock
+                    break
+                if err not in _IN_PROGRESS:
+                    errors.append(OSError(err, os.strerror(err)))
+                    sock.close()
+                    continue  # failed right away. start the next attempt now.
+                sel.register(sock, selectors.EVENT_WRITE)
+                pending.append(sock)
+                next_attempt = now + CONNECTION_ATTEMPT_DELAY
+                continue
+
+            if not pending and i >= len(infos):
+                raise errors[-1] if errors else OSError("getaddrinfo returns an empty list")
+            if deadline is not None and now >= deadline:
+                raise socket.timeout('timed out')
+
+            wait = [deadline - now] if deadline is not None else []
+            if i < len(infos):
+                wait.append(next_attempt - now)
+            for key, _ in sel.select(min(wait) if wait else None):
+                sock = key.fileobj
+                sel.unregister(sock)
+                pending.remove(sock)
+                err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if err == 0:
+                    winner = sock
+                    break
+                errors.append(OSError(err, os.strerror(err)))
+                sock.close()
+                next_attempt = time.monotonic()  # an attempt failed. don't wait for the delay.
+    finally:
+        for sock in pending:
+            if sock is not winner:
+                sock.close()
+        sel.close()
+
+    winner.settimeout(timeout)
+    return winner
+
+class HTTPConnection(http.client.HTTPConnection):
+    "An `http.client.HTTPConnection` that connects through `create_connection()`."
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._create_connection = create_connection
+
+class HTTPSConnection(http.client.HTTPSConnection):
+    "An `http.client.HTTPSConnection` that connects through `create_connection()`, and resumes TLS sessions (see `pySmartDL.tls`)."
+    def __init__(self, *args, **kwargs):
+        if kwargs.get('context') is None:
+            kwargs['context'] = tls.get_ssl_context()
+        super().__init__(*args, **kwargs)
+        self._create_connection = create_connection
+
+    def connect(self):
+        http.client.HTTPConnection.connect(self)
+        self._server_hostname = self._tunnel_host or self.host
+        self.sock = tls.wrap_socket(self._context, self.sock, self._server_hostname, self.port)
+
+    def getresponse(self):
+        response = super().getresponse()
+        # with TLS 1.3, the session ticket comes after the handshake. it's known now.
+        if isinstance(self.sock, ssl.SSLSocket):
+            tls.save_session(self.sock, self._server_hostname, self.port)
+        return response
+
+    def close(self):
+        if isinstance(self.sock, ssl.SSLSocket):
+            tls.save_session(self.sock, self._server_hostname, self.port)
+        super().close()
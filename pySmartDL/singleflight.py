@@ -0,0 +1,169 @@
+'''
+Single-flight deduplication of downloads. When many `SmartDL` objects of the same process
+download the same file at the same time, only the first one (the leader) downloads it,
+and the others wait for it and share its result, errors included.
+
+Across processes, the leader holds an advisory lock on a file next to `dest` (`dest.lock`),
+and writes the result into it before releasing it. A process that finds the lock held
+waits for it, and reads the result. The lock file is left in place.
+'''
+
+import os
+import json
+import time
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+try:
+    import msvcrt
+except ImportError:
+    msvcrt = None
+
+class Flight(object):
+    "A download that other callers can wait for."
+    def __init__(self, key):
+        self.key = key
+        self.dest = None
+        self.done = threading.Event()
+        self.errors = []
+        self.failed = False
+        self.filesize = 0
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def add_done_callback(self, fn):
+        "Calls `fn()` when the flight lands, or right away if it already did."
+        with self._lock:
+            if not self.done.is_set():
+                self._callbacks.append(fn)
+                return
+        fn()
+
+    def _set_done(self):
+        with self._lock:
+            self.done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            fn()
+
+class FlightGroup(object):
+    '''
+    The running flights of the process, by key.
+    '''
+    def __init__(self):
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def join(self, key):
+        '''
+        Joins the flight of `key`, or starts it.
+
+        :returns: `(flight, leader)`. `leader` is True if the caller started the flight, and must `land()` it.
+        :rtype: tuple
+        '''
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight:
+                return flight, False
+            flight = self._flights[key] = Flight(key)
+            return flight, True
+
+    def land(self, flight, errors, failed, filesize):
+        "Ends a flight, and wakes up the callers that wait for it."
+        with self._lock:
+            if self._flights.get(flight.key) is flight:
+                del self._flights[flight.key]
+        flight.errors = list(errors)
+        flight.failed = failed
+        flight.filesize = filesize
+        flight._set_done()
+
+flights = FlightGroup()
+
+class FileLock(object):
+    '''
+    An advisory, exclusive lock on a file, that carries the result of the download.
+
+    :param path: Path of the lock file. Created if it doesn't exist.
+    :type path: string
+    '''
+    def __init__(self, path, poll_interval=0.1):
+        self.path = path
+        self.poll_interval = poll_interval
+        self.fd = None
+
+    def _try_lock(self, fd):
+        try:
+            if fcntl:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            elif msvcrt:
+                os.lseek(fd, 0, os.SEEK_SET)
+                msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+            return True
+        except OSError:
+            return False
+
+    def acquire(self, blocking=True, clear=False):
+        '''
+        Acquires the lock. Returns False if `blocking` is false and the lock is held by someone else.
+
+        :param clear: If true, the result of the previous holder is erased once the lock is acquired. The holder
+                      that does the download clears it, so if it dies, the processes that wait for it don't read an old result.
+        :type clear: bool
+        :rtype: bool
+        '''
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o666)
+        while not self._try_lock(fd):
+            if not blocking:
+                os.close(fd)
+                return False
+            if fcntl:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                break
+            time.sleep(self.poll_interval)
+        if clear:
+            os.ftruncate(fd, 0)
+        self.fd = fd
+        return True
+
+    def read_result(self):
+        '''
+        Returns the result written by the previous holder of the lock, or None.
+
+        :rtype: dict
+        '''
+        os.lseek(self.fd, 0, os.SEEK_SET)
+        data = b''
+        while True:
+            chunk = os.read(self.fd, 65536)
+            if not chunk:
+                break
+            data += chunk
+        try:
+            return json.loads(data.decode('utf-8'))
+        except ValueError:
+            return None
+
+    def release(self, result=None):
+        '''
+        Writes `result` (if given) into the lock file, and releases the lock.
+
+        :param result: A JSON-serializable dict.
+        :type result: dict
+        '''
+        fd, self.fd = self.fd, None
+        if fd is None:
+            return
+        try:
+            if result is not None:
+                os.ftruncate(fd, 0)
+                os.lseek(fd, 0, os.SEEK_SET)
+                os.write(fd, json.dumps(result).encode('utf-8'))
+            if msvcrt and not fcntl:
+                os.lseek(fd, 0, os.SEEK_SET)
+                msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+        finally:
+            os.close(fd)  # closing the file releases a flock() too.
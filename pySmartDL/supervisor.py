@@ -0,0 +1,137 @@
+'''
+The threads that run the downloads of the process. One supervisor thread tracks the
+progress, the completion and the post-processing of every running `SmartDL` object, and
+the range requests and the post-processing of all the downloads run in one shared,
+bounded thread pool. The number of threads doesn't grow with the number of downloads:
+when there are more ranges than workers, they wait in the pool's queue.
+
+The settings can be changed with `configure()` before the first download starts.
+
+.. NOTE::
+    The `process` engine runs the ranges in its own process pool. Its downloads are
+    supervised by the same thread.
+'''
+
+import time
+import threading
+from concurrent import futures
+
+from . import utils
+
+MAX_WORKERS = 64  # threads of the shared pool
+INTERVAL = 0.1  # seconds between two checks of the downloads
+
+def configure(max_workers=None, interval=None):
+    '''
+    Changes the process-wide supervisor settings. Arguments left as None are not changed.
+    The size of the pool can't be changed once it was created.
+
+    :param max_workers: Number of threads of the shared pool. Default is 64.
+    :type max_workers: int
+    :param interval: Seconds between two checks of the downloads. Default is 0.1.
+    :type interval: float
+    '''
+    global MAX_WORKERS, INTERVAL
+    if max_workers is not None:
+        if supervisor._executor is not None:
+            raise RuntimeError("the shared pool is already running")
+        MAX_WORKERS = max_workers
+    if interval is not None:
+        INTERVAL = interval
+
+class TaskGroup(utils.ManagedExecutorMixin):
+    '''
+    The futures of a single download, that run in the shared pool. Has the interface of
+    `pySmartDL.utils.ManagedThreadPoolExecutor`, but `shutdown()` only cancels the futures
+    of the group that didn't start yet.
+
+    :param executor: The pool that runs the futures.
+    :type executor: `concurrent.futures.Executor` instance
+    '''
+    def __init__(self, executor):
+        self._executor = executor
+        self._futures = []
+        self._shutdown = False
+
+    def submit(self, fn, *args, **kwargs):
+        if self._shutdown:
+            raise RuntimeError('cannot schedule new futures after shutdown')
+        future = self._executor.submit(fn, *args, **kwargs)
+        self._futures.append(future)
+        return future
+
+    def shutdown(self, wait=True):
+        self._shutdown = True
+        for future in self._futures:
+            future.cancel()
+        if wait:
+            futures.wait(self._futures)
+
+class Supervisor(object):
+    '''
+    Calls `tick()` of the watched objects every `INTERVAL` seconds, on a single daemon
+    thread, until it returns True. The thread is started by the first `watch()`, and
+    sleeps while there's nothing to watch.
+    '''
+    def __init__(self):
+        self._watched = []
+        self._cond = threading.Condition()
+        self._thread = None
+        self._executor = None
+        self._executor_lock = threading.Lock()
+
+    def executor(self):
+        '''
+        Returns the shared pool, and creates it on the first call.
+
+        :rtype: `concurrent.futures.ThreadPoolExecutor` instance
+        '''
+        with self._executor_lock:
+            if self._executor is None:
+                try:
+                    self._executor = futures.ThreadPoolExecutor(MAX_WORKERS, thread_name_prefix='pySmartDL')
+                except TypeError:  # python < 3.6 can't name the threads
+                    self._executor = futures.ThreadPoolExecutor(MAX_WORKERS)
+            return self._executor
+
+    def submit(self, fn, *args, **kwargs):
+        "Runs `fn(*args, **kwargs)` in the shared pool."
+        return self.executor().submit(fn, *args, **kwargs)
+
+    def watch(self, obj):
+        '''
+        Starts calling `obj.tick()` periodically. `obj.abort(e)` is called if `tick()` raises an exception.
+        '''
+        with self._cond:
+            self._watched.append(obj)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='pySmartDL-supervisor')
+                self._thread.daemon = True
+                self._thread.start()
+            self._cond.notify()
+
+    def get_watched(self):
+        with self._cond:
+            return list(self._watched)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._watched:
+                    self._cond.wait()
+                watched = list(self._watched)
+
+            done = []
+            for obj in watched:
+                try:
+                    if obj.tick():
+                        done.append(obj)
+                except Exception as e:
+                    done.append(obj)
+                    obj.abort(e)
+
+            with self._cond:
+                self._watched = [obj for obj in self._watched if obj not in done]
+            time.sleep(INTERVAL)
+
+supervisor = Supervisor()
@@ -0,0 +1,141 @@
+'''
+Manifest-driven directory sync. A manifest lists the files of a remote tree, and only
+the files that are missing or changed locally are downloaded.
+
+A manifest is a list of dicts with the keys:
+
+* ``path`` - the path of the file, relative to the local root.
+* ``url`` - where to download it from.
+* ``size`` - size in bytes (optional).
+* ``hash`` - hex digest of the file (optional). The algorithm is `hash_algorithm`, or the entry's ``hash_algorithm`` key.
+* ``mtime`` - modification time, as a unix timestamp (optional).
+
+A local file is unchanged if its size matches, and either its mtime matches or its hash
+matches (hashes are calculated in parallel). Synced files get the manifest's mtime, so the
+next sync doesn't hash them again.
+
+Usage::
+
+	from pySmartDL import sync
+
+	summary = sync.sync(sync.load_manifest('manifest.json'), '/data/models')
+	print("{} saved".format(summary['bytes_saved']))
+'''
+
+import os
+import json
+from concurrent import futures
+
+from . import utils
+from .pySmartDL import SmartDL
+from .transport import HTTPClientTransport
+
+def load_manifest(path):
+    '''
+    Loads a JSON manifest: either a list of entries, or a dict with the list under `files`.
+
+    :param path: Path of the manifest file.
+    :type path: string
+    :rtype: list of dicts
+    '''
+    with open(path, 'r') as f:
+        data = json.load(f)
+    if isinstance(data, dict):
+        data = data['files']
+    return data
+
+def _local_path(root, path):
+    full = os.path.realpath(os.path.join(root, path))
+    if not full.startswith(os.path.realpath(root) + os.sep):
+        raise ValueError("Manifest path {!r} is outside of {}".format(path, root))
+    return full
+
+def _check(entry, path, hash_algorithm):
+    '''
+    Returns `(changed, hashed)`. `hashed` is true if the file had to be hashed.
+    '''
+    try:
+        st = os.stat(path)
+    except OSError:
+        return True, False
+    if entry.get('size') is not None and st.st_size != entry['size']:
+        return True, False
+    if entry.get('mtime') is not None and abs(st.st_mtime - entry['mtime']) < 1:
+        return False, False
+    if entry.get('hash'):
+        algorithm = entry.get('hash_algorithm', hash_algorithm)
+        return utils.get_file_hash(algorithm, path).lower() != entry['hash'].lower(), True
+    # no hash to compare with. the size is all we can check.
+    return entry.get('size') is None, False
+
+def sync(manifest, root, hash_algorithm='sha256', max_concurrent=4, threads=5, hash_workers=4, transport=None, request_args=None, verify=True, timeout=5, logger=None):
+    '''
+    Syncs a local folder with a manifest.
+
+    :param manifest: The manifest entries.
+    :type manifest: list of dicts
+    :param root: The local folder. Created if it doesn't exist.
+    :type root: string
+    :param hash_algorithm: The algorithm of the manifest's hashes. Default is `sha256`.
+    :type hash_algorithm: string
+    :param max_concurrent: Maximum number of files downloaded at once. Default is 4.
+    :type max_concurrent: int
+    :param threads: Number of connections per file. Default is 5.
+    :type threads: int
+    :param hash_workers: Number of files hashed in parallel. Default is 4.
+    :type hash_workers: int
+    :param transport: The transport shared by all the downloads. Default is a new `pySmartDL.transport.HTTPClientTransport`, so connections are kept alive and reused between files.
+    :type transport: `pySmartDL.transport.Transport` instance
+    :returns: A summary dict with the keys `files`, `unchanged`, `downloaded`, `failed`, `hashed` (number of files), `bytes_downloaded`, `bytes_saved` (the size of the unchanged files) and `errors` (a dict of path to exception).
+    :rtype: dict
+    '''
+    logger = logger or utils.DummyLogger()
+    own_transport = transport is None
+    transport = transport or HTTPClientTransport()
+    os.makedirs(root, exist_ok=True)
+
+    summary = {'files': len(manifest), 'unchanged': 0, 'downloaded': 0, 'failed': 0, 'hashed': 0,
+               'bytes_downloaded': 0, 'bytes_saved': 0, 'errors': {}}
+
+    paths = [_local_path(root, entry['path']) for entry in manifest]
+    with futures.ThreadPoolExecutor(hash_workers) as pool:
+        checks = list(pool.map(lambda args: _check(args[0], args[1], hash_algorithm), zip(manifest, paths)))
+
+    todo = []
+    for entry, path, (changed, hashed) in zip(manifest, paths, checks):
+        summary['hashed'] += hashed
+        if changed:
+            todo.append((entry, path))
+        else:
+            summary['unchanged'] += 1
+            summary['bytes_saved'] += os.path.getsize(path)
+            if hashed and entry.get('mtime') is not None:
+                os.utime(path, (entry['mtime'], entry['mtime']))
+    logger.info("{} of {} files are unchanged. Downloading {} files...".format(summary['unchanged'], len(manifest), len(todo)))
+
+    def fetch(entry, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        obj = SmartDL(entry['url'], dest=path, progress_bar=False, threads=threads, timeout=timeout, logger=logger,
+                      request_args=request_args, verify=verify, transport=transport, probe_mirrors=False)
+        if entry.get('hash'):
+            obj.add_hash_verification(entry.get('hash_algorithm', hash_algorithm), entry['hash'])
+        obj.start()
+        if entry.get('mtime') is not None:
+            os.utime(path, (entry['mtime'], entry['mtime']))
+        return obj.get_dl_size()
+
+    try:
+        with futures.ThreadPoolExecutor(max_concurrent) as pool:
+            jobs = [(entry, pool.submit(fetch, entry, path)) for entry, path in todo]
+            for entry, job in jobs:
+                try:
+                    summary['bytes_downloaded'] += job.result()
+                    summary['downloaded'] += 1
+                except Exception as e:
+                    logger.warning('Failed to sync "{}": {}'.format(entry['path'], e))
+                    summary['failed'] += 1
+                    summary['errors'][entry['path']] = e
+    finally:
+        if own_transport:
+            transport.close()
+    return summary
@@ -0,0 +1,139 @@
+'''
+Transfer telemetry. The byte counters of a download (the total, and one per connection)
+are sampled against monotonic timestamps into fixed-size ring buffers, and the speed is
+an exponentially weighted moving average of the measured rates. Every rate is weighted
+by the actual time between two samples, so a late sample doesn't skew the estimate.
+'''
+
+import time
+import array
+
+HISTORY_SIZE = 1200  # 2 minutes of samples, at 10 samples per second
+
+class RingBuffer(object):
+    '''
+    A fixed-size ring of `(timestamp, value)` samples, kept in two `array` objects.
+
+    :param capacity: Maximum number of samples. Older samples are overwritten.
+    :type capacity: int
+    '''
+    def __init__(self, capacity=HISTORY_SIZE):
+        self.capacity = capacity
+        self.times = array.array('d', [0.0]) * capacity
+        self.values = array.array('q', [0]) * capacity
+        self._next = 0
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def append(self, t, value):
+        self.times[self._next] = t
+        self.values[self._next] = value
+        self._next = (self._next + 1) % self.capacity
+        self._count = min(self._count + 1, self.capacity)
+
+    def last(self):
+        i = (self._next - 1) % self.capacity
+        return self.times[i], self.values[i]
+
+    def first(self):
+        i = (self._next - self._count) % self.capacity
+        return self.times[i], self.values[i]
+
+    def samples(self):
+        '''
+        Returns the samples, oldest first.
+
+        :rtype: list of `(timestamp, value)` tuples
+        '''
+        start = (self._next - self._count) % self.capacity
+        return [(self.times[(start + i) % self.capacity], self.values[(start + i) % self.capacity]) for i in range(self._count)]
+
+class SpeedEstimator(object):
+    '''
+    Estimates the speed of a growing byte counter.
+
+    :param halflife: Rates older than this many seconds weigh half as much. Default is 2.
+    :type halflife: float
+    :param capacity: Size of the ring buffer of samples.
+    :type capacity: int
+    '''
+    def __init__(self, halflife=2.0, capacity=HISTORY_SIZE):
+        self.halflife = halflife
+        self.history = RingBuffer(capacity)
+        self.speed = 0.0
+        self._rates = 0
+
+    def update(self, value, now=None):
+        '''
+        Adds a sample of the counter, and returns the new speed estimate in bytes per second.
+        '''
+        now = time.monotonic() if now is None else now
+        if len(self.history):
+            t0, v0 = self.history.last()
+            dt = now - t0
+            if dt <= 0:
+                return self.speed
+            if value >= v0:  # the counter goes down if a worker failed. skip that sample.
+                rate = (value - v0) / dt
+                if self._rates:
+                    alpha = 1 - 0.5 ** (dt / self.halflife)
+                    self.speed += alpha * (rate - self.speed)
+                else:
+                    self.speed = rate
+                self._rates += 1
+        self.history.append(now, value)
+        return self.speed
+
+    def elapsed(self):
+        "Returns the time covered by the samples, in seconds."
+        if not len(self.history):
+            return 0
+        return self.history.last()[0] - self.history.first()[0]
+
+    def eta(self, remaining):
+        "Returns the estimated time to download `remaining` bytes, in seconds. 0 if the speed is unknown."
+        if self.speed <= 0 or remaining <= 0:
+            return 0
+        return remaining / self.speed
+
+class Telemetry(object):
+    '''
+    The telemetry of a download: a `SpeedEstimator` for the total, and one per connection.
+
+    :param counters: The per-connection byte counters.
+    :type counters: a sequence of ints, such as `pySmartDL.process_engine.SharedCounters.array`
+    '''
+    def __init__(self, counters, halflife=2.0, capacity=HISTORY_SIZE):
+        self.counters = counters
+        self.start_time = time.monotonic()
+        self.total = SpeedEstimator(halflife, capacity)
+        self.connections = [SpeedEstimator(halflife, capacity) for _ in range(len(counters))]
+
+    def sample(self, now=None):
+        '''
+        Samples all the counters, and returns the total speed estimate.
+        '''
+        now = time.monotonic() if now is None else now
+        values = list(self.counters)
+        for estimator, value in zip(self.connections, values):
+            estimator.update(value, now)
+        return self.total.update(sum(values), now)
+
+    def export(self):
+        '''
+        Returns the raw time series. Timestamps are in seconds since the telemetry started.
+
+        :returns: A dict with the keys `total` and `connections`. Each series is a dict with the keys `speed` (the current estimate) and `samples` (a list of `(timestamp, bytes)` tuples).
+        :rtype: dict
+        '''
+        def series(estimator):
+            return {
+                'speed': estimator.speed,
+                'samples': [(t - self.start_time, v) for t, v in estimator.history.samples()],
+            }
+        return {
+            'total': series(self.total),
+            'connections': [series(e) for e in self.connections],
+        }
@@ -0,0 +1,128 @@
+'''
+TLS setup shared by all the transports: one cached `ssl.SSLContext` per verify/CA
+setting, and a cache of TLS sessions, so the range connections (and the mirrors on the
+same host) resume the session of a previous connection instead of doing a full handshake.
+
+The number of full and resumed handshakes are reported as the `tls_full_handshakes` and
+`tls_resumed_handshakes` metrics, and their latency as `tls_handshake_time`.
+'''
+
+import ssl
+import time
+import threading
+import collections
+
+from . import metrics
+from . import tracing
+
+SESSION_CACHE_SIZE = 256
+
+_contexts = {}
+_context_keys = {}
+_lock = threading.Lock()
+
+def get_ssl_context(verify=True, cafile=None, capath=None, alpn_protocols=None):
+    '''
+    Returns the process-wide SSL context for the given settings, creating it if needed.
+    The returned context is shared, and must not be modified.
+
+    :param verify: If ssl certificates should be validated. Default is True.
+    :type verify: bool
+    :param cafile: A file of CA certificates to trust, as `ssl.create_default_context()` takes it.
+    :type cafile: string
+    :param capath: A folder of CA certificates to trust.
+    :type capath: string
+    :param alpn_protocols: Protocols to offer with ALPN.
+    :type alpn_protocols: tuple of strings
+    :rtype: `ssl.SSLContext` instance
+    '''
+    key = (bool(verify), cafile, capath, tuple(alpn_protocols) if alpn_protocols else None)
+    with _lock:
+        context = _contexts.get(key)
+        if context is None:
+            context = ssl.create_default_context(cafile=cafile, capath=capath)
+            if not verify:
+                context.check_hostname = False
+                context.verify_mode = ssl.CERT_NONE
+            if alpn_protocols:
+                context.set_alpn_protocols(list(alpn_protocols))
+            _contexts[key] = context
+            _context_keys[id(context)] = key
+        return context
+
+def with_alpn(context, alpn_protocols):
+    '''
+    Returns a context like `context` that offers `alpn_protocols`. Shared contexts (and None)
+    are replaced by the matching shared context; other contexts are modified in place.
+
+    :rtype: `ssl.SSLContext` instance
+    '''
+    if context is None:
+        return get_ssl_context(alpn_protocols=alpn_protocols)
+    with _lock:
+        key = _context_keys.get(id(context))
+    if key is not None and _contexts.get(key) is context:
+        return get_ssl_context(key[0], key[1], key[2], alpn_protocols)
+    context.set_alpn_protocols(list(alpn_protocols))
+    return context
+
+class SessionCache(object):
+    '''
+    A thread-safe cache of the last TLS session of every (context, host, port).
+    Sessions can only be resumed with the context that created them.
+    '''
+    def __init__(self, size=SESSION_CACHE_SIZE):
+        self.size = size
+        self._sessions = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, context, host, port):
+        with self._lock:
+            entry = self._sessions.get((id(context), host, port))
+        # the context is kept with the session, in case the id was reused by another context.
+        if entry and entry[0] is context:
+            return entry[1]
+        return None
+
+    def put(self, context, host, port, session):
+        if session is None:
+            return
+        key = (id(context), host, port)
+        with self._lock:
+            self._sessions.pop(key, None)
+            self._sessions[key] = (context, session)
+            while len(self._sessions) > self.size:
+                self._sessions.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._sessions.clear()
+
+session_cache = SessionCache()
+
+def wrap_socket(context, sock, server_hostname, port):
+    '''
+    Does the TLS handshake on a connected socket, resuming a cached session if there is one.
+
+    :rtype: `ssl.SSLSocket` instance
+    '''
+    session = session_cache.get(context, server_hostname, port)
+    t1 = time.monotonic()
+    with tracing.span('tls_handshake', host=server_hostname) as span_args:
+        # if the server doesn't accept the session, it simply does a full handshake.
+        sslsock = context.wrap_socket(sock, server_hostname=server_hostname, session=session)
+        span_args['resumed'] = sslsock.session_reused
+    metrics.add_timing('tls_handshake_time', time.monotonic() - t1)
+    metrics.incr('tls_resumed_handshakes' if sslsock.session_reused else 'tls_full_handshakes')
+    session_cache.put(context, server_hostname, port, sslsock.session)
+    return sslsock
+
+def save_session(sslsock, server_hostname, port):
+    '''
+    Stores the session of a socket that's about to be closed. With TLS 1.3, the session
+    ticket arrives after the handshake, so it's only known once data was read.
+    '''
+    try:
+        session_cache.put(sslsock.context, server_hostname, port, sslsock.session)
+    except (AttributeError, ValueError, OSError):
+        pass
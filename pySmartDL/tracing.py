@@ -0,0 +1,222 @@
+'''
+Optional span tracing, to see where the time of a download goes: DNS, connect, TLS,
+time to first byte, the read loop, disk writes, retries, combining, hashing...
+
+Like `pySmartDL.metrics`, a `Tracer` is bound to the threads that work for a download,
+and the code records spans with `span()`. When no tracer is bound, `span()` returns a
+shared no-op context manager, so tracing costs almost nothing when it's disabled.
+
+Usage::
+
+	from pySmartDL import SmartDL
+	from pySmartDL.tracing import Tracer
+
+	tracer = Tracer()
+	obj = SmartDL(url, dest, tracer=tracer)
+	obj.start()
+	tracer.export_chrome('trace.json')  # open it in https://ui.perfetto.dev
+
+The recorded spans are:
+
+* ``smartdl`` - a whole download, from `start()` to the end.
+* ``range_probe``, ``probe`` - the requests that check for range support, and get the filesize.
+* ``size_probe`` - the requests that look for the filesize, if the response has no `Content-Length`.
+* ``range`` - a range worker (``single_request`` for small files, that are downloaded with the probe request).
+* ``request`` - opening a request, up to the response headers (the time to first byte). Contains ``dns``, ``connect`` and ``tls_handshake`` if a new connection was made.
+* ``read`` - the read loop. The time spent in disk writes is attached as the ``write_time`` argument.
+* ``retry`` - the sleep before a request is retried after a HTTP 416, 429 or 503 error.
+* ``combine``, ``hash``, ``extract`` - the actions after the download.
+
+.. NOTE::
+    Spans are not collected from the workers of the `process` engine.
+'''
+
+import os
+import json
+import time
+import threading
+import contextlib
+
+_local = threading.local()
+
+class Span(object):
+    '''
+    A finished span. `start` and `end` are unix timestamps, in seconds.
+    '''
+    __slots__ = ('name', 'category', 'start', 'end', 'thread_id', 'thread_name', 'args')
+
+    def __init__(self, name, category, start, end, thread_id, thread_name, args):
+        self.name = name
+        self.category = category
+        self.start = start
+        self.end = end
+        self.thread_id = thread_id
+        self.thread_name = thread_name
+        self.args = args
+
+    @property
+    def duration(self):
+        return self.end - self.start
+
+    def __repr__(self):
+        return "<Span {} {:.3f}ms>".format(self.name, self.duration*1000)
+
+class Tracer(object):
+    '''
+    Collects spans. A tracer can be shared by many downloads, to see them on one timeline.
+
+    :param on_span: A function that is called with every finished `Span` (for example, to forward it to OpenTelemetry).
+    :param keep_spans: If true, the spans are kept for `get_spans()` and `export_chrome()`. Default is True.
+    :type keep_spans: bool
+    '''
+    def __init__(self, on_span=None, keep_spans=True):
+        self.on_span = on_span
+        self.keep_spans = keep_spans
+        self.spans = []
+        self._lock = threading.Lock()
+        # perf_counter is precise, time.time is comparable between processes.
+        self._epoch = time.time() - time.perf_counter()
+
+    def now(self):
+        return self._epoch + time.perf_counter()
+
+    def add_span(self, name, start, end, args=None, category='pySmartDL'):
+        '''
+        Records a span that was timed by the caller.
+
+        :param args: Arguments attached to the span.
+        :type args: dict
+        '''
+        thread = threading.current_thread()
+        s = Span(name, category, start, end, thread.ident, thread.name, args or {})
+        if self.keep_spans:
+            with self._lock:
+                self.spans.append(s)
+        if self.on_span:
+            self.on_span(s)
+        return s
+
+    @contextlib.contextmanager
+    def span(self, name, category='pySmartDL', **args):
+        '''
+        A context manager that records a span. Arguments are attached to the span;
+        the yielded dict can be updated to attach more.
+        '''
+        start = self.now()
+        try:
+            yield args
+        finally:
+            self.add_span(name, start, self.now(), args, category)
+
+    def get_spans(self):
+        with self._lock:
+            return list(self.spans)
+
+    def export_chrome(self, path=None):
+        '''
+        Exports the spans in the Chrome trace event format, viewable in `Perfetto <https://ui.perfetto.dev>`_
+        or `chrome://tracing`.
+
+        :param path: If given, the trace is written to this file.
+        :type path: string
+        :returns: The trace.
+        :rtype: dict
+        '''
+        spans = self.get_spans()
+        t0 = min([s.start for s in spans]) if spans else 0
+        pid = os.getpid()
+        events = []
+        threads = {}
+        for s in spans:
+            threads[s.thread_id] = s.thread_name
+            events.append({
+                'name': s.name,
+                'cat': s.category,
+                'ph': 'X',
+                'ts': (s.start - t0) * 1e6,
+                'dur': (s.end - s.start) * 1e6,
+                'pid': pid,
+                'tid': s.thread_id,
+                'args': dict((k, v if isinstance(v, (int, float, bool)) or v is None else str(v)) for k, v in s.args.items()),
+            })
+        for tid, name in threads.items():
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': name}})
+        trace = {'traceEvents': events, 'displayTimeUnit': 'ms'}
+        if path:
+            with open(path, 'w') as f:
+                json.dump(trace, f)
+        return trace
+
+class _NullSpan(object):
+    "The span returned when tracing is disabled."
+    def __enter__(self):
+        return {}
+
+    def __exit__(self, *args):
+        return False
+
+_NULL_SPAN = _NullSpan()
+
+@contextlib.contextmanager
+def bind(tracer):
+    '''
+    Binds a `Tracer` to the current thread for the duration of the `with` block.
+    '''
+    prev = getattr(_local, 'tracer', None)
+    _local.tracer = tracer
+    try:
+        yield tracer
+    finally:
+        _local.tracer = prev
+
+def current():
+    '''
+    Returns the `Tracer` bound to the current thread, or None.
+    '''
+    return getattr(_local, 'tracer', None)
+
+def span(name, **args):
+    '''
+    Records a span with the tracer bound to the current thread, if any.
+    '''
+    tracer = getattr(_local, 'tracer', None)
+    if tracer is None:
+        return _NULL_SPAN
+    return tracer.span(name, **args)
+
+def wrap(tracer, fn, name=None, **args):
+    '''
+    Returns a function that runs `fn` with `tracer` bound to the thread, in a span if `name` is given.
+    Returns `fn` itself if `tracer` is None.
+    '''
+    if tracer is None:
+        return fn
+    def wrapper(*a, **kw):
+        with bind(tracer), (tracer.span(name, **args) if name else _NULL_SPAN):
+            return fn(*a, **kw)
+    return wrapper
+
+class TimedFile(object):
+    '''
+    Wraps a file object, and counts the time spent in `write()` as `write_time`.
+    '''
+    def __init__(self, f):
+        self.f = f
+        self.write_time = 0
+
+    def write(self, data):
+        t1 = time.perf_counter()
+        try:
+            return self.f.write(data)
+        finally:
+            self.write_time += time.perf_counter() - t1
+
+    def __getattr__(self, name):
+        return getattr(self.f, name)
+
+    def __enter__(self):
+        self.f.__enter__()
+        return self
+
+    def __exit__(self, *args):
+        return self.f.__exit__(*args)
@@ -0,0 +1,387 @@
+'''
+Transports do the actual network I/O of pySmartDL. A transport opens a
+(possibly ranged) request and returns a response object that exposes:
+
+* ``status`` - the HTTP status code.
+* ``headers`` - the response headers (supports ``headers["Content-Length"]`` and ``headers.get()``).
+* ``url`` - the final url of the response, after redirects.
+* ``read(n)`` and ``readinto(buffer)`` - read the body.
+* ``close()`` - release the connection.
+
+HTTP errors are raised as `urllib.error.HTTPError`, exactly as `urllib.request.urlopen` does,
+so every transport can be used interchangeably. Other clients (e.g. pycurl) can be plugged in
+by subclassing `Transport`.
+'''
+
+import io
+import gzip
+import socket
+import threading
+import http.client
+import urllib.request, urllib.error, urllib.parse
+
+try:
+    import urllib3
+except ImportError:
+    urllib3 = None
+
+from . import resolver
+
+REDIRECT_CODES = (301, 302, 303, 307, 308)
+
+def make_range_header(startByte=0, endByte=None):
+    '''
+    Returns the value of a `Range` header, or None if no range is needed.
+
+    :param startByte: First byte to fetch.
+    :type startByte: int
+    :param endByte: Last byte to fetch (inclusive). If None or 0, fetches until EOF.
+    :type endByte: int
+    :rtype: string
+    '''
+    if endByte:
+        return 'bytes={:.0f}-{:.0f}'.format(startByte, endByte)
+    if startByte:
+        return 'bytes={:.0f}-'.format(startByte)
+    return None
+
+class Transport(object):
+    '''
+    Base class for all transports.
+    '''
+    def open(self, url, requestArgs=None, context=None, timeout=None, startByte=0, endByte=None):
+        '''
+        Opens a request and returns a response object.
+
+        :param url: Url address.
+        :type url: string
+        :param requestArgs: Arguments of the request, in the form accepted by `urllib.request.Request` (`headers`, `data`, `method`).
+        :type requestArgs: dict
+        :param context: SSL context. None uses the default context.
+        :type context: `ssl.SSLContext` instance
+        :param timeout: Timeout in seconds.
+        :type timeout: int
+        :param startByte: First byte to fetch.
+        :type startByte: int
+        :param endByte: Last byte to fetch (inclusive). If None or 0, fetches until EOF.
+        :type endByte: int
+        '''
+        raise NotImplementedError
+
+    def close(self):
+        '''
+        Releases any resources (such as pooled connections) held by the transport.
+        '''
+        pass
+
+    def _headers(self, requestArgs, startByte, endByte):
+        headers = dict((requestArgs or {}).get('headers', {}))
+        range_header = make_range_header(startByte, endByte)
+        if range_header:
+            headers['Range'] = range_header
+        return headers
+
+class _HTTPHandler(urllib.request.HTTPHandler):
+    def http_open(self, req):
+        return self.do_open(resolver.HTTPConnection, req)
+
+class _HTTPSHandler(urllib.request.HTTPSHandler):
+    def https_open(self, req):
+        return self.do_open(resolver.HTTPSConnection, req, context=self._context)
+
+class UrllibTransport(Transport):
+    '''
+    The default transport. Uses `urllib.request`, so proxies and the
+    other default urllib handlers are respected. Connections go through
+    `pySmartDL.resolver` (DNS cache and Happy Eyeballs).
+    '''
+    def __init__(self):
+        self._openers = {}
+        self._lock = threading.Lock()
+
+    def _opener(self, context):
+        with self._lock:
+            entry = self._openers.get(id(context))
+            if entry is None or entry[0] is not context:
+                entry = self._openers[id(context)] = (context, urllib.request.build_opener(_HTTPHandler, _HTTPSHandler(context=context)))
+            return entry[1]
+
+    def __getstate__(self):
+        return {}
+
+    def __setstate__(self, state):
+        self.__init__()
+
+    def open(self, url, requestArgs=None, context=None, timeout=None, startByte=0, endByte=None):
+        requestArgs = dict(requestArgs or {})
+        requestArgs['headers'] = self._headers(requestArgs, startByte, endByte)
+        req = urllib.request.Request(url, **requestArgs)
+        return self._opener(context).open(req, timeout=timeout)
+
+class Response(io.RawIOBase):
+    '''
+    A generic response object, used by the non-urllib transports.
+    '''
+    def __init__(self, url, status, headers, fp, release=None):
+        self.url = url
+        self.status = self.code = status
+        self.headers = headers
+        self._fp = fp
+        self._release = release
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        return self._fp.readinto(b)
+
+    def read(self, n=-1):
+        if n is None or n < 0:
+            return self._fp.read()
+        return self._fp.read(n)
+
+    def info(self):
+        return self.headers
+
+    def geturl(self):
+        return self.url
+
+    def getcode(self):
+        return self.status
+
+    def close(self):
+        if not self.closed:
+            if self._release:
+                self._release()
+            else:
+                self._fp.close()
+        super().close()
+
+def _http_error(url, code, reason, headers, fp=None):
+    return urllib.error.HTTPError(url, code, reason, headers, fp)
+
+class HTTPClientTransport(Transport):
+    '''
+    A transport built directly on `http.client`. Keeps a pool of keep-alive
+    connections per host, and reads the body with `readinto` into the caller's buffer.
+
+    .. NOTE::
+        Proxies are not supported by this transport.
+
+    :param max_redirects: Maximum number of redirects to follow. Default is 10.
+    :type max_redirects: int
+    '''
+    def __init__(self, max_redirects=10):
+        self.max_redirects = max_redirects
+        self._pool = {}
+        self._lock = threading.Lock()
+
+    def _connection_class(self, scheme):
+        return resolver.HTTPSConnection if scheme == 'https' else resolver.HTTPConnection
+
+    def _new_connection(self, scheme, host, port, context, timeout):
+        if scheme == 'https':
+            return self._connection_class(scheme)(host, port, timeout=timeout, context=context)
+        return self._connection_class(scheme)(host, port, timeout=timeout)
+
+    def _get_connection(self, key, context, timeout):
+        with self._lock:
+            conns = self._pool.get(key)
+            if conns:
+                conn = conns.pop()
+                conn.timeout = timeout
+                if conn.sock:
+                    conn.sock.settimeout(timeout)
+                return conn, True
+        scheme, host, port = key[:3]
+        return self._new_connection(scheme, host, port, context, timeout), False
+
+    def __getstate__(self):
+        # connections can't be shared with other processes; a copy starts with an empty pool.
+        return {'max_redirects': self.max_redirects}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def _put_connection(self, key, conn):
+        with self._lock:
+            self._pool.setdefault(key, []).append(conn)
+
+    def open(self, url, requestArgs=None, context=None, timeout=None, startByte=0, endByte=None):
+        requestArgs = requestArgs or {}
+        headers = self._headers(requestArgs, startByte, endByte)
+        data = requestArgs.get('data')
+        method = requestArgs.get('method') or ('POST' if data is not None else 'GET')
+
+        for i in range(self.max_redirects+1):
+            parsed = urllib.parse.urlsplit(url)
+            scheme = parsed.scheme.lower()
+            if scheme not in ('http', 'https'):
+                raise urllib.error.URLError('unknown url type: {}'.format(scheme))
+            port = parsed.port or (443 if scheme == 'https' else 80)
+            key = (scheme, parsed.hostname, port, id(context))
+            path = parsed.path or '/'
+            if parsed.query:
+                path += '?' + parsed.query
+
+            conn, reused = self._get_connection(key, context, timeout)
+            try:
+                conn.request(method, path, body=data, headers=headers)
+                resp = conn.getresponse()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                conn.close()
+                if not reused:
+                    raise
+                # the server closed an idle keep-alive connection. try again with a fresh one.
+                conn = self._new_connection(scheme, parsed.hostname, port, context, timeout)
+                conn.request(method, path, body=data, headers=headers)
+                resp = conn.getresponse()
+            except socket.timeout:
+                conn.close()
+                raise
+            except OSError as e:
+                conn.close()
+                raise urllib.error.URLError(e)
+
+            if resp.status in REDIRECT_CODES and resp.getheader('Location'):
+                resp.read()
+                self._put_connection(key, conn)
+                url = urllib.parse.urljoin(url, resp.getheader('Location'))
+                if resp.status == 303:
+                    method, data = 'GET', None
+                continue
+
+            release = self._releaser(key, conn, resp)
+            if resp.status >= 400:
+                response = Response(url, resp.status, resp.headers, resp, release)
+                raise _http_error(url, resp.status, resp.reason, resp.headers, response)
+            return Response(url, resp.status, resp.headers, resp, release)
+
+        raise _http_error(url, resp.status, 'Too many redirects', resp.headers)
+
+    def _releaser(self, key, conn, resp):
+        def release():
+            # A connection can only be reused if the body was read completely.
+            if resp.isclosed() and not resp.will_close:
+                self._put_connection(key, conn)
+            else:
+                resp.close()
+                conn.close()
+        return release
+
+    def close(self):
+        with self._lock:
+            pool, self._pool = self._pool, {}
+        for conns in pool.values():
+            for conn in conns:
+                conn.close()
+
+class Urllib3Transport(Transport):
+    '''
+    A transport that uses `urllib3 <https://urllib3.readthedocs.io/>`_ connection pools.
+    Requires the urllib3 package.
+
+    :param maxsize: Maximum number of connections kept per host. Default is 10.
+    :type maxsize: int
+    '''
+    def __init__(self, maxsize=10):
+        if not urllib3:
+            raise ImportError("Urllib3Transport requires the urllib3 package.")
+        self.maxsize = maxsize
+        self._managers = {}
+        self._lock = threading.Lock()
+        # only the redirects are followed. failed connections and reads are retried by SmartDL, like with the other transports.
+        self._retries = urllib3.Retry(total=None, connect=0, read=0, status=0, other=0, redirect=10, raise_on_redirect=True)
+
+    def __getstate__(self):
+        return {'maxsize': self.maxsize}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def _manager(self, context):
+        with self._lock:
+            if id(context) not in self._managers:
+                kwargs = {'maxsize': self.maxsize}
+                if context:
+                    kwargs['ssl_context'] = context
+                self._managers[id(context)] = urllib3.PoolManager(**kwargs)
+            return self._managers[id(context)]
+
+    def open(self, url, requestArgs=None, context=None, timeout=None, startByte=0, endByte=None):
+        requestArgs = requestArgs or {}
+        headers = self._headers(requestArgs, startByte, endByte)
+        data = requestArgs.get('data')
+        method = requestArgs.get('method') or ('POST' if data is not None else 'GET')
+        try:
+            resp = self._manager(context).request(method, url, body=data, headers=headers,
+                                                  timeout=timeout, preload_content=False, decode_content=False, retries=self._retries)
+        except urllib3.exceptions.ReadTimeoutError as e:
+            raise socket.timeout(str(e))
+        except urllib3.exceptions.HTTPError as e:
+            raise urllib.error.URLError(e)
+
+        response = Response(resp.geturl() or url, resp.status, resp.headers, resp, resp.release_conn)
+        if resp.status >= 400:
+            raise _http_error(response.url, resp.status, resp.reason, resp.headers, response)
+        return response
+
+    def close(self):
+        with self._lock:
+            managers, self._managers = self._managers, {}
+        for manager in managers.values():
+            manager.clear()
+
+class MemoryTransport(Transport):
+    '''
+    An in-process transport that serves files from memory. Supports ranges.
+    Useful for tests and benchmarks.
+
+    :param files: A dictionary of urls and their data.
+    :type files: dict
+    :param accept_ranges: If the fake server supports HTTP ranges. Default is True.
+    :type accept_ranges: bool
+    :param compress: If true, full responses are gzip-compressed for requests that accept it. Default is False.
+    :type compress: bool
+    '''
+    def __init__(self, files=None, accept_ranges=True, compress=False):
+        self.files = files or {}
+        self.accept_ranges = accept_ranges
+        self.compress = compress
+        self.requests = []
+
+    def open(self, url, requestArgs=None, context=None, timeout=None, startByte=0, endByte=None):
+        headers = self._headers(requestArgs, startByte, endByte)
+        self.requests.append((url, headers))
+        if url not in self.files:
+            raise _http_error(url, 404, 'Not Found', http.client.HTTPMessage())
+        data = self.files[url]
+
+        resp_headers = http.client.HTTPMessage()
+        status = 200
+        if self.accept_ranges:
+            resp_headers['Accept-Ranges'] = 'bytes'
+            if 'Range' in headers:
+                start, _, end = headers['Range'][len('bytes='):].partition('-')
+                start = int(start)
+                end = min(int(end), len(data)-1) if end else len(data)-1
+                if start >= len(data):
+                    raise _http_error(url, 416, 'Requested Range Not Satisfiable', resp_headers)
+                resp_headers['Content-Range'] = 'bytes {}-{}/{}'.format(start, end, len(data))
+                data = data[start:end+1]
+                status = 206
+        if self.compress and status == 200 and 'gzip' in headers.get('Accept-Encoding', ''):
+            resp_headers['Content-Encoding'] = 'gzip'
+            data = gzip.compress(data)
+        resp_headers['Content-Length'] = str(len(data))
+        return Response(url, status, resp_headers, io.BytesIO(data))
+
+_default_transport = UrllibTransport()
+
+def get_default_transport():
+    '''
+    Returns the process-wide default transport (`UrllibTransport`).
+
+    :rtype: `Transport` instance
+    '''
+    return _default_transport
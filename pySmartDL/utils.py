@@ -9,11 +9,17 @@ import urllib.request, urllib.parse, urllib.error
 import random
 import logging
 import re
+import codecs
 import hashlib
+import time
+import calendar
+import email.utils
 from concurrent import futures
 from math import log, ceil
 import shutil
 
+from .transport import get_default_transport
+
 DEFAULT_LOGGER_CREATED = False
 
 def combine_files(parts, dest, chunkSize = 1024 * 1024 * 4):
@@ -84,53 +90,221 @@ def progress_bar(progress, length=20):
         progress = 1
     return "[" + "#"*int(progress*length) + "-"*(length-int(progress*length)) + "]"
     
-def is_HTTPRange_supported(url, timeout=15):
+def is_HTTPRange_supported(url, timeout=15, transport=None, context=None, requestArgs=None):
     '''
     Checks if a server allows `Byte serving <https://en.wikipedia.org/wiki/Byte_serving>`_,
-    using the Range HTTP request header and the Accept-Ranges and Content-Range HTTP response headers.
+    using the Range HTTP request header and the Content-Range HTTP response header.
     
     :param url: Url address.
     :type url: string
     :param timeout: Timeout in seconds. Default is 15.
     :type timeout: int
+    :param transport: Transport to use. Default is the default transport.
+    :type transport: `pySmartDL.transport.Transport` instance
+    :param context: SSL context. None uses the default context.
+    :type context: `ssl.SSLContext` instance
+    :param requestArgs: Arguments of the request (headers...), in the form accepted by `urllib.request.Request`.
+    :type requestArgs: dict
     :rtype: bool
     '''
-    url = url.replace(' ', '%20')
-    
-    fullsize = get_filesize(url, timeout=timeout)
-    if not fullsize:
+    try:
+        return get_range_info(url, timeout, transport, context, requestArgs)[0]
+    except (urllib.error.HTTPError, urllib.error.URLError):
         return False
+
+def get_range_info(url, timeout=15, transport=None, context=None, requestArgs=None):
+    '''
+    Checks if a server allows range requests, and gets the filesize, with a single
+    `Range: bytes=0-0` request. The filesize comes from the total of the `Content-Range`
+    header, so it's known even if the server doesn't send a `Content-Length` for whole
+    responses (`Transfer-Encoding: chunked`).
     
-    headers = {'Range': 'bytes=0-3'}
-    req = urllib.request.Request(url, headers=headers)
-    urlObj = urllib.request.urlopen(req, timeout=timeout)
+    :param url: Url address.
+    :type url: string
+    :returns: `(range_supported, filesize)`. `filesize` is None if the server didn't tell.
+    :rtype: tuple
+    '''
+    url = url.replace(' ', '%20')
+    transport = transport or get_default_transport()
+    urlObj = transport.open(url, _with_headers(requestArgs, Range='bytes=0-0'), context=context, timeout=timeout)
     urlObj.close()
     
-    if "Content-Length" not in urlObj.headers:
-        return False
+    content_range = parse_content_range(urlObj.headers.get('Content-Range'))
+    if urlObj.status == 206 and content_range:
+        return True, content_range[2]
+    try:
+        return False, int(urlObj.headers["Content-Length"])
+    except (KeyError, TypeError, ValueError):
+        return False, None
 
-    filesize = int(urlObj.headers["Content-Length"])
-    return filesize != fullsize
+def discover_filesize(url, timeout=15, transport=None, context=None, requestArgs=None):
+    '''
+    Finds the size of a file whose response has no `Content-Length` (for example, a
+    chunked response). Tries, in order:
+    
+    1. The total of the `Content-Range` of a `Range: bytes=0-0` request.
+    2. The `Content-Length` of a HEAD request.
+    3. The total of the `Content-Range` of the `416` answer to a range that starts past any plausible end of the file.
+    
+    :param url: Url address.
+    :type url: string
+    :returns: Size in bytes, or 0 if it's unknown.
+    :rtype: int
+    '''
+    transport = transport or get_default_transport()
+    try:
+        filesize = get_range_info(url, timeout, transport, context, requestArgs)[1]
+    except (urllib.error.HTTPError, urllib.error.URLError, OSError):
+        filesize = None
+    if filesize:
+        return filesize
+    
+    try:
+        urlObj = transport.open(url, _with_headers(requestArgs, method='HEAD'), context=context, timeout=timeout)
+        urlObj.close()
+        if 'Content-Encoding' not in urlObj.headers:
+            return int(urlObj.headers["Content-Length"])
+    except (KeyError, TypeError, ValueError, urllib.error.HTTPError, urllib.error.URLError, OSError):
+        pass
+    
+    try:
+        urlObj = transport.open(url, requestArgs, context=context, timeout=timeout, startByte=2**62)
+        urlObj.close()
+    except urllib.error.HTTPError as e:
+        content_range = parse_content_range(e.headers.get('Content-Range')) if e.code == 416 and e.headers else None
+        if content_range and content_range[2]:
+            return content_range[2]
+    except (urllib.error.URLError, OSError):
+        pass
+    return 0
+
+def _with_headers(requestArgs, method=None, **headers):
+    requestArgs = dict(requestArgs or {})
+    requestArgs['headers'] = dict(requestArgs.get('headers') or {}, **headers)
+    if method:
+        requestArgs['method'] = method
+    return requestArgs
 
-def get_filesize(url, timeout=15):
+def get_filesize(url, timeout=15, transport=None, context=None):
     '''
-    Fetches file's size of a file over HTTP.
+    Fetches file's size of a file over HTTP. If the server doesn't send a `Content-Length`,
+    `discover_filesize()` is used.
     
     :param url: Url address.
     :type url: string
     :param timeout: Timeout in seconds. Default is 15.
     :type timeout: int
+    :param transport: Transport to use. Default is the default transport.
+    :type transport: `pySmartDL.transport.Transport` instance
+    :param context: SSL context. None uses the default context.
+    :type context: `ssl.SSLContext` instance
     :returns: Size in bytes.
     :rtype: int
     '''
+    transport = transport or get_default_transport()
     try:
-        urlObj = urllib.request.urlopen(url, timeout=timeout)
+        urlObj = transport.open(url, context=context, timeout=timeout)
+        urlObj.close()
         file_size = int(urlObj.headers["Content-Length"])
-    except (IndexError, KeyError, TypeError, urllib.error.HTTPError, urllib.error.URLError):
+    except (IndexError, KeyError, TypeError):
+        return discover_filesize(url, timeout, transport, context)
+    except (urllib.error.HTTPError, urllib.error.URLError):
         return 0
         
     return file_size
     
+def parse_content_range(value):
+    '''
+    Parses a `Content-Range` header.
+    
+    >>> parse_content_range('bytes 0-499/1234')
+    (0, 499, 1234)
+    
+    :param value: The header value.
+    :type value: string
+    :returns: `(start, end, total)`. `start` and `end` are None for unsatisfied ranges, `total` is None if unknown. Returns None if the header is missing or invalid.
+    :rtype: tuple
+    '''
+    if not value:
+        return None
+    match = re.match(r'^\s*bytes\s+(?:(\d+)-(\d+)|\*)/(\d+|\*)\s*$', value)
+    if not match:
+        return None
+    start, end, total = match.groups()
+    return (
+        int(start) if start is not None else None,
+        int(end) if end is not None else None,
+        int(total) if total != '*' else None
+    )
+
+def parse_retry_after(value, now=None):
+    '''
+    Parses a `Retry-After` header, either delay-seconds or an HTTP date.
+    
+    >>> parse_retry_after('120')
+    120.0
+    
+    :param value: The header value.
+    :type value: string
+    :returns: The delay in seconds (never negative), or None if the header is missing or invalid.
+    :rtype: float
+    '''
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError, IndexError):
+        return None
+    if date is None:
+        return None
+    now = time.time() if now is None else now
+    return max(0.0, date.timestamp() - now)
+
+EXPIRED_URL_CODES = (403, 410)  # how servers refuse a signed url that isn't valid anymore
+URL_EXPIRY_MARGIN = 30  # seconds. a signed url is treated as expired a bit early, so a request doesn't race the expiry.
+
+def get_url_expiry(url):
+    '''
+    Returns the time a signed url expires, from its query: `X-Amz-Date` and `X-Amz-Expires`
+    (S3 presigned urls, signature v4), `X-Goog-Date` and `X-Goog-Expires` (GCS), `Expires`
+    (S3 v2, CloudFront), or `se` (Azure SAS).
+    
+    >>> get_url_expiry('https://bucket.s3.amazonaws.com/file?X-Amz-Date=20240101T000000Z&X-Amz-Expires=3600')
+    1704070800
+    
+    :param url: Url address.
+    :type url: string
+    :returns: A unix timestamp, or None if the url isn't signed (or the expiry is invalid).
+    :rtype: int
+    '''
+    query = dict((k.lower(), v) for k, v in urllib.parse.parse_qsl(urllib.parse.urlsplit(url).query))
+    try:
+        for prefix in ('x-amz-', 'x-goog-'):
+            if prefix+'date' in query and prefix+'expires' in query:
+                return calendar.timegm(time.strptime(query[prefix+'date'], '%Y%m%dT%H%M%SZ')) + int(query[prefix+'expires'])
+        if query.get('expires', '').isdigit():
+            return int(query['expires'])
+        if 'se' in query and 'sig' in query:
+            return calendar.timegm(time.strptime(query['se'].rstrip('Z')[:19], '%Y-%m-%dT%H:%M:%S'))
+    except ValueError:
+        pass
+    return None
+
+def is_url_expired(url, now=None):
+    '''
+    Returns if `url` is a signed url that expired, or expires in less than `URL_EXPIRY_MARGIN` seconds.
+    
+    :rtype: bool
+    '''
+    expiry = get_url_expiry(url)
+    if expiry is None:
+        return False
+    now = time.time() if now is None else now
+    return expiry - now < URL_EXPIRY_MARGIN
+
 def get_random_useragent():
     '''
     Returns a random popular user-agent.
@@ -241,6 +415,37 @@ def time_human(duration, fmt_short=False, show_ms=False):
         return "".join(["%s%s" % x for x in result])
     return ", ".join(["%s %s" % x for x in result])
 
+def detect_json_encoding(b):
+    '''
+    Detects the encoding of JSON data from its first bytes, like `json.detect_encoding()`
+    (which is only available since Python 3.6).
+
+    >>> detect_json_encoding(b'{\x00"\x00')
+    'utf-16-le'
+
+    :param b: The first 4 bytes of the data, or fewer if the data is shorter.
+    :type b: bytes
+    :rtype: string
+    '''
+    if b.startswith((codecs.BOM_UTF32_BE, codecs.BOM_UTF32_LE)):
+        return 'utf-32'
+    if b.startswith((codecs.BOM_UTF16_BE, codecs.BOM_UTF16_LE)):
+        return 'utf-16'
+    if b.startswith(codecs.BOM_UTF8):
+        return 'utf-8-sig'
+    # JSON text starts with an ASCII character, so the position of the null bytes gives the encoding.
+    if len(b) >= 4:
+        if not b[0]:
+            return 'utf-16-be' if b[1] else 'utf-32-be'
+        if not b[1]:
+            return 'utf-16-le' if b[2] or b[3] else 'utf-32-le'
+    elif len(b) == 2:
+        if not b[0]:
+            return 'utf-16-be'
+        if not b[1]:
+            return 'utf-16-le'
+    return 'utf-8'
+
 def get_file_hash(algorithm, path):
     '''
     Calculates a file's hash.
@@ -250,18 +455,21 @@ def get_file_hash(algorithm, path):
     
     :param algorithm: Hashing algorithm.
     :type algorithm: string
-    :param path: The file path
-    :type path: string
+    :param path: The file path. If a list of paths is given, the hash of their concatenation is calculated.
+    :type path: string or list of strings
     :rtype: string
     '''
     hashAlg = hashlib.new(algorithm)
     block_sz = 1*1024**2  # 1 MB
+    buff = bytearray(block_sz)  # reused for every block
+    view = memoryview(buff)
 
-    with open(path, 'rb') as f:
-        data = f.read(block_sz)
-        while data:
-            hashAlg.update(data)
-            data = f.read(block_sz)
+    for p in ([path] if isinstance(path, str) else path):
+        with open(p, 'rb', buffering=0) as f:
+            n = f.readinto(buff)
+            while n:
+                hashAlg.update(view[:n])
+                n = f.readinto(buff)
     
     return hashAlg.hexdigest()
 
@@ -316,6 +524,15 @@ def create_debugging_logger():
     
     return t_log
     
+class CanceledException(Exception):
+    "Raised when the job is canceled."
+    def __init__(self):
+        pass
+    def __str__(self):
+        return 'CanceledException'
+    def __repr__(self):
+        return "<CanceledException>"
+
 class DummyLogger(object):
     '''
     A dummy logger. You can call `debug()`, `warning()`, etc on this object, and nothing will happen.
@@ -331,14 +548,10 @@ class DummyLogger(object):
             return object.__getattr__(name)
         return self.dummy_func
         
-class ManagedThreadPoolExecutor(futures.ThreadPoolExecutor):
+class ManagedExecutorMixin(object):
     '''
-	Managed Thread Pool Executor. A subclass of ThreadPoolExecutor.
+    Keeps track of the futures submitted to an executor.
     '''
-    def __init__(self, max_workers):
-        futures.ThreadPoolExecutor.__init__(self, max_workers)
-        self._futures = []
-    
     def submit(self, fn, *args, **kwargs):
         future = super().submit(fn, *args, **kwargs)
         self._futures.append(future)
@@ -354,7 +567,7 @@ class ManagedThreadPoolExecutor(futures.ThreadPoolExecutor):
         :rtype: List of `Exception` instances'''
         l = []
         for x in self._futures:
-            if x.exception():
+            if not x.cancelled() and x.exception():
                 l.append(x.exception())
         return l
 
@@ -365,6 +578,26 @@ class ManagedThreadPoolExecutor(futures.ThreadPoolExecutor):
         :rtype: `Exception` instance
         '''
         for x in self._futures:
-            if x.exception():
+            if not x.cancelled() and x.exception():
                 return x.exception()
         return None
+
+class ManagedThreadPoolExecutor(ManagedExecutorMixin, futures.ThreadPoolExecutor):
+    '''
+	Managed Thread Pool Executor. A subclass of ThreadPoolExecutor.
+    '''
+    def __init__(self, max_workers):
+        futures.ThreadPoolExecutor.__init__(self, max_workers)
+        self._futures = []
+
+class ManagedProcessPoolExecutor(ManagedExecutorMixin, futures.ProcessPoolExecutor):
+    '''
+	Managed Process Pool Executor. A subclass of ProcessPoolExecutor.
+    '''
+    def __init__(self, max_workers, initializer=None, initargs=()):
+        if initializer:
+            futures.ProcessPoolExecutor.__init__(self, max_workers, initializer=initializer, initargs=initargs)
+        else:
+            # initializer is new in Python 3.7
+            futures.ProcessPoolExecutor.__init__(self, max_workers)
+        self._futures = []
@@ -0,0 +1,265 @@
+'''
+A dedicated I/O stage. Instead of every range worker writing its 8KB reads to disk
+itself, the workers hand their buffers to a `FileWriter`. The writer thread coalesces
+adjacent buffers into large writes, and the bounded queue gives backpressure to the readers.
+'''
+
+import os
+import mmap
+import time
+import threading
+import collections
+
+FSYNC_POLICIES = ('none', 'finish', 'periodic')
+_O_DIRECT = getattr(os, 'O_DIRECT', 0)
+_ALIGN = mmap.PAGESIZE
+
+class _OpenFile(object):
+    def __init__(self, path, truncate, direct):
+        flags = os.O_WRONLY | os.O_CREAT | getattr(os, 'O_BINARY', 0)
+        if truncate:
+            flags |= os.O_TRUNC
+        self.fd = os.open(path, flags, 0o666)
+        self.direct_fd = None
+        if direct and _O_DIRECT:
+            try:
+                self.direct_fd = os.open(path, os.O_WRONLY | _O_DIRECT)
+            except OSError:
+                pass  # the filesystem doesn't support O_DIRECT.
+        self.buf = bytearray()
+        self.buf_offset = 0
+        self.buf_time = 0
+        self.refs = 0
+        self.error = None
+        self.last_fsync = time.monotonic()
+
+class WriterFile(object):
+    '''
+    A file-like object that writes through a `FileWriter`. Returned by `FileWriter.open()`.
+    '''
+    def __init__(self, writer, path, offset):
+        self.writer = writer
+        self.path = path
+        self.pos = offset
+
+    def write(self, data):
+        self.writer.write(self.path, self.pos, bytes(data))
+        self.pos += len(data)
+        return len(data)
+
+    def close(self):
+        if self.writer:
+            writer, self.writer = self.writer, None
+            writer.close_file(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class FileWriter(object):
+    '''
+    A writer thread that can be shared by many downloads.
+
+    :param max_queued: Maximum number of bytes waiting in the queue. Workers block when it's full. Default is 64MB.
+    :type max_queued: int
+    :param coalesce_size: Adjacent buffers are joined until they reach this size, and then written at once. Default is 4MB.
+    :type coalesce_size: int
+    :param max_delay: A partial buffer is written after this many seconds, even if it's not full. Default is 1.
+    :type max_delay: float
+    :param fsync_policy: `none` never calls fsync, `finish` calls it when a file is done, `periodic` also calls it every `fsync_interval` seconds. Default is `finish`.
+    :type fsync_policy: string
+    :param fsync_interval: Seconds between two fsyncs of the same file, with the `periodic` policy. Default is 5.
+    :type fsync_interval: float
+    :param drop_cache: If true, tells the kernel (`posix_fadvise(DONTNEED)`) that the written data won't be read again, so huge downloads don't evict the page cache. Pages are only dropped once they're on disk, so pair it with a fsync policy. Default is False.
+    :type drop_cache: bool
+    :param direct_io: If true, page-aligned blocks are written with `O_DIRECT`, bypassing the page cache. Unaligned heads and tails are written normally. Ignored where `O_DIRECT` is not available. Default is False.
+    :type direct_io: bool
+    '''
+    def __init__(self, max_queued=64*1024**2, coalesce_size=4*1024**2, max_delay=1, fsync_policy='finish', fsync_interval=5, drop_cache=False, direct_io=False):
+        if fsync_policy not in FSYNC_POLICIES:
+            raise ValueError("fsync_policy must be one of {} (got {!r})".format(FSYNC_POLICIES, fsync_policy))
+        self.max_queued = max_queued
+        self.coalesce_size = coalesce_size
+        self.max_delay = max_delay
+        self.fsync_policy = fsync_policy
+        self.fsync_interval = fsync_interval
+        self.drop_cache = drop_cache and hasattr(os, 'posix_fadvise')
+        self.direct_io = direct_io and bool(_O_DIRECT)
+
+        self._queue = collections.deque()
+        self._queued = 0
+        self._files = {}
+        self._cond = threading.Condition()
+        self._thread = None
+        self._direct_buf = mmap.mmap(-1, coalesce_size + _ALIGN) if self.direct_io else None
+
+    def _ensure_started(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name='pySmartDL-writer')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def open(self, path, offset=None):
+        '''
+        Opens a file for writing. If `offset` is None, the file is truncated and written
+        from the start. Else, it's written from `offset` (the file is shared with other workers).
+
+        :rtype: `WriterFile` instance
+        '''
+        with self._cond:
+            f = self._files.get(path)
+            if f is None:
+                f = self._files[path] = _OpenFile(path, offset is None, self.direct_io)
+            f.refs += 1
+            self._ensure_started()
+        return WriterFile(self, path, offset or 0)
+
+    def write(self, path, offset, data):
+        '''
+        Queues a buffer to be written at `offset`. Blocks while the queue is full.
+        Raises the error of a previous write to the same file, if any.
+        '''
+        with self._cond:
+            while self._queued and self._queued + len(data) > self.max_queued:
+                self._cond.wait()
+            f = self._files[path]
+            if f.error:
+                raise f.error
+            self._queue.append((f, offset, data))
+            self._queued += len(data)
+            self._cond.notify_all()
+
+    def close_file(self, path):
+        '''
+        Blocks until all the data queued for the file is written (and synced, according to the
+        fsync policy), and releases it. Raises the error of a failed write, if any.
+        '''
+        with self._cond:
+            f = self._files[path]
+            self._queue.append((f, None, None))  # a flush marker
+            self._cond.notify_all()
+            while any(item[0] is f for item in self._queue) or f.buf:
+                self._cond.wait()
+            f.refs -= 1
+            last = f.refs == 0
+            if last:
+                del self._files[path]
+        if last:
+            self._finish(f)
+        if f.error:
+            raise f.error
+
+    def _finish(self, f):
+        try:
+            if self.fsync_policy != 'none' and not f.error:
+                os.fsync(f.fd)
+            if self.drop_cache:
+                os.posix_fadvise(f.fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        except OSError as e:
+            f.error = f.error or e
+        finally:
+            os.close(f.fd)
+            if f.direct_fd is not None:
+                os.close(f.direct_fd)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._queue:
+                    pending = [f for f in self._files.values() if f.buf]
+                    if not pending:
+                        self._cond.wait()
+                        continue
+                    timeout = min(f.buf_time for f in pending) + self.max_delay - time.monotonic()
+                    if timeout <= 0:
+                        break
+                    self._cond.wait(timeout)
+                if self._queue:
+                    f, offset, data = self._queue.popleft()
+                    if data is not None:
+                        self._queued -= len(data)
+                    self._cond.notify_all()
+                else:
+                    f, offset, data = None, None, None
+
+            if f is None:
+                # nothing queued, but a partial buffer waited for too long.
+                for f in [f for f in list(self._files.values()) if f.buf and f.buf_time + self.max_delay <= time.monotonic()]:
+                    self._flush(f)
+                with self._cond:
+                    self._cond.notify_all()
+                continue
+
+            if data is None:
+                self._flush(f)
+            elif f.error:
+                pass  # the error is raised to the worker on its next call.
+            elif f.buf and offset == f.buf_offset + len(f.buf):
+                f.buf += data
+            else:
+                self._flush(f)
+                f.buf_offset = offset
+                f.buf += data
+                f.buf_time = time.monotonic()
+
+            if len(f.buf) >= self.coalesce_size:
+                self._flush(f)
+            with self._cond:
+                self._cond.notify_all()
+
+    def _flush(self, f):
+        if not f.buf or f.error:
+            f.buf = bytearray()
+            return
+        try:
+            self._pwrite(f, f.buf, f.buf_offset)
+            if self.fsync_policy == 'periodic' and time.monotonic() - f.last_fsync >= self.fsync_interval:
+                os.fsync(f.fd)
+                f.last_fsync = time.monotonic()
+                if self.drop_cache:
+                    os.posix_fadvise(f.fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        except OSError as e:
+            f.error = e
+        f.buf = bytearray()
+
+    def _pwrite(self, f, data, offset):
+        view = memoryview(data)
+        if f.direct_fd is not None:
+            head = -offset % _ALIGN
+            if len(view) - head >= _ALIGN:
+                if head:
+                    self._write_all(f.fd, view[:head], offset)
+                    view, offset = view[head:], offset+head
+                # O_DIRECT needs an aligned memory buffer as well, so the data is copied to an mmap'ed one.
+                while len(view) >= _ALIGN:
+                    n = min(len(view), len(self._direct_buf)) // _ALIGN * _ALIGN
+                    self._direct_buf[:n] = view[:n]
+                    self._write_all(f.direct_fd, memoryview(self._direct_buf)[:n], offset)
+                    view, offset = view[n:], offset+n
+        self._write_all(f.fd, view, offset)
+
+    def _write_all(self, fd, view, offset):
+        while len(view):
+            if hasattr(os, 'pwrite'):
+                n = os.pwrite(fd, view, offset)
+            else:
+                os.lseek(fd, offset, os.SEEK_SET)
+                n = os.write(fd, view)
+            view, offset = view[n:], offset+n
+
+_default_writer = None
+_default_writer_lock = threading.Lock()
+
+def get_default_writer():
+    '''
+    Returns the process-wide default `FileWriter`, creating it if needed.
+
+    :rtype: `FileWriter` instance
+    '''
+    global _default_writer
+    with _default_writer_lock:
+        if _default_writer is None:
+            _default_writer = FileWriter()
+        return _default_writer
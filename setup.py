@@ -1,7 +1,12 @@
 from setuptools import setup, find_packages
 import pySmartDL
 
-extra = {}
+extra = {
+    'extras_require': {
+        'http2': ['h2>=3.0'],
+        'urllib3': ['urllib3'],
+    }
+}
 release_posttag = ""
 
 setup(
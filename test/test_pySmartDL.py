@@ -10,10 +10,353 @@ import warnings
 import tempfile
 from pathlib import Path
 import socket
+import ssl
+import threading
+import http.server
+import socketserver
+import urllib.parse
+import urllib.error
+import io
+import hashlib
+import gzip
+import tarfile
+import zipfile
 
 sys.path.insert(0, str(Path(__file__).parent.parent))
 
 import pySmartDL
+import pySmartDL.http2
+
+try:
+    import h2.connection
+    import h2.config
+    import h2.events
+    import h2.exceptions
+except ImportError:
+    h2 = None
+
+try:
+    import urllib3
+except ImportError:
+    urllib3 = None
+
+class RangeRequestHandler(http.server.BaseHTTPRequestHandler):
+    "Serves the server's files from memory. Supports single ranges."
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        self.do_GET(send_body=False)
+
+    def do_GET(self, send_body=True):
+        self.server.requests.append((self.command, self.path, dict(self.headers)))
+        data = self.server.files.get(self.path)
+        if data is None:
+            self.send_error(404)
+            return
+        status = 200
+        headers = {'Accept-Ranges': 'bytes'}
+        if 'Range' in self.headers:
+            start, end = self.headers['Range'][len('bytes='):].split('-')
+            start = int(start)
+            end = min(int(end), len(data)-1) if end else len(data)-1
+            headers['Content-Range'] = 'bytes {}-{}/{}'.format(start, end, len(data))
+            data = data[start:end+1]
+            status = 206
+        self.send_response(status)
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        if send_body:
+            self.wfile.write(data)
+
+class LocalHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    "A local HTTP server for tests that don't need the internet."
+    daemon_threads = True
+
+    def __init__(self, files, handler=RangeRequestHandler):
+        http.server.HTTPServer.__init__(self, ('127.0.0.1', 0), handler)
+        self.files = files
+        self.requests = []
+        t = threading.Thread(target=self.serve_forever)
+        t.daemon = True
+        t.start()
+
+    def url(self, path, host='127.0.0.1'):
+        return "http://{}:{}{}".format(host, self.server_address[1], path)
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
+
+class SlowRangeRequestHandler(RangeRequestHandler):
+    "Answers range requests after a delay."
+    def do_GET(self, send_body=True):
+        if 'Range' in self.headers:
+            time.sleep(0.5)
+        RangeRequestHandler.do_GET(self, send_body)
+
+class StallingRangeRequestHandler(RangeRequestHandler):
+    "Trickles the second half of the first range request that doesn't start at 0. If `server.stall_headers` is true, answers it late instead."
+    def do_GET(self, send_body=True):
+        if not self.headers.get('Range', 'bytes=0-').startswith('bytes=0-') and not self.server.stalled:
+            self.server.stalled = True
+            if getattr(self.server, 'stall_headers', False):
+                time.sleep(3)
+                RangeRequestHandler.do_GET(self, send_body)
+                return
+            self.server.requests.append((self.command, self.path, dict(self.headers)))
+            data = self.server.files[self.path]
+            start, end = [int(x) for x in self.headers['Range'][len('bytes='):].split('-')]
+            data = data[start:end+1]
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, end, len(self.server.files[self.path])))
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            half = len(data)//2
+            self.wfile.write(data[:half])
+            try:
+                for i in range(half, len(data), 100):
+                    time.sleep(0.2)
+                    self.wfile.write(data[i:i+100])
+            except OSError:
+                pass
+            return
+        RangeRequestHandler.do_GET(self, send_body)
+
+class NoRangeRequestHandler(RangeRequestHandler):
+    "Ignores the Range header, and sends whole files."
+    def do_GET(self, send_body=True):
+        del self.headers['Range']
+        RangeRequestHandler.do_GET(self, send_body)
+
+class OverloadedRangeRequestHandler(RangeRequestHandler):
+    "Refuses the first range requests that don't start at 0 with a 503 and a Retry-After."
+    def do_GET(self, send_body=True):
+        if not self.headers.get('Range', 'bytes=0-').startswith('bytes=0-') and self.server.refuse > 0:
+            self.server.refuse -= 1
+            self.server.requests.append((self.command, self.path, dict(self.headers)))
+            self.send_response(503)
+            self.send_header('Retry-After', '1')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        RangeRequestHandler.do_GET(self, send_body)
+
+class ThrottledRangeRequestHandler(RangeRequestHandler):
+    "Sends the body in small chunks, and counts the open connections."
+    def do_GET(self, send_body=True):
+        self.server.connections += 1
+        try:
+            self.server.requests.append((self.command, self.path, dict(self.headers)))
+            data = self.server.files[self.path]
+            status = 200
+            if 'Range' in self.headers:
+                start, end = self.headers['Range'][len('bytes='):].split('-')
+                start = int(start)
+                end = min(int(end), len(data)-1) if end else len(data)-1
+                content_range = 'bytes {}-{}/{}'.format(start, end, len(data))
+                data = data[start:end+1]
+                status = 206
+            self.send_response(status)
+            if status == 206:
+                self.send_header('Content-Range', content_range)
+            self.send_header('Accept-Ranges', 'bytes')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            for i in range(0, len(data), 32*1024):
+                self.wfile.write(data[i:i+32*1024])
+                time.sleep(0.01)
+        except OSError:
+            pass
+        finally:
+            self.server.connections -= 1
+
+class ChunkedRequestHandler(RangeRequestHandler):
+    "Sends whole responses with `Transfer-Encoding: chunked`, and no Content-Length. Ranges are supported."
+    def do_GET(self, send_body=True):
+        if 'Range' in self.headers:
+            RangeRequestHandler.do_GET(self, send_body)
+            return
+        self.server.requests.append((self.command, self.path, dict(self.headers)))
+        data = self.server.files[self.path]
+        self.send_response(200)
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        if not send_body:
+            return
+        try:
+            for i in range(0, len(data), 64*1024):
+                chunk = data[i:i+64*1024]
+                self.wfile.write('{:x}\r\n'.format(len(chunk)).encode('ascii') + chunk + b'\r\n')
+            self.wfile.write(b'0\r\n\r\n')
+        except OSError:
+            pass
+
+class EncodingRequestHandler(RangeRequestHandler):
+    "Sends whole responses gzip-compressed and `compress`-encoded, which can't be decoded, unless they are asked for unencoded (or `server.always_encode` is true)."
+    def do_GET(self, send_body=True):
+        if 'Range' in self.headers or (self.headers.get('Accept-Encoding') == 'identity' and not self.server.always_encode):
+            RangeRequestHandler.do_GET(self, send_body)
+            return
+        self.server.requests.append((self.command, self.path, dict(self.headers)))
+        data = gzip.compress(self.server.files[self.path])
+        self.send_response(200)
+        self.send_header('Content-Encoding', 'gzip, compress')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        try:
+            if send_body:
+                self.wfile.write(data)
+        except OSError:
+            pass  # the client closes the response it can't decode
+
+class RedirectingRequestHandler(RangeRequestHandler):
+    "Redirects `/<file>` to a signed url, `/signed/<file>?sig=<n>&Expires=<server.expires>`. Range requests to the revoked signatures get a 403."
+    def do_GET(self, send_body=True):
+        path, _, query = self.path.partition('?')
+        if not path.startswith('/signed/'):
+            self.server.redirects += 1
+            self.send_response(302)
+            self.send_header('Location', '/signed{}?sig={}&Expires={}'.format(path, self.server.redirects, self.server.expires))
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        sig = int(dict(urllib.parse.parse_qsl(query))['sig'])
+        if sig in self.server.revoked and self.headers.get('Range', 'bytes=0-0') != 'bytes=0-0':
+            self.send_response(403)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.path = path[len('/signed'):]
+        RangeRequestHandler.do_GET(self, send_body)
+
+class MultiRangeRequestHandler(RangeRequestHandler):
+    "Answers multi-range requests with a multipart/byteranges response, or with the whole file if `server.multirange` is false."
+    def do_GET(self, send_body=True):
+        if ',' not in self.headers.get('Range', ''):
+            RangeRequestHandler.do_GET(self, send_body)
+            return
+        self.server.requests.append((self.command, self.path, dict(self.headers)))
+        data = self.server.files[self.path]
+        if not self.server.multirange:
+            del self.headers['Range']
+            RangeRequestHandler.do_GET(self, send_body)
+            self.server.requests.pop()
+            return
+        body = b''
+        for r in self.headers['Range'][len('bytes='):].split(','):
+            start, end = [int(x) for x in r.split('-')]
+            body += '\r\n--BOUNDARY\r\nContent-Type: application/octet-stream\r\nContent-Range: bytes {}-{}/{}\r\n\r\n'.format(start, end, len(data)).encode()
+            body += data[start:end+1]
+        body += b'\r\n--BOUNDARY--\r\n'
+        self.send_response(206)
+        self.send_header('Content-Type', 'multipart/byteranges; boundary=BOUNDARY')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+class ETagRequestHandler(RangeRequestHandler):
+    "Sends an ETag, and answers a matching If-None-Match with a 304."
+    def do_GET(self, send_body=True):
+        data = self.server.files.get(self.path)
+        etag = '"{}"'.format(hashlib.md5(data).hexdigest()) if data is not None else None
+        if etag and self.headers.get('If-None-Match') == etag:
+            self.server.requests.append((self.command, self.path, dict(self.headers)))
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        RangeRequestHandler.do_GET(self, send_body)
+
+    def send_header(self, keyword, value):
+        if keyword == 'Content-Length' and self.path in self.server.files:
+            RangeRequestHandler.send_header(self, 'ETag', '"{}"'.format(hashlib.md5(self.server.files[self.path]).hexdigest()))
+        RangeRequestHandler.send_header(self, keyword, value)
+
+class LocalHTTPSServer(LocalHTTPServer):
+    "A local HTTPS server, with the self-signed certificate in test/localhost.pem."
+    def __init__(self, files, handler=RangeRequestHandler):
+        self.context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        self.context.load_cert_chain(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'localhost.pem'))
+        LocalHTTPServer.__init__(self, files, handler)
+
+    def get_request(self):
+        sock, addr = LocalHTTPServer.get_request(self)
+        return self.context.wrap_socket(sock, server_side=True), addr
+
+    def url(self, path, host='127.0.0.1'):
+        return "https://{}:{}{}".format(host, self.server_address[1], path)
+
+class H2TestServer(object):
+    "A tiny HTTP/2 server (prior knowledge, no TLS) that supports ranges."
+    def __init__(self, files):
+        self.files = files
+        self.connections = 0
+        self.sock = socket.socket()
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(5)
+        self.port = self.sock.getsockname()[1]
+        t = threading.Thread(target=self.serve)
+        t.daemon = True
+        t.start()
+
+    def serve(self):
+        while True:
+            try:
+                client, _ = self.sock.accept()
+            except OSError:
+                return
+            self.connections += 1
+            t = threading.Thread(target=self.handle, args=(client,))
+            t.daemon = True
+            t.start()
+
+    def handle(self, client):
+        conn = h2.connection.H2Connection(config=h2.config.H2Configuration(client_side=False, header_encoding='utf-8'))
+        conn.initiate_connection()
+        client.sendall(conn.data_to_send())
+        pending = {}
+        while True:
+            data = client.recv(65536)
+            if not data:
+                break
+            for event in conn.receive_data(data):
+                if isinstance(event, h2.events.RequestReceived):
+                    headers = dict(event.headers)
+                    body = self.files[headers[':path']]
+                    status = '200'
+                    if 'range' in headers:
+                        start, end = headers['range'][len('bytes='):].split('-')
+                        body = body[int(start):int(end)+1]
+                        status = '206'
+                    conn.send_headers(event.stream_id, [(':status', status), ('content-length', str(len(body))), ('accept-ranges', 'bytes')])
+                    pending[event.stream_id] = body
+                elif isinstance(event, h2.events.StreamReset):
+                    pending.pop(event.stream_id, None)
+            for stream_id, body in list(pending.items()):
+                try:
+                    while body:
+                        n = min(len(body), conn.local_flow_control_window(stream_id), conn.max_outbound_frame_size)
+                        if n <= 0:
+                            break
+                        conn.send_data(stream_id, body[:n])
+                        body = body[n:]
+                    if body:
+                        pending[stream_id] = body
+                    else:
+                        conn.end_stream(stream_id)
+                        del pending[stream_id]
+                except h2.exceptions.StreamClosedError:
+                    del pending[stream_id]
+            client.sendall(conn.data_to_send())
+        client.close()
+
+    def close(self):
+        self.sock.close()
 
 class TestSmartDL(unittest.TestCase):
     def setUp(self):
@@ -168,6 +511,830 @@ class TestSmartDL(unittest.TestCase):
         obj.start()
         self.assertTrue(obj.isSuccessful())
 
+    def test_memory_transport(self):
+        url = "http://example.com/data.bin"
+        data = os.urandom(5*1024**2+123)
+        transport = pySmartDL.transport.MemoryTransport({url: data})
+        obj = pySmartDL.SmartDL(url, dest=self.dl_dir, progress_bar=False, transport=transport, connect_default_logger=self.enable_logging)
+        obj.start()
+        
+        self.assertTrue(obj.isSuccessful())
+        self.assertEqual(obj.get_data(binary=True), data)
+        self.assertTrue(any('Range' in headers for _, headers in transport.requests))
+
+    def test_mirror_probing(self):
+        data = os.urandom(5*1024**2+123)
+        files = {
+            "http://mirror2.example.com/data.bin": data,
+            "http://mirror3.example.com/data.bin": data[:-1],  # size mismatch
+            "http://mirror4.example.com/data.bin": data,
+        }
+        urls = ["http://mirror1.example.com/data.bin"] + sorted(files)  # mirror1 is dead
+        transport = pySmartDL.transport.MemoryTransport(files)
+        obj = pySmartDL.SmartDL(urls, dest=self.dl_dir, progress_bar=False, transport=transport, connect_default_logger=self.enable_logging)
+        obj.start()
+        
+        self.assertTrue(obj.isSuccessful())
+        self.assertEqual(obj.get_data(binary=True), data)
+        ranking = obj.get_mirror_ranking()
+        self.assertEqual(sorted([r['url'] for r in ranking]), ["http://mirror2.example.com/data.bin", "http://mirror4.example.com/data.bin"])
+        self.assertTrue(all(r['range_supported'] and r['filesize'] == len(data) for r in ranking))
+        self.assertEqual(obj.threads_count, 5)
+
+    def test_hung_first_mirror(self):
+        data = os.urandom(3*1024**2)
+        server = LocalHTTPServer({'/data.bin': data})
+        hung = socket.socket()
+        hung.bind(('127.0.0.1', 0))
+        hung.listen(5)  # connects, but never answers
+        try:
+            urls = ["http://127.0.0.1:{}/data.bin".format(hung.getsockname()[1]), server.url('/data.bin')]
+            t = time.time()
+            obj = pySmartDL.SmartDL(urls, dest=self.dl_dir, progress_bar=False, timeout=10, connect_default_logger=self.enable_logging)
+            self.assertLess(time.time() - t, 0.5)
+            t = time.time()
+            obj.start()
+            self.assertLess(time.time() - t, 5)  # the probes aren't waited for until the timeout
+
+            self.assertTrue(obj.isSuccessful())
+            self.assertEqual(obj.get_data(binary=True), data)
+            self.assertTrue(obj.range_supported)
+            self.assertEqual(obj.threads_count, 5)
+            ranking = obj.get_mirror_ranking()
+            self.assertEqual([r['url'] for r in ranking], urls[::-1])  # the hung mirror is ranked last, unprobed
+            self.assertIsNone(ranking[-1]['ttfb'])
+        finally:
+            hung.close()
+            server.close()
+
+    def test_writer(self):
+        url = "http://example.com/data.bin"
+        data = os.urandom(5*1024**2+123)
+        transport = pySmartDL.transport.MemoryTransport({url: data})
+        writer = pySmartDL.writer.FileWriter(max_queued=1024**2, coalesce_size=256*1024, fsync_policy='periodic', fsync_interval=0, drop_cache=True)
+        obj = pySmartDL.SmartDL(url, dest=self.dl_dir, progress_bar=False, transport=transport, writer=writer, connect_default_logger=self.enable_logging)
+        obj.start()
+        
+        self.assertTrue(obj.isSuccessful())
+        self.assertEqual(obj.get_data(binary=True), data)
+
+    def test_process_engine(self):
+        url = "http://example.com/data.bin"
+        data = os.urandom(5*1024**2+123)
+        transport = pySmartDL.transport.MemoryTransport({url: data})
+        obj = pySmartDL.SmartDL(url, dest=self.dl_dir, progress_bar=False, transport=transport, engine='process', connect_default_logger=self.enable_logging)
+        obj.start()
+        
+        self.assertTrue(obj.isSuccessful())
+        self.assertEqual(obj.get_dl_size(), len(data))
+        self.assertEqual(obj.get_data(binary=True), data)
+
+        # a compressed transfer is read by a thread, so the file isn't preallocated to the compressed size
+        url = "http://example.com/data.json"
+        data = json.dumps([{"id": i, "name": "item"} for i in range(100000)]).encode('utf-8')
+        transport = pySmartDL.transport.MemoryTransport({url: data}, compress=True)
+        obj = pySmartDL.SmartDL(url, dest=os.path.join(self.dl_dir, 'compressed', ''), progress_bar=False, transport=transport, compression=True, engine='process', connect_default_logger=self.enable_logging)
+        obj.start(blocking=False)
+        obj.wait(raise_exceptions=True)
+
+        self.assertTrue(obj.isSuccessful())
+        self.assertEqual(obj.get_data(binary=True), data)
+        self.assertEqual(obj.get_decoded_size(), len(data))
+
+    def test_compression(self):
+        url = "http://example.com/data.json"
+        data = json.dumps([{"id": i, "name": "item"} for i in range(100000)]).encode('utf-8')
+        transport = pySmartDL.transport.MemoryTransport({url: data}, compress=True)
+        obj = pySmartDL.SmartDL(url, dest=self.dl_dir, progress_bar=False, transport=transport, compression=True, connect_default_logger=self.enable_logging)
+        obj.start()
+        
+        self.assertTrue(obj.isSuccessful())
+        self.assertEqual(obj.get_data(binary=True), data)
+        self.assertEqual(obj.get_decoded_size(), len(data))
+        self.assertLess(obj.get_dl_size(), len(data))
+
+    def test_unsupported_encoding(self):
+        data = os.urandom(3*1024**2)
+        server = LocalHTTPServer({'/data.bin': data}, EncodingRequestHandler)
+        server.always_encode = False
+        try:
+            obj = pySmartDL.SmartDL(server.url('/data.bin'), dest=self.dl_dir, progress_bar=False, compression=True, connect_default_logger=self.enable_logging)
+            obj.start()
+            self.assertTrue(obj.isSuccessful())
+            self.assertEqual(obj.get_data(binary=True), data)
+            self.assertIn('identity', [r[2].get('Accept-Encoding') for r in server.requests])
+
+            server.always_encode = True
+            server.requests = []
+            obj = pySmartDL.SmartDL(server.url('/data.bin'), dest=self.dl_dir, progress_bar=False, compression=True, connect_default_logger=self.enable_logging)
+            self.assertRaises(ValueError, obj.start)
+            self.assertFalse(obj.isSuccessful())
+            self.assertEqual(len([r for r in server.requests if 'Range' not in r[2]]), 2)  # failed once, without retries
+        finally:
+            server.close()
+
+    def test_progress_callbacks(self):
+        url = "http://example.com/data.bin"
+        data = os.urandom(5*1024**2+123)
+        transport = pySmartDL.transport.MemoryTransport({url: data})
+        stream = io.StringIO()
+        obj = pySmartDL.SmartDL(url, dest=self.dl_dir, progress_bar=pySmartDL.progress.ProgressBar(stream), transport=transport, connect_default_logger=self.enable_logging)
+        progress, states = [], []
+        obj.on_progress(lambda obj: progress.append(obj.shared_var.value), min_interval=0, min_delta=1024**2)
+        obj.on_state_change(lambda obj, old, new: states.append(new))
+        obj.start()
+        
+        self.assertTrue(obj.isSuccessful())
+        self.assertTrue(1 < len(progress) <= 7)
+        self.assertEqual(progress[-1], len(data))
+        self.assertEqual(states, ["downloading", "combining", "finished"])
+        self.assertEqual(len(stream.getvalue().splitlines()), 1)  # not a terminal, so only the final line is printed
+
+    def test_multi_progress_bar(self):
+        class Bar(pySmartDL.progress.MultiProgressBar):
+            def format(self, obj, final=False):
+                return "{} {}".format(obj, "done" if final else "running")
+        stream = io.StringIO()
+        bar = Bar(stream)
+        bar.enabled = True
+        for name in ['a', 'b', 'c']:
+            bar.render(name)
+        bar.render('a', final=True)
+        bar.render('b')
+        bar.render('c', final=True)
+        
+        self.assertEqual(list(bar._lines.values()), ['b running'])  # finished downloads aren't redrawn
+        self.assertEqual(stream.getvalue().count('a done'), 1)
+        self.assertTrue(stream.getvalue().endswith('\x1b[2Fc done\x1b[K\nb running\x1b[K\n'))
+
+    def test_telemetry(self):
+        estimator = pySmartDL.telemetry.SpeedEstimator(halflife=1, capacity=10)
+        for i in range(20):
+            estimator.update(i*1000, now=i*0.1)
+        self.assertAlmostEqual(estimator.speed, 10000)
+        self.assertAlmostEqual(estimator.eta(5000), 0.5)
+        estimator.update(25*1000, now=2.5)  # a late sample at the same rate doesn't change the estimate
+        self.assertAlmostEqual(estimator.speed, 10000)
+        self.assertEqual(len(estimator.history.samples()), 10)
+        self.assertEqual(estimator.history.samples()[-1], (2.5, 25000))
+
+        url = "http://example.com/data.bin"
+        data = os.urandom(5*1024**2+123)
+        transport = pySmartDL.transport.MemoryTransport({url: data})
+        obj = pySmartDL.SmartDL(url, dest=self.dl_dir, progress_bar=False, transport=transport, connect_default_logger=self.enable_logging)
+        obj.start()
+        
+        self.assertTrue(obj.isSuccessful())
+        telemetry = obj.get_telemetry()
+        self.assertEqual(len(telemetry['connections']), obj.threads_count*2)  # a counter per range, and one per hedged request
+        self.assertTrue(telemetry['total']['samples'])
+
+    def test_tls_session_resumption(self):
+        self.assertIs(pySmartDL.tls.get_ssl_context(False), pySmartDL.tls.get_ssl_context(False))
+        self.assertIsNot(pySmartDL.tls.with_alpn(pySmartDL.tls.get_ssl_context(), ['h2']), pySmartDL.tls.get_ssl_context())
+
+        data = os.urandom(5*1024**2+123)
+        server = LocalHTTPSServer({'/data.bin': data})
+        try:
+            obj = pySmartDL.SmartDL(server.url('/data.bin'), dest=self.dl_dir, progress_bar=False, verify=False, transport=pySmartDL.transport.HTTPClientTransport(), connect_default_logger=self.enable_logging)
+            obj.start()
+        finally:
+            server.close()
+
+        self.assertTrue(obj.isSuccessful())
+        self.assertEqual(obj.get_data(binary=True), data)
+        metrics = obj.get_metrics()
+        self.assertGreaterEqual(metrics.get('tls_resumed_handshakes', 0), 1)
+        self.assertEqual(metrics['tls_resumed_handshakes'] + metrics.get('tls_full_handshakes', 0), metrics['connections'])
+
+    def test_tracing(self):
+        data = os.urandom(5*1024**2+123)
+        server = LocalHTTPServer({'/data.bin': data})
+        spans = []
+        try:
+            tracer = pySmartDL.tracing.Tracer(on_span=spans.append)
+            obj = pySmartDL.SmartDL(server.url('/data.bin'), dest=self.dl_dir, progress_bar=False, tracer=tracer, connect_default_logger=self.enable_logging)
+            obj.add_hash_verification('sha256', hashlib.sha256(data).hexdigest())
+            obj.start()
+        finally:
+            server.close()
+
+        self.assertTrue(obj.isSuccessful())
+        names = [s.name for s in tracer.get_spans()]
+        self.assertEqual(names, [s.name for s in spans])
+        for name in ['range_probe', 'probe', 'connect', 'request', 'read', 'combine', 'hash', 'smartdl']:
+            self.assertIn(name, names)
+        self.assertGreaterEqual(names.count('range'), 2)
+        self.assertEqual(names.count('range'), names.count('read'))
+        self.assertEqual(sum([s.args['bytes'] for s in spans if s.name == 'read']), len(data))
+
+        trace = tracer.export_chrome(os.path.join(self.dl_dir, 'trace.json'))
+        with open(os.path.join(self.dl_dir, 'trace.json')) as f:
+            self.assertEqual(json.load(f), trace)
+        self.assertEqual(len([e for e in trace['traceEvents'] if e['ph'] == 'X']), len(spans))
+
+        # nothing is recorded without a tracer
+        self.assertIs(pySmartDL.tracing.span('read'), pySmartDL.tracing.span('hash'))
+
+    def test_hedged_requests(self):
+        data = os.urandom(5*1024**2+123)
+        server = LocalHTTPServer({'/data.bin': data}, StallingRangeRequestHandler)
+        server.stalled = False
+        try:
+            obj = pySmartDL.SmartDL(server.url('/data.bin'), dest=self.dl_dir, progress_bar=False, connect_default_logger=self.enable_logging)
+            t1 = time.time()
+            obj.start()
+        finally:
+            server.close()
+
+        self.assertTrue(obj.isSuccessful())
+        self.assertLess(time.time()-t1, 10)
+        self.assertEqual(obj.get_data(binary=True), data)
+        self.assertEqual(obj.get_metrics()['hedged_requests'], 1)
+        self.assertEqual(obj.get_dl_size(), len(data))
+        self.assertEqual(obj.shared_var.value, len(data))
+
+        # the range stalls before its first byte: the hedge opens the part first, and the late answer doesn't truncate it.
+        server = LocalHTTPServer({'/data.bin': data}, StallingRangeRequestHandler)
+        server.stalled = False
+        server.stall_headers = True
+        try:
+            obj = pySmartDL.SmartDL(server.url('/data.bin'), dest=self.dl_dir, progress_bar=False, connect_default_logger=self.enable_logging)
+            obj.start()
+            time.sleep(1.5)  # until the stalled request is answered
+        finally:
+            server.close()
+
+        self.assertTrue(obj.isSuccessful())
+        self.assertEqual(obj.get_metrics()['hedged_requests'], 1)
+        self.assertEqual(obj.get_data(binary=True), data)
+
+        # a whole file is never written at the offset of a range
+        server = LocalHTTPServer({'/data.bin': data}, NoRangeRequestHandler)
+        dest = os.path.join(self.dl_dir, 'range.bin')
+        try:
+            self.assertRaises(urllib.error.URLError, pySmartDL.download.download, server.url('/data.bin'), dest, {}, None, 1024, 2047, offset=0)
+        finally:
+            server.close()
+
+    def test_governor(self):
+        self.assertEqual(pySmartDL.utils.parse_retry_after('120'), 120)
+        self.assertEqual(pySmartDL.utils.parse_retry_after('Wed, 21 Oct 2015 07:28:00 GMT', now=1445412470), 10)
+        self.assertIsNone(pySmartDL.utils.parse_retry_after('soon'))
+
+        host = pySmartDL.governor.HostGovernor('example.com', limit=8)
+        for i in range(6):
+            host.acquire()
+        host.on_overload()
+        host.on_overload()  # failures that come together only halve the limit once
+        self.assertEqual(host.limit, 3)
+        self.assertFalse(host.acquire(timeout=0.1))
+        for i in range(6):
+            host.release()
+        for i in range(3):
+            host.on_success()
+        self.assertEqual(host.limit, 4)
+
+        # a stop while waiting for a slot cancels the download, instead of finishing it
+        url = 'http://governor.invalid/data.bin'
+        host = pySmartDL.governor.governor.get(url)
+        for i in range(host.limit):
+            host.acquire()
+        try:
+            with self.assertRaises(pySmartDL.CanceledException):
+                pySmartDL.download.download(url, os.path.join(self.dl_dir, 'governor.bin'), thread_shared_cmds={'stop': ''})
+        finally:
+            for i in range(host.limit):
+                host.release()
+
+        data = os.urandom(12*1024**2)
+        server = LocalHTTPServer({'/data.bin': data}, OverloadedRangeRequestHandler)
+        server.refuse = 3
+        try:
+            obj = pySmartDL.SmartDL(server.url('/data.bin'), dest=self.dl_dir, progress_bar=False, connect_default_logger=self.enable_logging)
+            t1 = time.time()
+            obj.start()
+        finally:
+            server.close()
+
+        self.assertTrue(obj.isSuccessful())
+        self.assertLess(time.time()-t1, 5)  # Retry-After is used instead of the default delay
+        self.assertEqual(obj.get_data(binary=True), data)
+        self.assertGreaterEqual(obj.get_metrics()['governor_decreases'], 1)
+        self.assertLess(pySmartDL.governor.governor.get(obj.url).limit, pySmartDL.governor.MAX_CONNECTIONS)
+
+    def test_fetch_hash_sums(self):
+        files = dict(('/release/{}.bin'.format(i), os.urandom(1024)) for i in range(20))
+        sums = "".join(["{}  {}\n".format(hashlib.sha256(data).hexdigest(), os.path.basename(path)) for path, data in files.items()])
+        files['/release/SHA256SUMS'] = sums.encode('utf-8')
+        self.assertEqual(pySmartDL.hashsums.parse_sums("SHA256 (./a.bin) = ABCD\n"), {'a.bin': 'abcd'})
+
+        server = LocalHTTPServer(files, ETagRequestHandler)
+        ttl = pySmartDL.hashsums.SUMS_TTL
+        try:
+            urls = [server.url(path) for path in files if path.endswith('.bin')]
+            hashes = pySmartDL.hashsums.find_hashes(urls)
+            for url in urls:
+                self.assertEqual(hashes[url], ('sha256', hashlib.sha256(files[url[url.index('/release'):]]).hexdigest()))
+            self.assertEqual(len(server.requests), 3)  # each candidate sums file is requested once
+
+            obj = pySmartDL.SmartDL(urls[0], dest=self.dl_dir, progress_bar=False, connect_default_logger=self.enable_logging)
+            requests = len(server.requests)
+            self.assertTrue(obj.fetch_hash_sums())
+            self.assertEqual(len(server.requests), requests)  # cached
+            self.assertEqual(obj.hash_code, hashes[urls[0]][1])
+
+            pySmartDL.hashsums.SUMS_TTL = 0
+            self.assertEqual(pySmartDL.hashsums.find_hash(urls[1]), hashes[urls[1]])
+            revalidations = [r for r in server.requests[requests:] if r[1].endswith('SHA256SUMS')]
+            self.assertEqual(len(revalidations), 1)
+            self.assertIn('If-None-Match', revalidations[0][2])
+        finally:
+            pySmartDL.hashsums.SUMS_TTL = ttl
+            server.close()
+
+    def test_get_data_mapped(self):
+        url = "http://example.com/data.json"
+        data = json.dumps({'values': list(range(100000))}).encode('utf-16')
+        transport = pySmartDL.transport.MemoryTransport({url: data})
+        obj = pySmartDL.SmartDL(url, dest=self.dl_dir, progress_bar=False, transport=transport, connect_default_logger=self.enable_logging)
+        obj.add_hash_verification('sha256', hashlib.sha256(data).hexdigest())
+        obj.start()
+
+        self.assertTrue(obj.isSuccessful())
+        view = obj.get_data(mapped=True)
+        self.assertTrue(view.readonly)
+        self.assertEqual(view, data)
+        head = obj.get_data(bytes=10, mapped=True)
+        self.assertEqual(head, data[:10])
+        mapping = head.obj
+        head.release()
+        mapping.close()  # nothing else holds the map
+        view.release()
+        for encoding in ['utf-8', 'utf-8-sig', 'utf-16', 'utf-16-le', 'utf-16-be', 'utf-32', 'utf-32-le', 'utf-32-be']:
+            self.assertEqual(pySmartDL.utils.detect_json_encoding('{"a": 1}'.encode(encoding)[:4]), encoding)
+        self.assertEqual(obj.get_json(), {'values': list(range(100000))})
+        self.assertEqual(obj.get_data_hash('sha256'), hashlib.sha256(data).hexdigest())
+        self.assertEqual(obj.get_data_hash('md5'), hashlib.md5(data).hexdigest())
+
+    def test_pause_closes_connections(self):
+        data = os.urandom(8*1024**2)
+        server = LocalHTTPServer({'/data.bin': data}, ThrottledRangeRequestHandler)
+        server.connections = 0
+        try:
+            obj = pySmartDL.SmartDL(server.url('/data.bin'), dest=self.dl_dir, progress_bar=False, threads=2, hedging=False, connect_default_logger=self.enable_logging)
+            obj.start(blocking=False)
+            while obj.get_dl_size() < 1024**2:
+                time.sleep(0.05)
+            obj.pause()
+            time.sleep(1)
+            self.assertEqual(server.connections, 0)
+            paused_size = obj.get_dl_size()
+            requests = len(server.requests)
+            obj.resume()
+            obj.wait()
+        finally:
+            server.close()
+
+        self.assertTrue(obj.isSuccessful())
+        self.assertEqual(obj.get_data(binary=True), data)
+        self.assertEqual(obj.get_dl_size(), len(data))
+        resumed = [r[2]['Range'] for r in server.requests[requests:]]
+        self.assertEqual(len(resumed), 2)
+        starts = [arg[0] for arg in pySmartDL.utils.calc_chunk_size(len(data), 2, obj.minChunkFile)]
+        self.assertEqual(sum([int(r[len('bytes='):].split('-')[0]) for r in resumed]) - sum(starts), paused_size)
+
+    def test_chunked_response_size(self):
+        data = os.urandom(6*1024**2+123)
+        server = LocalHTTPServer({'/data.bin': data}, ChunkedRequestHandler)
+        try:
+            self.assertTrue(pySmartDL.utils.is_HTTPRange_supported(server.url('/data.bin')))
+            self.assertEqual(pySmartDL.utils.get_filesize(server.url('/data.bin')), len(data))
+            obj = pySmartDL.SmartDL(server.url('/data.bin'), dest=self.dl_dir, progress_bar=False, threads=3, connect_default_logger=self.enable_logging)
+            requests = len(server.requests)
+            obj.start()
+        finally:
+            server.close()
+
+        self.assertTrue(obj.isSuccessful())
+        self.assertEqual(obj.get_final_filesize(), len(data))
+        self.assertEqual(obj.get_progress(), 1.0)
+        self.assertEqual(obj.get_data(binary=True), data)
+        ranges = [r[2]['Range'] for r in server.requests[requests:] if r[2].get('Range', 'bytes=0-0') != 'bytes=0-0']
+        self.assertEqual(len(ranges), 3)
+
+    def test_resolved_url(self):
+        self.assertEqual(pySmartDL.utils.get_url_expiry('https://s3.amazonaws.com/b/f?X-Amz-Date=20240101T000000Z&X-Amz-Expires=3600'), 1704070800)
+        self.assertIsNone(pySmartDL.utils.get_url_expiry('https://example.com/f?a=1'))
+
+        data = os.urandom(6*1024**2)
+        server = LocalHTTPServer({'/data.bin': data}, RedirectingRequestHandler)
+        server.redirects = 0
+        server.revoked = set()
+        server.expires = int(time.time()) + 3600
+        try:
+            # the range requests go to the target of the redirect
+            obj = pySmartDL.SmartDL(server.url('/data.bin'), dest=os.path.join(self.dl_dir, 'a', ''), progress_bar=False, threads=3, connect_default_logger=self.enable_logging)
+            redirects = server.redirects
+            obj.start()
+            self.assertTrue(obj.isSuccessful())
+            self.assertEqual(obj.get_data(binary=True), data)
+            self.assertEqual(server.redirects, redirects+1)  # only the probe
+            self.assertIn('/signed/data.bin?sig={}'.format(server.redirects), obj.get_resolved_url())
+
+            # a refused target falls back to the original url
+            obj = pySmartDL.SmartDL(server.url('/data.bin'), dest=os.path.join(self.dl_dir, 'b', ''), progress_bar=False, threads=3, connect_default_logger=self.enable_logging)
+            redirects = server.redirects
+            server.revoked.add(redirects+1)
+            obj.start()
+            self.assertTrue(obj.isSuccessful())
+            self.assertEqual(obj.get_data(binary=True), data)
+            self.assertEqual(server.redirects, redirects+1+3)
+
+            # an expired target isn't used
+            server.expires = int(time.time()) + 10
+            obj = pySmartDL.SmartDL(server.url('/data.bin'), dest=os.path.join(self.dl_dir, 'c', ''), progress_bar=False, threads=3, connect_default_logger=self.enable_logging)
+            redirects = server.redirects
+            obj.start()
+            self.assertTrue(obj.isSuccessful())
+            self.assertEqual(obj.get_resolved_url(), obj.url)
+            self.assertEqual(server.redirects, redirects+1+3)
+
+            # the members of a remote zip are fetched from the target too, and from the original url once it's refused
+            server.expires = int(time.time()) + 3600
+            files = {'a.bin': os.urandom(1024**2), 'b.txt': b'hello'*1000}
+            zip_buf = io.BytesIO()
+            with zipfile.ZipFile(zip_buf, 'w') as zf:
+                for name, content in files.items():
+                    zf.writestr(name, content)
+            server.files['/data.zip'] = zip_buf.getvalue()
+            for revoked in [False, True]:
+                dest = os.path.join(self.dl_dir, 'zip{}'.format(revoked), '')
+                obj = pySmartDL.SmartDL(server.url('/data.zip'), dest=dest, progress_bar=False, connect_default_logger=self.enable_logging)
+                redirects = server.redirects
+                if revoked:
+                    server.revoked.add(redirects+1)
+                obj.add_extraction(os.path.join(dest, 'extracted'), keep_archive=False)
+                obj.start()
+                self.assertTrue(obj.isSuccessful())
+                for name, content in files.items():
+                    with open(os.path.join(dest, 'extracted', name), 'rb') as f:
+                        self.assertEqual(f.read(), content)
+                if revoked:
+                    self.assertGreater(server.redirects, redirects+1)
+                else:
+                    self.assertEqual(server.redirects, redirects+1)  # only the probe
+        finally:
+            server.close()
+
+    def test_multirange_fetcher(self):
+        data = os.urandom(1024**2)
+        ranges = [(i*20000, i*20000+100+i) for i in range(40)] + [(5, 10), (0, 0)]
+        server = LocalHTTPServer({'/data.bin': data}, MultiRangeRequestHandler)
+        server.multirange = True
+        try:
+            fetcher = pySmartDL.multirange.MultiRangeFetcher(server.url('/data.bin'))
+            self.assertEqual(fetcher.fetch(ranges), [data[start:end] for start, end in ranges])
+            self.assertTrue(fetcher.multirange_supported)
+            self.assertEqual(fetcher.requests, 2)  # 40 ranges, 32 per request
+
+            os.makedirs(self.dl_dir, exist_ok=True)
+            dest = os.path.join(self.dl_dir, 'ranges.bin')
+            fetcher.download(ranges, dest)
+            with open(dest, 'rb') as f:
+                written = f.read()
+            for start, end in ranges:
+                self.assertEqual(written[start:end], data[start:end])
+
+            server.multirange = False
+            fetcher = pySmartDL.multirange.MultiRangeFetcher(server.url('/data.bin'))
+            self.assertEqual(fetcher.fetch(ranges[:10]), [data[start:end] for start, end in ranges[:10]])
+            self.assertFalse(fetcher.multirange_supported)
+            self.assertEqual(fetcher.requests, 1+10)  # one request per range after the first answer
+        finally:
+            server.close()
+
+    def test_shared_supervisor(self):
+        files = dict(('http://example.com/{}.bin'.format(i), os.urandom(64*1024)) for i in range(100))
+        transport = pySmartDL.transport.MemoryTransport(files)
+        objs = [pySmartDL.SmartDL(url, dest=os.path.join(self.dl_dir, url.rsplit('/', 1)[1]), progress_bar=False, transport=transport, connect_default_logger=self.enable_logging) for url in files]
+        threads = threading.active_count()
+        for obj in objs:
+            obj.start(blocking=False)
+        self.assertLessEqual(threading.active_count() - threads, pySmartDL.supervisor.MAX_WORKERS + 1)
+        for obj in objs:
+            obj.wait()
+
+        for url, obj in zip(files, objs):
+            self.assertTrue(obj.isSuccessful())
+            self.assertEqual(obj.get_data(binary=True), files[url])
+            self.assertEqual(len(obj.pool._futures), 1)
+        self.assertLessEqual(threading.active_count() - threads, pySmartDL.supervisor.MAX_WORKERS + 1)
+        time.sleep(pySmartDL.supervisor.INTERVAL * 3)
+        self.assertEqual(pySmartDL.supervisor.supervisor.get_watched(), [])
+
+    def test_small_file_fast_path(self):
+        data = os.urandom(20*1024)
+        server = LocalHTTPServer({'/small.bin': data})
+        try:
+            obj = pySmartDL.SmartDL(server.url('/small.bin'), dest=self.dl_dir, progress_bar=False, connect_default_logger=self.enable_logging)
+            requests = len(server.requests)
+            obj.start()
+        finally:
+            server.close()
+
+        self.assertTrue(obj.isSuccessful())
+        self.assertEqual(obj.get_data(binary=True), data)
+        self.assertEqual(len(server.requests), requests+1)  # only the probe request
+        self.assertEqual(obj.pool.get_exceptions(), [])
+        self.assertFalse(obj.pool._futures)
+        self.assertEqual(obj.get_dl_size(), len(data))
+        self.assertFalse(os.path.exists(obj.get_dest()+".000"))
+
+    def test_single_flight(self):
+        data = os.urandom(5*1024**2+123)
+        server = LocalHTTPServer({'/data.bin': data}, SlowRangeRequestHandler)
+        try:
+            objs = [pySmartDL.SmartDL(server.url('/data.bin'), dest=os.path.join(self.dl_dir, str(i), ''), progress_bar=False, single_flight=True, connect_default_logger=self.enable_logging) for i in range(3)]
+            requests = len(server.requests)
+            for obj in objs:
+                obj.start(blocking=False)
+            for obj in objs:
+                obj.wait()
+        finally:
+            server.close()
+
+        for obj in objs:
+            self.assertTrue(obj.isSuccessful())
+            self.assertEqual(obj.get_data(binary=True), data)
+        new_requests = server.requests[requests:]
+        self.assertEqual(len([r for r in new_requests if 'Range' not in r[2]]), 1)  # a single probe
+        self.assertEqual(sum([int(r[2]['Range'].split('-')[1]) - int(r[2]['Range'][6:].split('-')[0]) + 1 for r in new_requests if 'Range' in r[2]]), len(data))
+
+        # another process holds the lock file, and writes the result when it's done
+        dest = os.path.join(self.dl_dir, 'other', 'data.bin')
+        os.makedirs(os.path.dirname(dest))
+        lock = pySmartDL.singleflight.FileLock(dest + '.lock')
+        self.assertTrue(lock.acquire())
+        transport = pySmartDL.transport.MemoryTransport({"http://example.com/data.bin": data})
+        obj = pySmartDL.SmartDL("http://example.com/data.bin", dest=dest, progress_bar=False, transport=transport, single_flight=True, connect_default_logger=self.enable_logging)
+        requests = len(transport.requests)
+        obj.start(blocking=False)
+        with open(dest, 'wb') as f:
+            f.write(data)
+        lock.release({'ok': True, 'error': None, 'pid': 0, 'filesize': len(data)})
+        obj.wait()
+        self.assertTrue(obj.isSuccessful())
+        self.assertEqual(len(transport.requests), requests)
+
+        # the next process that downloads the file dies without a result. the old result isn't read as its own.
+        self.assertTrue(lock.acquire(clear=True))
+        obj = pySmartDL.SmartDL("http://example.com/data.bin", dest=dest, progress_bar=False, transport=transport, single_flight=True, connect_default_logger=self.enable_logging)
+        obj.start(blocking=False)
+        lock.release()
+        obj.wait()
+        self.assertFalse(obj.isSuccessful())
+        self.assertIn('exited without a result', str(obj.get_errors()[-1]))
+
+    def test_sync(self):
+        files = {'a.bin': os.urandom(100*1024), 'dir/b.bin': os.urandom(3*1024**2), 'c.bin': os.urandom(1024)}
+        transport = pySmartDL.transport.MemoryTransport({"http://example.com/" + name: data for name, data in files.items()})
+        manifest = [{'path': name, 'url': "http://example.com/" + name, 'size': len(data), 'hash': hashlib.sha256(data).hexdigest(), 'mtime': 1500000000}
+                    for name, data in files.items()]
+        root = os.path.join(self.dl_dir, 'tree')
+        os.makedirs(root)
+        with open(os.path.join(root, 'a.bin'), 'wb') as f:
+            f.write(files['a.bin'])  # unchanged, but the mtime differs
+        with open(os.path.join(root, 'c.bin'), 'wb') as f:
+            f.write(os.urandom(1024))  # changed, same size
+
+        summary = pySmartDL.sync.sync(manifest, root, transport=transport)
+        self.assertEqual((summary['unchanged'], summary['downloaded'], summary['failed'], summary['hashed']), (1, 2, 0, 2))
+        self.assertEqual(summary['bytes_saved'], len(files['a.bin']))
+        for name, data in files.items():
+            with open(os.path.join(root, name), 'rb') as f:
+                self.assertEqual(f.read(), data)
+
+        requests = len(transport.requests)
+        summary = pySmartDL.sync.sync(manifest, root, transport=transport)
+        self.assertEqual((summary['unchanged'], summary['hashed']), (3, 0))  # the mtimes match now
+        self.assertEqual(len(transport.requests), requests)
+
+    def test_remote_file(self):
+        files = {'a.bin': os.urandom(3*1024**2), 'b.txt': b'hello'*1000}
+        buf = io.BytesIO()
+        with zipfile.ZipFile(buf, 'w') as zf:
+            for name, content in files.items():
+                zf.writestr(name, content)
+        data = buf.getvalue()
+        url = "http://example.com/data.zip"
+        transport = pySmartDL.transport.MemoryTransport({url: data})
+
+        with pySmartDL.RemoteFile(url, block_size=64*1024, cache_blocks=8, transport=transport) as f:
+            self.assertEqual(f.size, len(data))
+            with zipfile.ZipFile(f) as zf:
+                self.assertEqual(zf.read('b.txt'), files['b.txt'])
+            self.assertLess(f.bytes_fetched, 512*1024)  # only the central directory and b.txt
+
+            f.seek(0)
+            self.assertEqual(f.read(), data)
+            f.seek(-10, io.SEEK_END)
+            self.assertEqual(f.read(100), data[-10:])
+
+    def test_extraction(self):
+        files = {'a.bin': os.urandom(3*1024**2), 'dir/b.txt': b'hello'*1000, 'c.bin': os.urandom(2*1024**2)}
+        tar_buf, zip_buf = io.BytesIO(), io.BytesIO()
+        with tarfile.open(fileobj=tar_buf, mode='w:gz') as tar:
+            for name, content in files.items():
+                info = tarfile.TarInfo(name)
+                info.size = len(content)
+                tar.addfile(info, io.BytesIO(content))
+        with zipfile.ZipFile(zip_buf, 'w', zipfile.ZIP_DEFLATED) as zf:
+            for name, content in files.items():
+                zf.writestr(name, content)
+        transport = pySmartDL.transport.MemoryTransport({
+            "http://example.com/data.tar.gz": tar_buf.getvalue(),
+            "http://example.com/data.zip": zip_buf.getvalue(),
+        })
+
+        for url, keep_archive in [("http://example.com/data.tar.gz", True), ("http://example.com/data.tar.gz", False), ("http://example.com/data.zip", True), ("http://example.com/data.zip", False)]:
+            dest = os.path.join(self.dl_dir, str(keep_archive), '')
+            path = os.path.join(dest, 'extracted')
+            obj = pySmartDL.SmartDL(url, dest=dest, progress_bar=False, transport=transport, connect_default_logger=self.enable_logging)
+            obj.add_extraction(path, keep_archive=keep_archive)
+            obj.start()
+
+            self.assertTrue(obj.isSuccessful())
+            self.assertEqual(os.path.exists(obj.get_dest()), keep_archive)
+            for name, content in files.items():
+                with open(os.path.join(path, name), 'rb') as f:
+                    self.assertEqual(f.read(), content)
+
+        # the members are streamed. only the central directory is fetched whole.
+        class CountingFetcher(pySmartDL.extract.RangeFetcher):
+            fetched = 0
+            def __call__(self, start, end):
+                self.fetched += end-start
+                return pySmartDL.extract.RangeFetcher.__call__(self, start, end)
+        fetch = CountingFetcher("http://example.com/data.zip", transport)
+        path = os.path.join(self.dl_dir, 'streamed')
+        pySmartDL.extract.extract_remote_zip(len(zip_buf.getvalue()), fetch, path, threads=2)
+        self.assertLessEqual(fetch.fetched, 64*1024+22)
+        for name, content in files.items():
+            with open(os.path.join(path, name), 'rb') as f:
+                self.assertEqual(f.read(), content)
+
+        # many members under one folder are extracted in parallel
+        nested = dict(('dir/sub/{}.bin'.format(i), os.urandom(64*1024)) for i in range(40))
+        nested_buf = io.BytesIO()
+        with zipfile.ZipFile(nested_buf, 'w') as zf:
+            zf.writestr('dir/', b'')
+            for name, content in nested.items():
+                zf.writestr(name, content)
+        transport.files["http://example.com/nested.zip"] = nested_buf.getvalue()
+        class SlowStream(object):
+            def __init__(self, stream, fetch):
+                self.stream = stream
+                self.fetch = fetch
+            def readinto(self, b):
+                with self.fetch.lock:
+                    self.fetch.reading += 1
+                    self.fetch.max_reading = max(self.fetch.max_reading, self.fetch.reading)
+                time.sleep(0.01)
+                try:
+                    return self.stream.readinto(b)
+                finally:
+                    with self.fetch.lock:
+                        self.fetch.reading -= 1
+            def close(self):
+                self.stream.close()
+        class SlowFetcher(pySmartDL.extract.RangeFetcher):
+            lock = threading.Lock()
+            reading = max_reading = 0
+            def open(self, start, end):
+                return SlowStream(pySmartDL.extract.RangeFetcher.open(self, start, end), self)
+        for i in range(3):
+            path = os.path.join(self.dl_dir, 'nested{}'.format(i))
+            fetch = SlowFetcher("http://example.com/nested.zip", transport)
+            pySmartDL.extract.extract_remote_zip(len(nested_buf.getvalue()), fetch, path, threads=8)
+            self.assertGreater(fetch.max_reading, 1)  # the members aren't read under one lock
+            for name, content in nested.items():
+                with open(os.path.join(path, name), 'rb') as f:
+                    self.assertEqual(f.read(), content)
+
+        # the archive is downloaded to be hashed, even if it isn't kept.
+        for hash_, successful in [(hashlib.sha256(zip_buf.getvalue()).hexdigest(), True), ('0'*64, False)]:
+            dest = os.path.join(self.dl_dir, hash_, '')
+            obj = pySmartDL.SmartDL("http://example.com/data.zip", dest=dest, progress_bar=False, transport=transport, connect_default_logger=self.enable_logging)
+            obj.add_hash_verification('sha256', hash_)
+            obj.add_extraction(os.path.join(dest, 'extracted'), keep_archive=False)
+            obj.start(blocking=False)
+            obj.wait()
+
+            self.assertEqual(obj.isSuccessful(), successful)
+            self.assertEqual(any([isinstance(e, pySmartDL.HashFailedException) for e in obj.get_errors()]), not successful)
+
+    @unittest.skipUnless(urllib3, "requires the urllib3 package")
+    def test_urllib3_transport(self):
+        data = os.urandom(1024**2)
+        server = LocalHTTPServer({'/data.bin': data})
+        transport = pySmartDL.transport.Urllib3Transport()
+        try:
+            obj = pySmartDL.SmartDL(server.url('/data.bin'), dest=self.dl_dir, progress_bar=False, transport=transport, connect_default_logger=self.enable_logging)
+            obj.start()
+            self.assertTrue(obj.isSuccessful())
+            self.assertEqual(obj.get_data(binary=True), data)
+        finally:
+            server.close()
+
+        # a closed port fails right away, instead of being retried without a limit.
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        t = time.time()
+        self.assertRaises(urllib.error.URLError, transport.open, "http://127.0.0.1:{}/data.bin".format(port), timeout=2)
+        self.assertLess(time.time() - t, 2)
+        transport.close()
+
+    @unittest.skipUnless(h2, "requires the h2 package")
+    def test_http2_transport(self):
+        data = os.urandom(5*1024**2+123)
+        server = H2TestServer({'/data.bin': data})
+        transport = pySmartDL.http2.H2Transport(allow_h2c=True)
+        url = "http://127.0.0.1:{}/data.bin".format(server.port)
+        try:
+            obj = pySmartDL.SmartDL(url, dest=self.dl_dir, progress_bar=False, transport=transport, connect_default_logger=self.enable_logging)
+            obj.start()
+        finally:
+            transport.close()
+            server.close()
+        
+        self.assertTrue(obj.isSuccessful())
+        self.assertEqual(obj.get_data(binary=True), data)
+        self.assertEqual(server.connections, 1)  # all the ranges were multiplexed over one connection
+
+        # a slow handshake with one host doesn't hold up the requests to another
+        server = H2TestServer({'/data.bin': data})
+        transport = pySmartDL.http2.H2Transport(allow_h2c=True)
+        connect = transport._connect
+        slow = threading.Event()
+        def _connect(scheme, host, port, context, timeout):
+            if host == 'localhost':
+                slow.wait(10)
+            return connect(scheme, '127.0.0.1', port, context, timeout)
+        transport._connect = _connect
+        try:
+            t = threading.Thread(target=lambda: transport.open("http://localhost:{}/data.bin".format(server.port), endByte=99).read())
+            t.start()
+            t0 = time.time()
+            transport.open("http://127.0.0.1:{}/data.bin".format(server.port), endByte=99).close()
+            self.assertLess(time.time()-t0, 5)
+            slow.set()
+            t.join()
+        finally:
+            slow.set()
+            transport.close()
+            server.close()
+
+    def test_connection_metrics(self):
+        data = os.urandom(5*1024**2+123)
+        server = LocalHTTPServer({'/data.bin': data})
+        try:
+            # "localhost" may resolve to ::1 too, while the server only listens on 127.0.0.1
+            obj = pySmartDL.SmartDL(server.url('/data.bin', host='localhost'), dest=self.dl_dir, progress_bar=False, connect_default_logger=self.enable_logging)
+            obj.start()
+        finally:
+            server.close()
+        
+        self.assertTrue(obj.isSuccessful())
+        self.assertEqual(obj.get_data(binary=True), data)
+        metrics = obj.get_metrics()
+        self.assertGreaterEqual(metrics['connect_time']['count'], 4)
+        self.assertGreaterEqual(metrics['dns_cache_hits'], 1)
+
+        # the expired names are dropped, and the cache doesn't grow past its size
+        cache = pySmartDL.resolver.DNSCache()
+        ttl, size = pySmartDL.resolver.DNS_TTL, pySmartDL.resolver.DNS_CACHE_SIZE
+        try:
+            pySmartDL.resolver.configure(dns_ttl=0.05, dns_cache_size=3)
+            cache.getaddrinfo('127.0.0.1', 1)
+            time.sleep(0.1)
+            cache.getaddrinfo('127.0.0.1', 2)
+            self.assertEqual(len(cache), 1)
+            pySmartDL.resolver.configure(dns_ttl=60)
+            for port in range(3, 8):
+                cache.getaddrinfo('127.0.0.1', port)
+            self.assertEqual(len(cache), 3)
+        finally:
+            pySmartDL.resolver.configure(dns_ttl=ttl, dns_cache_size=size)
+
+        metrics = pySmartDL.metrics.Metrics()
+        for i in range(pySmartDL.metrics.MAX_SAMPLES*3):
+            metrics.add_timing('ttfb', i)
+        self.assertEqual(len(metrics.timings['ttfb'].samples), pySmartDL.metrics.MAX_SAMPLES)
+        self.assertEqual(metrics.snapshot()['ttfb'], {'count': 3000, 'total': sum(range(3000)), 'min': 0, 'max': 2999, 'avg': 1499.5})
+
     def test_utils(self):
         self.assertEqual(pySmartDL.utils.progress_bar(0.6, length=42), '[########################----------------]')
         self.assertEqual(pySmartDL.utils.sizeof_human(175799789), '167.7 MB')